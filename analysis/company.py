@@ -3,14 +3,16 @@ import pandas as pd
 
 from analysis.technical import Technical
 from data import store as store
+from data.panel import Panel
 from utils import logger
 
 _logger = logger.get_logger()
 
 
 class Company:
-    def __init__(self, ticker: str, days: int, backtest: int = 0, lazy: bool = True, live: bool = False):
-        if not store.is_ticker(ticker):
+    def __init__(self, ticker: str, days: int, backtest: int = 0, lazy: bool = True, live: bool = False, validate: bool = True,
+                 panel: Panel | None = None):
+        if validate and not store.is_ticker(ticker):
             raise ValueError(f'Invalid ticker {ticker}')
         if days < 1:
             raise ValueError('Invalid number of days')
@@ -27,6 +29,7 @@ class Company:
         self.volatility = 0.0
         self.active = True
         self.ta: Technical = None
+        self.panel = panel  # Shared history of many tickers to load from instead of the store
 
         if not lazy:
             self._load_history()
@@ -108,7 +111,10 @@ class Company:
 
     def _load_history(self) -> bool:
         success = False
-        self.history = store.get_history(self.ticker, self.days, end=self.backtest, live=self.live)
+        if self.panel is not None and self.ticker in self.panel:
+            self.history = self.panel.get_history(self.ticker)
+        else:
+            self.history = store.get_history(self.ticker, self.days, end=self.backtest, live=self.live)
         if self.history.empty:
             self.active = False
             _logger.info(f'{__name__}: Empty history for {self.ticker}')
@@ -122,7 +128,7 @@ class Company:
         return success
 
     def _load_company(self) -> None:
-        self.information = store.get_company(self.ticker, live=self.live)
+        self.information = store.get_companies([self.ticker], live=self.live).get(self.ticker, {})
         if not self.information:
             raise RuntimeError(f'No company info for {self.ticker}')
 
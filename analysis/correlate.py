@@ -1,6 +1,10 @@
 import datetime as dt
 
+import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
 
 from base import Threaded
 from data import store as store
@@ -10,11 +14,16 @@ _logger = logger.get_logger()
 
 
 CORRELATION_CUTOFF = 0.85
+CORRELATION_MIN_PERIODS = 20  # Fewer overlapping returns give NaN
+ROLLING_CELLS = 1 << 21  # Correlations held at once by rolling_correlation() (windows x tickers x tickers)
+TRADING_DAYS = 252  # Per year, to size the running correlation's window of returns from calendar days
 CACHE_TYPE = 'cor'
+CACHE_TYPE_RUNNING = 'crs'
+CACHE_TYPE_CLUSTERS = 'ccl'
 
 
 class Correlate(Threaded):
-    def __init__(self, tickers: list[str], name: str, days: int = 365):
+    def __init__(self, tickers: list[str], name: str, days: int = 365, dtype: type = np.float64, block: int = 0):
         if tickers is None:
             raise ValueError('Invalid list of tickers')
         if not tickers:
@@ -24,89 +33,176 @@ class Correlate(Threaded):
         self.name = name
         self.results: pd.DataFrame = pd.DataFrame()
         self.filtered: pd.DataFrame = pd.DataFrame()
+        self.returns: pd.DataFrame = pd.DataFrame()
+        self.rolling: pd.DataFrame = pd.DataFrame()
+        self.clusters: pd.DataFrame = pd.DataFrame()
         self.days: int = days
+        self.window = max(round(days * TRADING_DAYS / 365), 2)
+        self.dtype = dtype
+        self.block = block
         self.cache_available = False
         self.cache_date: str = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
         self.cache_today_only = cache.CACHE_TODAY_ONLY
-        self.cache_available = cache.exists(self.name, CACHE_TYPE, today_only=self.cache_today_only)
+        self.cache_key = cache.build_key(tickers=set(tickers), days=days, values='log_returns', revision=store.get_database_revision())
+        self.cache_available = cache.exists(self.name, CACHE_TYPE, today_only=self.cache_today_only, params=self.cache_key)
 
     @Threaded.threaded
     def compute(self) -> None:
         self.results = pd.DataFrame()
-        combined_df = pd.DataFrame()
+        returns = pd.DataFrame()
         self.task_total = len(self.tickers)
 
-        if self.cache_available:
-            combined_df, self.cache_date = cache.load(self.name, CACHE_TYPE, today_only=self.cache_today_only)
-        else:
+        # A running correlation covering the tickers (see update()) only needs the days since it was saved
+        running = self._load_running()
+        if running is not None and set(ticker.upper() for ticker in self.tickers) <= set(running.tickers):
             self.task_state = 'Fetching'
-            for ticker in self.tickers:
-                self.task_ticker = ticker
-                df = store.get_history(ticker, self.days)
-                if not df.empty:
-                    df = df.set_index('date')
-                    df = df.rename(columns={'close': ticker})
-                    df = df.drop(['high', 'low', 'open', 'volume'], axis=1)
+            self._update_running(running)
+            self.task_completed = self.task_total
 
-                    if combined_df.empty:
-                        combined_df = df
-                    else:
-                        combined_df = pd.concat([combined_df, df], axis=1)
+            self.task_state = 'Correlating'
+            index = {ticker: n for n, ticker in enumerate(running.tickers)}
+            columns = np.array(sorted(index[ticker.upper()] for ticker in set(self.tickers)))
+            tickers = [running.tickers[column] for column in columns]
 
-                self.task_completed += 1
+            self.returns = pd.DataFrame(running.returns[:, columns], index=running.dates, columns=tickers)
+            self.results = pd.DataFrame(running.matrix(columns), index=tickers, columns=tickers)
+            self.results = self.results.loc[self.results.notna().any(), self.results.notna().any()]
+            self.task_success = self.results.shape[1]
+            self.task_object = self.results
+        elif self.cache_available:
+            returns, self.cache_date = cache.load(self.name, CACHE_TYPE, today_only=self.cache_today_only, params=self.cache_key)
+        else:
+            # One bulk read into an aligned date x ticker panel
+            self.task_state = 'Fetching'
+            panel = store.get_history_panel(self.tickers, self.days)
+            self.task_completed = self.task_total
+
+            returns = pd.DataFrame(log_returns(panel.close, panel.valid), index=panel.dates[1:], columns=panel.tickers)
+            returns = returns.loc[:, returns.notna().any()]
+            self.task_success = returns.shape[1]
 
-            if not combined_df.empty:
-                cache.dump(combined_df, self.name, CACHE_TYPE)
+            if not returns.empty:
+                cache.dump(returns, self.name, CACHE_TYPE, params=self.cache_key)
 
-        if not combined_df.empty:
+        if self.results.empty and returns is not None and not returns.empty:
+            self.returns = returns
             self.task_state = 'Correlating'
-            self.results = combined_df.fillna(combined_df.mean())
-            self.results = combined_df.corr()
+            matrix = correlate(returns.to_numpy(), dtype=self.dtype, block=self.block)
+            self.results = pd.DataFrame(matrix, index=returns.columns, columns=returns.columns)
             self.task_object = self.results
 
         self.task_state = 'Done'
 
     @Threaded.threaded
-    def filter(self, sublist: list[str]=[]) -> None:
+    def update(self) -> None:
+        # Bring the running correlation for the list up to date, adding only the days since it was last
+        # saved, then save it in place of the last one. It is rebuilt from the whole window if the tickers change
+        self.results = pd.DataFrame()
+        self.task_total = len(self.tickers)
+        self.task_state = 'Fetching'
+
+        running = self._load_running()
+        if running is not None and set(running.tickers) == set(ticker.upper() for ticker in self.tickers):
+            added = self._update_running(running)
+        else:
+            days = int(self.window * 365 / TRADING_DAYS) + 7
+            panel = store.get_history_panel(self.tickers, days)
+            running = RunningCorrelation(panel.tickers, self.window)
+            added = running.push(log_returns(panel.close, panel.valid), panel.dates[1:])
+            cache.dump(running, self.name, CACHE_TYPE_RUNNING, params=self._running_key(), replace=True)
+
+        self.task_completed = self.task_total
+        self.task_success = added
+
+        self.task_state = 'Correlating'
+        self.results = pd.DataFrame(running.matrix(), index=running.tickers, columns=running.tickers)
+        self.results = self.results.loc[self.results.notna().any(), self.results.notna().any()]
+        self.task_object = self.results
+
+        _logger.info(f'{__name__}: Running correlation for {self.name} updated with {added} day(s)')
+
+        self.task_state = 'Done'
+
+    @Threaded.threaded
+    def filter(self, sublist: list[str] = [], top: int = 0, per_ticker: bool = False) -> None:
         self.filtered = pd.DataFrame()
 
-        all_df = pd.DataFrame()
-        all = []
         if not self.results.empty:
-            if sublist:
-                tickers = [ticker for ticker in self.results if ticker in sublist]
-            else:
-                tickers = [ticker for ticker in self.results if ticker in self.results]
+            tickers = self.results.columns.to_list()
+            selected = np.isin(tickers, sublist) if sublist else None
 
-            self.task_total = len(tickers)
+            self.task_total = len(sublist) if sublist else len(tickers)
             self.task_state = 'Filtering'
 
-            correlation_generator = (self.get_ticker_correlation(ticker) for ticker in tickers)
-            for df in correlation_generator:
-                self.task_ticker = df.index.name
-                for s in df.itertuples():
-                    # s = (ticker1, ticker2, correlation)
-                    # Arrange the symbol names so we can more easily remove duplicates
-                    if df.index.name < s[1]:
-                        t = (df.index.name, s[1])
-                    else:
-                        t = (s[1], df.index.name)
-
-                    # Add if relevant and not already in list
-                    if s[2] < CORRELATION_CUTOFF:
-                        pass
-                    elif t not in all:
-                        all.append(t)
-                        new = pd.Series({'ticker1':t[0], 'ticker2':t[1], 'correlation':s[2]}).to_frame().T
-                        all_df = pd.concat([all_df, new])
-
-                self.task_completed += 1
-
-            all_df = all_df.sort_values(['correlation'], ascending=False)
-            self.filtered = all_df.reset_index(drop=True)
+            self.filtered = get_pairs(self.results.to_numpy(), tickers, selected=selected, top=top, per_ticker=per_ticker)
+            self.task_completed = self.task_total
+
+        self.task_state = 'Done'
+
+    @Threaded.threaded
+    def compute_rolling(self, window: int = 60, step: int = 5, tickers: list[str] = []) -> None:
+        # Mean pairwise correlation of the tickers (all by default) over rolling windows of returns. Needs compute()
+        self.rolling = pd.DataFrame()
+
+        if not self.returns.empty:
+            returns = self.returns[[ticker for ticker in tickers if ticker in self.returns]] if tickers else self.returns
+
+            self.task_total = returns.shape[1]
+            self.task_state = 'Correlating'
+
+            if returns.shape[1] > 1:
+                mean, pairs = rolling_correlation(returns.to_numpy(), window, step=step)
+                ends = np.arange(window - 1, len(returns), step)
+                self.rolling = pd.DataFrame({'date': returns.index[ends], 'correlation': mean, 'pairs': pairs})
+
+            self.task_completed = self.task_total
+            self.task_object = self.rolling
+        else:
+            _logger.warning(f'{__name__}: Must first compute correlation')
+
+        self.task_state = 'Done'
+
+    @Threaded.threaded
+    def compute_clusters(self, clusters: int = 10, use_cache: bool = True) -> None:
+        # Hierarchical clusters of the correlation matrix, cached with the correlation results they come from
+        self.clusters = pd.DataFrame()
+
+        if not self.results.empty:
+            key = cache.build_key(correlation=self.cache_key, clusters=clusters)
+            table = None
+            if use_cache:
+                table, _ = cache.load(self.name, CACHE_TYPE_CLUSTERS, today_only=self.cache_today_only, params=key)
+
+            if isinstance(table, pd.DataFrame):
+                self.clusters = table
+            else:
+                self.task_state = 'Clustering'
+                ids, order = cluster(self.results.to_numpy(), clusters)
+                self.clusters = pd.DataFrame({'ticker': self.results.columns[order], 'cluster': ids[order]})
+                cache.dump(self.clusters, self.name, CACHE_TYPE_CLUSTERS, params=key)
+
+            self.task_object = self.clusters
+        else:
+            _logger.warning(f'{__name__}: Must first compute correlation')
 
         self.task_state = 'Done'
 
+    def _running_key(self) -> str:
+        return cache.build_key(window=self.window)
+
+    def _load_running(self) -> 'RunningCorrelation | None':
+        running, _ = cache.load(self.name, CACHE_TYPE_RUNNING, today_only=False, params=self._running_key())
+        return running if isinstance(running, RunningCorrelation) and len(running.dates) > 0 else None
+
+    def _update_running(self, running: 'RunningCorrelation') -> int:
+        days = (dt.date.today() - pd.Timestamp(running.dates[-1]).date()).days + 7
+        panel = store.get_history_panel(running.tickers, days)
+        added = running.push(log_returns(panel.close, panel.valid), panel.dates[1:])
+        if added > 0:
+            cache.dump(running, self.name, CACHE_TYPE_RUNNING, params=self._running_key(), replace=True)
+
+        return added
+
     def get_ticker_correlation(self, ticker: str) -> pd.DataFrame:
         ticker = ticker.upper()
         df = pd.DataFrame()
@@ -127,6 +223,315 @@ class Correlate(Threaded):
         return df
 
 
+# Correlation over a rolling window of returns, kept as the pairwise sums (count, x, x squared and
+# cross products over the dates both tickers have returns). Each new day updates the sums with outer
+# products, and the day leaving the window is subtracted the same way, so an update is O(n^2)
+# rather than O(n^2 x window). Returns are kept as float32, and the sums are rebuilt from them once
+# the whole window has been replaced, so rounding doesn't build up over the add/subtract cycles
+class RunningCorrelation:
+    def __init__(self, tickers: list[str], window: int):
+        if window < 2:
+            raise ValueError('Invalid window')
+
+        count = len(tickers)
+        self.tickers = list(tickers)
+        self.window = window
+        self.dates: list = []
+        self.returns = np.empty((0, count), dtype=np.float32)  # The returns in the window, to subtract when they leave it
+        self.pushed = 0  # Days added since the sums were rebuilt
+        self.n = np.zeros((count, count))
+        self.sx = np.zeros((count, count))
+        self.sxx = np.zeros((count, count))
+        self.sxy = np.zeros((count, count))
+
+    def __repr__(self):
+        return f'<RunningCorrelation ({len(self.tickers)} tickers, {len(self.dates)}/{self.window} days)>'
+
+    def __getstate__(self) -> dict:
+        # Saved as float32, with the symmetric sums (count and cross products) as upper triangles
+        upper = np.triu_indices(len(self.tickers))
+        return {
+            'tickers': self.tickers,
+            'window': self.window,
+            'dates': self.dates,
+            'returns': self.returns,
+            'pushed': self.pushed,
+            'n': self.n[upper].astype(np.min_scalar_type(self.window)),
+            'sx': self.sx.astype(np.float32),
+            'sxx': self.sxx.astype(np.float32),
+            'sxy': self.sxy[upper].astype(np.float32),
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        count = len(state['tickers'])
+        upper = np.triu_indices(count)
+
+        def symmetric(values: np.ndarray) -> np.ndarray:
+            matrix = np.zeros((count, count))
+            matrix[upper] = values
+            return matrix + np.triu(matrix, k=1).T
+
+        self.tickers = state['tickers']
+        self.window = state['window']
+        self.dates = state['dates']
+        self.returns = state['returns']
+        self.pushed = state['pushed']
+        self.n = symmetric(state['n'])
+        self.sx = state['sx'].astype(float)
+        self.sxx = state['sxx'].astype(float)
+        self.sxy = symmetric(state['sxy'])
+
+    def push(self, returns: np.ndarray, dates: np.ndarray) -> int:
+        # Add the rows (dates x tickers, NaN for no return) dated after the last date, dropping the oldest
+        # beyond the window. Returns the number of days added
+        if returns.shape[1:] != (len(self.tickers),):
+            raise ValueError('Returns do not match tickers')
+
+        if self.dates:
+            newer = np.asarray(pd.to_datetime(dates) > pd.Timestamp(self.dates[-1]))
+            returns, dates = returns[newer], np.asarray(dates)[newer]
+
+        # A large batch (e.g. the first one) only needs its last 'window' rows
+        returns, dates = returns[-self.window:].astype(np.float32), list(dates[-self.window:])
+        leaving = max(len(self.dates) + len(dates) - self.window, 0)
+
+        left = self.returns[:leaving]
+        self.returns = np.concatenate([self.returns[leaving:], returns])
+        self.dates = self.dates[leaving:] + dates
+        self.pushed += len(dates)
+
+        if self.pushed >= self.window:
+            for sums in (self.n, self.sx, self.sxx, self.sxy):
+                sums.fill(0.0)
+
+            self._add(self.returns, 1.0)
+            self.pushed = 0
+        else:
+            self._add(left, -1.0)
+            self._add(returns, 1.0)
+
+        return len(dates)
+
+    def matrix(self, columns: np.ndarray | None = None, min_periods: int = CORRELATION_MIN_PERIODS) -> np.ndarray:
+        # Correlation matrix of all the tickers, or of those in 'columns'
+        select = np.ix_(columns, columns) if columns is not None else np.s_[:, :]
+        n, sx, sxx, sxy = self.n[select], self.sx[select], self.sxx[select], self.sxy[select]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sy = sx.T
+            syy = sxx.T
+            cov = sxy - sx * sy / n
+            var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+            corr = np.clip(cov / np.sqrt(var), -1.0, 1.0)
+
+        corr[(n < min_periods) | ~np.isfinite(corr)] = np.nan
+
+        return corr
+
+    def _add(self, returns: np.ndarray, sign: float) -> None:
+        # Sums over several rows at once are the same outer products, done as matrix products
+        if len(returns) == 0:
+            return
+
+        m = (~np.isnan(returns)).astype(float)
+        x = np.where(m > 0.0, returns, 0.0).astype(float)
+
+        self.n += sign * (m.T @ m)
+        self.sx += sign * (x.T @ m)
+        self.sxx += sign * ((x * x).T @ m)
+        self.sxy += sign * (x.T @ x)
+
+
+def log_returns(close: np.ndarray, valid: np.ndarray | None = None) -> np.ndarray:
+    # Date x ticker log returns, one row shorter than the prices. Returns into or out of a
+    # date without an actual bar (forward filled prices) are NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.log(close[1:] / close[:-1])
+
+    if valid is not None:
+        returns[~(valid[1:] & valid[:-1])] = np.nan
+
+    returns[~np.isfinite(returns)] = np.nan
+
+    return returns
+
+
+def correlate(values: np.ndarray, dtype: type = np.float64, block: int = 0,
+              min_periods: int = CORRELATION_MIN_PERIODS, out: np.ndarray | None = None) -> np.ndarray:
+    # Pearson correlation between the columns of a date x ticker matrix, using for each pair only the dates
+    # where both have values (as DataFrame.corr() does). Without missing values this is one matrix product
+    # of the standardized columns. Otherwise the pairwise sums come from products of the values and the
+    # mask of valid values. A block size computes the result a band of rows at a time, into 'out' if given
+    # (e.g. a np.memmap for universes too large for memory)
+    values = np.asarray(values, dtype=dtype)
+    count = values.shape[1]
+    block = count if block <= 0 else block
+    out = np.empty((count, count), dtype=dtype) if out is None else out
+
+    mask = ~np.isnan(values)
+    complete = bool(mask.all())
+
+    # Center each column first. Correlation doesn't change, and the sums are better conditioned
+    with np.errstate(invalid='ignore'):
+        means = np.where(mask, values, 0.0).sum(axis=0) / np.maximum(mask.sum(axis=0), 1)
+    x = np.where(mask, values - means, 0.0).astype(dtype)
+    m = mask.astype(dtype)
+
+    if complete:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x /= np.sqrt((x * x).sum(axis=0))
+    else:
+        xx = x * x
+
+    for start in range(0, count, block):
+        stop = min(start + block, count)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if complete:
+                corr = x[:, start:stop].T @ x
+                n = np.full(corr.shape, values.shape[0])
+            else:
+                n = m[:, start:stop].T @ m
+                sx = x[:, start:stop].T @ m        # Sum of x over the dates both have values
+                sy = m[:, start:stop].T @ x
+                sxx = xx[:, start:stop].T @ m
+                syy = m[:, start:stop].T @ xx
+                sxy = x[:, start:stop].T @ x
+
+                cov = sxy - sx * sy / n
+                var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+                corr = cov / np.sqrt(var)
+
+        corr = np.clip(corr, -1.0, 1.0)
+        corr[(n < min_periods) | ~np.isfinite(corr)] = np.nan
+        out[start:stop] = corr
+
+    return out
+
+
+def rolling_correlation(values: np.ndarray, window: int, step: int = 1, min_periods: int = CORRELATION_MIN_PERIODS,
+                        cells: int = ROLLING_CELLS) -> tuple[np.ndarray, np.ndarray]:
+    # Mean pairwise-complete correlation between the columns of a date x ticker matrix, and the number of pairs
+    # it's over, for windows of 'window' rows every 'step' rows. The windows are strided views, and their sums
+    # batched matrix products over a chunk of windows at a time, so no more than about 'cells' correlations
+    # (chunk x tickers x tickers) are held at once
+    values = np.asarray(values, dtype=float)
+    if window < 2 or step < 1:
+        raise ValueError('Invalid window')
+    if len(values) < window:
+        return np.empty(0), np.empty(0, dtype=int)
+
+    count = values.shape[1]
+    mask = ~np.isnan(values)
+    m = sliding_window_view(mask.astype(float), window, axis=0)[::step]  # windows x tickers x window
+    x = sliding_window_view(np.where(mask, values, 0.0), window, axis=0)[::step]
+    xx = sliding_window_view(np.where(mask, values * values, 0.0), window, axis=0)[::step]
+
+    chunk = max(cells // max(count * count, 1), 1)
+    mean = np.empty(len(m))
+    pairs = np.empty(len(m), dtype=int)
+    diagonal = np.arange(count)
+
+    for start in range(0, len(m), chunk):
+        mc, xc, xxc = m[start:start+chunk], x[start:start+chunk], xx[start:start+chunk]
+        mt = mc.transpose(0, 2, 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = mc @ mt
+            sx = xc @ mt
+            sxx = xxc @ mt
+            sxy = xc @ xc.transpose(0, 2, 1)
+
+            sy = sx.transpose(0, 2, 1)
+            syy = sxx.transpose(0, 2, 1)
+            cov = sxy - sx * sy / n
+            var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+            corr = np.clip(cov / np.sqrt(var), -1.0, 1.0)
+
+        # Each pair is in the matrix twice, and the diagonal isn't a pair
+        valid = (n >= min_periods) & np.isfinite(corr)
+        valid[:, diagonal, diagonal] = False
+        found = valid.sum(axis=(1, 2)) // 2
+
+        with np.errstate(invalid='ignore'):
+            mean[start:start+chunk] = np.where(valid, corr, 0.0).sum(axis=(1, 2)) / 2.0 / found
+        pairs[start:start+chunk] = found
+
+    return mean, pairs
+
+
+def cluster(matrix: np.ndarray, clusters: int) -> tuple[np.ndarray, np.ndarray]:
+    # Average-linkage clusters on the correlation distance sqrt((1 - corr) / 2). Returns the cluster id of
+    # each ticker and the order of the dendrogram leaves (correlated tickers next to each other)
+    count = len(matrix)
+    if count < 2:
+        return np.ones(count, dtype=int), np.arange(count)
+
+    distances = np.sqrt(np.clip((1.0 - np.nan_to_num(matrix, nan=0.0)) / 2.0, 0.0, 1.0))
+    np.fill_diagonal(distances, 0.0)
+    distances = (distances + distances.T) / 2.0
+
+    linkage = hierarchy.linkage(distance.squareform(distances, checks=False), method='average')
+    ids = hierarchy.fcluster(linkage, t=clusters, criterion='maxclust')
+    order = hierarchy.leaves_list(linkage)
+
+    return ids, order
+
+
+def get_pairs(matrix: np.ndarray, tickers: list[str], cutoff: float | None = CORRELATION_CUTOFF,
+              selected: np.ndarray | None = None, top: int = 0, per_ticker: bool = False) -> pd.DataFrame:
+    # Ticker pairs from a correlation matrix, each pair once (ticker1 < ticker2), highest first. Pairs are
+    # those above the cutoff, restricted to ones including a selected ticker, and limited to the top
+    # pairs overall, or per selected ticker
+    count = len(tickers)
+    values = np.where(np.isnan(matrix), -np.inf, matrix)
+    selected = np.ones(count, dtype=bool) if selected is None else np.asarray(selected, dtype=bool)
+
+    if top > 0 and per_ticker:
+        # Each selected ticker's top correlations, excluding itself
+        rows = np.flatnonzero(selected)
+        values = values[rows]
+        values[np.arange(len(rows)), rows] = -np.inf
+
+        k = min(top, count - 1)
+        if k <= 0 or rows.size == 0:
+            first = second = np.empty(0, dtype=int)
+        else:
+            columns = np.argpartition(-values, k - 1, axis=1)[:, :k]
+            first = np.repeat(rows, k)
+            second = columns.ravel()
+
+        # Same pair from both of its tickers
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        codes = np.unique(first * count + second)
+        first, second = codes // count, codes % count
+    else:
+        # Upper triangle only, so each pair is seen once
+        keep = np.triu(values >= cutoff if cutoff is not None else values > -np.inf, k=1)
+        keep &= selected[:, None] | selected[None, :]
+        first, second = np.nonzero(keep)
+
+    correlation = matrix[first, second]
+    keep = ~np.isnan(correlation)
+    if cutoff is not None:
+        keep &= correlation >= cutoff
+    first, second, correlation = first[keep], second[keep], correlation[keep]
+
+    if top > 0 and not per_ticker and correlation.size > top:
+        best = np.argpartition(-correlation, top - 1)[:top]
+        first, second, correlation = first[best], second[best], correlation[best]
+
+    order = np.argsort(-correlation, kind='stable')
+    names = np.asarray(tickers, dtype=object)
+    ticker1, ticker2 = names[first[order]], names[second[order]]
+    swap = ticker2 < ticker1
+
+    return pd.DataFrame({
+        'ticker1': np.where(swap, ticker2, ticker1),
+        'ticker2': np.where(swap, ticker1, ticker2),
+        'correlation': correlation[order]})
+
+
 if __name__ == '__main__':
     import logging
     import time
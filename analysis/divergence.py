@@ -1,20 +1,18 @@
 import datetime as dt
-import random
-from concurrent import futures
 
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
-from ta import trend
 
+from analysis import technical as technical_
 from analysis.technical import Technical
 from base import Threaded
 from data import store as store
-from utils import cache, logger, ui
+from utils import cache, memo, logger, ui
 
 _logger = logger.get_logger()
 
 CACHE_TYPE = 'div'
+CACHE_MIN_TICKERS = 100  # Smaller lists aren't cached
 
 class Divergence(Threaded):
     def __init__(self, tickers: list[str], name: str, window: int = 15, days: int = 100):
@@ -27,9 +25,9 @@ class Divergence(Threaded):
         self.interval: int = 14
         self.periods: int = days // 50
         self.streak: int = 5
-        self.concurrency: int = 10
         self.scaled: bool = True
         self.cache_name: str = name
+        self.cache_key: str = ''
         self.cache_available: bool = False
         self.cache_used: bool = False
         self.cache_date: str = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
@@ -39,9 +37,7 @@ class Divergence(Threaded):
             if not store.is_ticker(ticker):
                 raise ValueError(f'{__name__}: Not a valid ticker: {ticker}')
 
-        self.cache_available = cache.exists(name, CACHE_TYPE, today_only=self.cache_today_only)
-        if self.cache_available:
-            self.results, self.cache_date = cache.load(name, CACHE_TYPE, today_only=self.cache_today_only)
+        self._load_cache()
 
     @Threaded.threaded
     def calculate(self, use_cache: bool = True, scaled: bool = True) -> None:
@@ -50,36 +46,29 @@ class Divergence(Threaded):
 
         _logger.info(f'{__name__}: Calculating {len(self.tickers)} ticker(s)')
 
+        # Cached results depend on scaling, so look again if it changed
+        if scaled != self.scaled:
+            self.scaled = scaled
+            self._load_cache()
+
         if use_cache and self.cache_available:
             self.cache_used = True
             _logger.info(f'{__name__}: Using cached results. Scaled={scaled}')
         else:
-            self.scaled = scaled
             self.task_total = len(self.tickers)
             self.task_state = 'None'
             self.results = []
 
-            # Break up the tickers and run concurrently if a large list, otherwise just run the single list
-            random.shuffle(self.tickers)
-            if len(self.tickers) > 100:
-                _logger.info(f'{__name__}: Running with thread pool. Scaled={scaled}')
-
-                tickers: list[np.ndarray] = np.array_split(self.tickers, self.concurrency)
-                tickers = [i.tolist() for i in tickers]
+            _logger.info(f'{__name__}: Running as a panel. Scaled={scaled}')
 
-                with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-                    self.task_futures = [executor.submit(self._run, ticker_list) for ticker_list in tickers]
+            # All the tickers at once from one panel, then any missing from it one at a time
+            panel = store.get_history_panel(self.tickers, self.days)
+            missing = [ticker for ticker in self.tickers if ticker.upper() not in panel or not panel.valid[:, panel.index[ticker.upper()]].any()]
+            self._run_panel(panel, [ticker for ticker in self.tickers if ticker not in missing])
+            self._run(missing)
 
-                    for future in futures.as_completed(self.task_futures):
-                        _logger.info(f'{__name__}: Thread completed: {future.result()}')
-
-                if self.results:
-                    cache.dump(self.results, self.cache_name, CACHE_TYPE)
-            else:
-                _logger.info(f'{__name__}: Running without thread pool. Scaled={scaled}')
-
-                use_cache = False
-                self._run(self.tickers)
+            if len(self.tickers) > CACHE_MIN_TICKERS and self.results:
+                cache.dump(self.results, self.cache_name, CACHE_TYPE, params=self.cache_key)
 
         self.task_state = 'Done'
 
@@ -91,110 +80,143 @@ class Divergence(Threaded):
 
         self.streak = streak
         self.analysis = pd.DataFrame()
+        analysis = []
         for result in self.results:
-            idx = result[::-1]['streak'].idxmax()  # Index of most recent largest streak
-            date = result.iloc[idx]['date']
-            max = result.iloc[idx]['streak']
-            if max >= streak:
-                data = [[result.index.name, date, max]]
-                df = pd.DataFrame(data, columns=['ticker', 'date', 'streak'])
-                self.analysis = pd.concat([self.analysis, df], ignore_index=True)
-
-        if len(self.analysis) > 0:
+            streaks = result['streak'].to_numpy()
+            idx = len(streaks) - 1 - int(np.argmax(streaks[::-1]))  # Index of most recent largest streak
+            if streaks[idx] >= streak:
+                analysis.append([result.index.name, result['date'].iloc[idx], streaks[idx]])
+
+        if analysis:
+            self.analysis = pd.DataFrame(analysis, columns=['ticker', 'date', 'streak'])
             self.analysis = self.analysis.reset_index(drop=True)
             self.analysis = self.analysis.sort_values(by=['streak'], ascending=False)
 
+    def _load_cache(self) -> None:
+        self.cache_key = cache.build_key(
+            tickers=set(self.tickers),
+            window=self.window,
+            days=self.days,
+            type=self.type,
+            interval=self.interval,
+            periods=self.periods,
+            scaled=self.scaled,
+            revision=store.get_database_revision())
+
+        results, self.cache_date = cache.load(self.cache_name, CACHE_TYPE, today_only=self.cache_today_only, params=self.cache_key)
+        self.cache_available = results is not None
+        self.results = results if self.cache_available else []
+
     def _run(self, tickers: list[str]) -> None:
         for ticker in tickers:
-            ta = Technical(ticker, None, self.days)
-            history = ta.history
-            result = pd.DataFrame()
-
-            # Use scaled & normalized values for comparison
-            scaler = MinMaxScaler(feature_range=(0, 1))
-
-            # Base data
-            dates = history['date'][self.interval:].reset_index(drop=True)
-            price = history['close'][self.interval:].reset_index(drop=True)
-
-            if not history.empty and not price.empty:
-                self.task_ticker = ticker
-
-                # Calculate 0-1 scaled series of day-to-day rsi differences
-                price.name = 'price'
-                price_sma = trend.sma_indicator(price, window=self.window, fillna=True).reset_index(drop=True)
-                price_sma.name = 'price_sma'
-                price_sma_diff = price_sma.diff(periods=self.periods).fillna(0.0)
-                price_sma_diff.name = 'price_sma_diff'
-                scaled = scaler.fit_transform(price_sma.values.reshape(-1, 1))
-                scaled = [value[0] for value in scaled]
-                price_sma_scaled = pd.Series(scaled, name='price_sma_scaled')
-                price_sma_scaled_diff = price_sma_scaled.diff(periods=self.periods).fillna(0.0)
-                price_sma_scaled_diff.name = 'price_sma_scaled_diff'
-
-                # Calculate 0-1 scaled series of day-to-day rsi differences
-                technical = ta.calc_rsi(self.interval)[self.interval:]
-                technical_sma = trend.sma_indicator(technical, window=self.window, fillna=True).reset_index(drop=True)
-                technical_sma.name = f'{self.type}_sma'
-                technical_sma_diff = technical_sma.diff(periods=self.periods).fillna(0.0)
-                technical_sma_diff.name = f'{self.type}_sma_diff'
-                scaled = scaler.fit_transform(technical_sma.values.reshape(-1, 1))
-                scaled = [value[0] for value in scaled]
-                technical_sma_scaled = pd.Series(scaled, name=f'{self.type}_sma_scaled')
-                technical_sma_scaled_diff = technical_sma_scaled.diff(periods=self.periods).fillna(0.0)
-                technical_sma_scaled_diff.name = f'{self.type}_sma_scaled_diff'
-
-                # Calculate differences in the slopes between prices and RSI's
-                if self.scaled:
-                    divergence = technical_sma_scaled_diff - price_sma_scaled_diff
-                else:
-                    divergence = technical_sma_diff - price_sma_diff
-                divergence.name = 'diff'
-
-                # Calculate differences in the slopes between prices and RSI's for opposite slopes only
-                div = []
-                for i in range(len(price_sma_scaled_diff)):
-                    p = price_sma_scaled_diff[i] if self.scaled else price_sma_diff[i]
-                    t = technical_sma_scaled_diff[i] if self.scaled else technical_sma_diff[i]
-                    div += [t - p if p * t < 0.0 else np.NaN]
-                divergence_only = pd.Series(div, name='div')
-
-                # Begin overall result dataframe with the dates
-                result = dates
-
-                # Price data
-                result = pd.concat([result, price], axis=1)
-                result = pd.concat([result, price_sma], axis=1)
-                result = pd.concat([result, price_sma_diff], axis=1)
-                result = pd.concat([result, price_sma_scaled], axis=1)
-                result = pd.concat([result, price_sma_scaled_diff], axis=1)
-
-                # Technical data
-                tech = technical.reset_index(drop=True)
-                result = pd.concat([result, tech], axis=1)
-                result = pd.concat([result, technical_sma], axis=1)
-                result = pd.concat([result, technical_sma_diff], axis=1)
-                result = pd.concat([result, technical_sma_scaled], axis=1)
-                result = pd.concat([result, technical_sma_scaled_diff], axis=1)
-                result = pd.concat([result, divergence], axis=1)
-                result = pd.concat([result, divergence_only], axis=1)
-
-                # Streak data
-                analysis = result.loc[:, ('date', 'div')]
-                analysis['tmp1'] = analysis['div'].notna() == True
-                analysis['tmp2'] = analysis['tmp1'].ne(analysis['tmp1'].shift())
-                analysis['tmp3'] = analysis['tmp2'].cumsum()
-                analysis['tmp4'] = analysis.groupby('tmp3').cumcount() + 1
-                analysis['streak'] = np.where(analysis['tmp1'] == True, analysis['tmp4'], 0)
-                result = pd.concat([result, analysis['streak']], axis=1)
-
-                result.index.name = f'{ticker.upper()}'
-
-                if not result.empty:
-                    self.results.append(result)
+            self.task_ticker = ticker
+            history = Technical(ticker, None, self.days).history
+            if not history.empty:
+                close = history['close'].to_numpy(dtype=float).reshape(-1, 1)
+                self._add_results([ticker], [history['date'].to_numpy()], close, np.array([len(history)]),
+                                  [memo.build_history_span(ticker, history)])
 
             self.task_completed += 1
 
+    def _run_panel(self, panel, tickers: list[str]) -> None:
+        if not tickers:
+            return
+
+        # Each ticker's actual bars at the top of its column (trailing NaN), so every column
+        # starts at its first bar exactly as its own history would
+        columns = np.array([panel.index[ticker.upper()] for ticker in tickers])
+        valid = panel.valid[:, columns]
+        lengths = valid.sum(axis=0)
+        close = panel.compact(columns, end=False)['close']
+        dates = [panel.dates[valid[:, n]] for n in range(len(tickers))]
+
+        self._add_results(tickers, dates, close, lengths, memo.build_spans(panel, tickers))
+        self.task_completed += len(tickers)
+
+    def _add_results(self, tickers: list[str], dates: list[np.ndarray], close: np.ndarray, lengths: np.ndarray,
+                     spans: list[str | None] | None = None) -> None:
+        values = calculate(close, self.window, self.interval, self.periods, self.scaled, spans)
+        columns = ['price', 'price_sma', 'price_sma_diff', 'price_sma_scaled', 'price_sma_scaled_diff',
+                   self.type, f'{self.type}_sma', f'{self.type}_sma_diff', f'{self.type}_sma_scaled', f'{self.type}_sma_scaled_diff',
+                   'diff', 'div', 'streak']
+
+        for n, ticker in enumerate(tickers):
+            length = lengths[n] - self.interval
+            if length > 0:
+                result = pd.DataFrame(values[:length, n], columns=columns)
+                result.insert(0, 'date', dates[n][self.interval:])
+                result['streak'] = result['streak'].astype(int)
+                result.index.name = f'{ticker.upper()}'
+                self.results.append(result)
+
+
+def calculate(close: np.ndarray, window: int, interval: int, periods: int, scaled: bool = True,
+              spans: list[str | None] | None = None) -> np.ndarray:
+    # Divergence columns for date x ticker closes, each column starting at its first bar (NaN after its last).
+    # Returns dates (less the first 'interval') x tickers x 13 columns in the order of the results. With the span
+    # of each ticker's bars (see memo.build_spans()), the RSI is memoized per ticker and shared with the screener
+    count = max(len(close) - interval, 0)
+    results = np.full((count, close.shape[1], 13), np.nan)
+    if count == 0:
+        return results
+
+    valid = ~np.isnan(close[interval:])
+
+    # Price and its SMA
+    price = close[interval:]
+    price_sma = technical_.rolling_mean(price, [window])[window]
+
+    # RSI over the whole history, then without the first 'interval' values
+    if spans is None:
+        rsi = technical_.rsi(close, interval)
+    else:
+        lengths = (~np.isnan(close)).sum(axis=0)
+        rsi = memo.get_columns(spans, lengths, 'rsi', lambda columns: technical_.rsi(close[:, columns], interval),
+                               len(close), end=False, interval=interval)
+    rsi = rsi[interval:]
+    rsi_sma = technical_.rolling_mean(rsi, [window])[window]
+
+    results[:, :, 0] = price
+    results[:, :, 5] = rsi
+    for offset, sma in ((1, price_sma), (6, rsi_sma)):
+        results[:, :, offset] = sma
+        results[:, :, offset + 1] = _diff(sma, periods, valid)
+        results[:, :, offset + 2] = _scale(sma)
+        results[:, :, offset + 3] = _diff(results[:, :, offset + 2], periods, valid)
+
+    # Differences in the slopes of price and RSI, and the same for opposite slopes only
+    p = results[:, :, 4] if scaled else results[:, :, 2]
+    t = results[:, :, 9] if scaled else results[:, :, 7]
+    results[:, :, 10] = t - p
+    results[:, :, 11] = np.where(p * t < 0.0, t - p, np.nan)
+
+    # Length of the current run of divergent days
+    divergent = ~np.isnan(results[:, :, 11])
+    runs = np.cumsum(divergent, axis=0)
+    results[:, :, 12] = np.where(valid, runs - np.maximum.accumulate(np.where(divergent, 0, runs), axis=0), np.nan)
+
+    return results
+
+
+def _diff(values: np.ndarray, periods: int, valid: np.ndarray) -> np.ndarray:
+    # As Series.diff(periods).fillna(0.0) within each column's values
+    diff = np.zeros_like(values)
+    if periods > 0 and len(values) > periods:
+        diff[periods:] = values[periods:] - values[:-periods]
+
+    return np.where(valid, np.nan_to_num(diff), np.nan)
+
+
+def _scale(values: np.ndarray) -> np.ndarray:
+    # Each column scaled to 0-1 (all 0 if constant), as MinMaxScaler does
+    valid = ~np.isnan(values)
+    low = np.where(valid, values, np.inf).min(axis=0)
+    high = np.where(valid, values, -np.inf).max(axis=0)
+    span = high - low
+    span = np.where(np.isfinite(span) & (span > 0.0), span, 1.0)
+
+    return (values - low) / span
+
 
 if __name__ == '__main__':
     import logging
@@ -1,12 +1,11 @@
 import datetime as dt
-import random
-from concurrent import futures
 
 import numpy as np
 import pandas as pd
 
 from base import Threaded
 from data import store as store
+from data.panel import Panel
 from utils import cache, logger, ui
 
 _logger = logger.get_logger()
@@ -16,7 +15,13 @@ CACHE_TYPE = 'gap'
 THRESHOLD = 0.01
 MINPRICE = 1.0
 MINVOLUME = 500e3
-MINCONCURRENECY = 100
+MINCACHE = 100  # Smaller lists aren't cached
+
+FILL_WINDOW = 8        # Bars searched for fills in the first pass. Doubled on each pass after
+FILL_WINDOW_MAX = 512
+FILL_HORIZONS = (1, 5, 20, 60)  # Bars
+SIZE_BUCKETS = (0.0, 0.02, 0.03, 0.05, 0.10, np.inf)
+GROUPS = ('ticker', 'sector', 'size', 'direction')
 
 
 class Gap(Threaded):
@@ -26,8 +31,8 @@ class Gap(Threaded):
         self.threshold: float = threshold
         self.results: list[pd.DataFrame]
         self.analysis: pd.DataFrame = pd.DataFrame()
-        self.concurrency: int = 10
         self.cache_name: str = name
+        self.cache_key: str = ''
         self.cache_available: bool = False
         self.cache_used: bool = False
         self.cache_date: str = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
@@ -37,13 +42,11 @@ class Gap(Threaded):
             if not store.is_ticker(ticker):
                 raise ValueError(f'{__name__}: Not a valid ticker: {ticker}')
 
-        self.cache_available = cache.exists(name, CACHE_TYPE, today_only=self.cache_today_only)
+        self.cache_key = cache.build_key(tickers=set(tickers), days=days, threshold=threshold, revision=store.get_database_revision())
+        results, self.cache_date = cache.load(name, CACHE_TYPE, today_only=self.cache_today_only, params=self.cache_key)
+        self.cache_available = results is not None
         if self.cache_available:
-            self.results, self.cache_date = cache.load(name, CACHE_TYPE, today_only=self.cache_today_only)
-            if self.results[0].attrs['days'] != days:
-                self.results = []
-                self.cache_available = False
-                _logger.info(f'{__name__}: Cached results not used. Different days value')
+            self.results = results
 
     @Threaded.threaded
     def calculate(self, use_cache: bool = True) -> None:
@@ -62,27 +65,14 @@ class Gap(Threaded):
             self.results = []
             self.analysis = pd.DataFrame()
 
-            # Break up the tickers and run concurrently if a large list, otherwise just run the single list
-            if len(self.tickers) > MINCONCURRENECY:
-                _logger.info(f'{__name__}: Running with thread pool')
-
-                random.shuffle(self.tickers)
-                tickers: list[np.ndarray] = np.array_split(self.tickers, self.concurrency)
-                tickers = [i.tolist() for i in tickers]
-
-                with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-                    self.task_futures = [executor.submit(self._run, ticker_list) for ticker_list in tickers]
-
-                    for future in futures.as_completed(self.task_futures):
-                        _logger.info(f'{__name__}: Thread completed: {future.result()}')
+            # All the tickers at once from one panel, then any missing from it one at a time
+            panel = store.get_history_panel(self.tickers, days=self.days)
+            missing = [ticker for ticker in self.tickers if ticker.upper() not in panel or not panel.valid[:, panel.index[ticker.upper()]].any()]
+            self._run_panel(panel, [ticker for ticker in self.tickers if ticker not in missing])
+            self._run(missing)
 
-                if self.results:
-                    cache.dump(self.results, self.cache_name, CACHE_TYPE)
-            else:
-                _logger.info(f'{__name__}: Running without thread pool')
-
-                use_cache = False
-                self._run(self.tickers)
+            if len(self.tickers) > MINCACHE and self.results:
+                cache.dump(self.results, self.cache_name, CACHE_TYPE, params=self.cache_key)
 
         self.task_state = 'Done'
 
@@ -135,51 +125,217 @@ class Gap(Threaded):
         for ticker in tickers:
             self.task_ticker = ticker
             history = store.get_history(ticker, days=self.days)
+            if not history.empty:
+                results = find_gaps(history, self.threshold)
+                self._add_result(ticker, results, history['date'].iloc[-1])
 
-            history['up'] = history['low'] - history['high'].shift(1)
-            history['dn'] = history['low'].shift(1) - history['high']
-
-            # Find relevant gap-ups
-            up = history[history['up'] > (history['close'] * self.threshold)].copy()
-            for result in up.itertuples():
-                df = history.loc[history['date'] >= result.date]
-                high = history.iloc[result.Index-1]['high']
-                low = history.iloc[result.Index]['low']
-                min_low = df['low'].min()
-                up.loc[result.Index, 'index'] = result.Index
-                up.loc[result.Index, 'start'] = high
-                up.loc[result.Index, 'gap'] = low - high
-                if min_low > high:
-                    up.loc[result.Index, 'unfilled'] = min_low - high
-                else:
-                    up.loc[result.Index, 'unfilled'] = 0.0
-
-            # Find relevant gap-downs
-            dn = history[history['dn'] > (history['close'] * self.threshold)].copy()
-            for result in dn.itertuples():
-                df = history.loc[history['date'] >= result.date]
-                low = history.iloc[result.Index-1]['low']
-                high = history.iloc[result.Index]['high']
-                max_high = df['high'].max()
-                dn.loc[result.Index, 'index'] = result.Index
-                dn.loc[result.Index, 'start'] = low
-                dn.loc[result.Index, 'gap'] = high - low
-                if low > max_high:
-                    dn.loc[result.Index, 'unfilled'] = low - max_high
-                else:
-                    dn.loc[result.Index, 'unfilled'] = 0.0
-
-            # Combine the results and do some housekeeping
-            results = pd.concat([up, dn]).sort_index().reset_index(drop=True)
-            if not results.empty:
-                results = results.drop(['open', 'high', 'low'], axis=1)
-                results = results.drop(['up', 'dn'], axis=1)
-                results.index.name = ticker.upper()
-                results.attrs = {'days': self.days, 'threshold': self.threshold, 'last': history.iloc[-1]['date']}
-                self.results.append(results)
+            self.task_completed += 1
 
+    def _run_panel(self, panel: Panel, tickers: list[str]) -> None:
+        for ticker, results in find_gaps_panel(panel, tickers, self.threshold).items():
+            self.task_ticker = ticker
+            self._add_result(ticker, results, panel.dates[panel.valid[:, panel.index[ticker.upper()]]][-1])
             self.task_completed += 1
 
+    def _add_result(self, ticker: str, results: pd.DataFrame, last: object) -> None:
+        if not results.empty:
+            results.index.name = ticker.upper()
+            results.attrs = {'days': self.days, 'threshold': self.threshold, 'last': last}
+            self.results.append(results)
+
+
+def find_gaps(history: pd.DataFrame, threshold: float = THRESHOLD) -> pd.DataFrame:
+    # Gaps in one ticker's history (in date order), with how much of each is still unfilled. Returns a row for
+    # each gap with its date, close and volume, its index in the history, the price it gapped from,
+    # the gap (negative for gap-downs) and the part not since filled
+    high = history['high'].to_numpy(dtype=float)
+    low = history['low'].to_numpy(dtype=float)
+    close = history['close'].to_numpy(dtype=float)
+    valid = np.ones(len(history), dtype=bool)
+
+    rows, _, start, gap, unfilled = _find_gaps(high[:, None], low[:, None], close[:, None], valid[:, None], threshold)
+
+    results = history.iloc[rows][['date', 'close', 'volume']].reset_index(drop=True)
+    results['index'] = rows.astype(float)
+    results['start'] = start
+    results['gap'] = gap
+    results['unfilled'] = unfilled
+
+    return results
+
+
+def find_gaps_panel(panel: Panel, tickers: list[str], threshold: float = THRESHOLD) -> dict[str, pd.DataFrame]:
+    # Same as find_gaps() for each ticker, in one pass over the panel. Tickers without gaps are left out
+    columns = np.array([panel.index[ticker.upper()] for ticker in tickers], dtype=int)
+    valid = panel.valid[:, columns]
+
+    rows, cols, start, gap, unfilled = _find_gaps(panel.high[:, columns], panel.low[:, columns], panel.close[:, columns], valid, threshold)
+
+    # Each gap's index in its ticker's own history
+    index = (np.cumsum(valid, axis=0) - 1)[rows, cols]
+
+    # Ticker by ticker, gaps in date order
+    order = np.lexsort((rows, cols))
+    rows, cols, index, start, gap, unfilled = rows[order], cols[order], index[order], start[order], gap[order], unfilled[order]
+    bounds = np.searchsorted(cols, np.arange(len(tickers) + 1))
+
+    results = {}
+    for n, ticker in enumerate(tickers):
+        first, last = bounds[n], bounds[n+1]
+        if last > first:
+            column = columns[n]
+            results[ticker] = pd.DataFrame({
+                'date': panel.dates[rows[first:last]],
+                'close': panel.close[rows[first:last], column],
+                'volume': panel.volume[rows[first:last], column],
+                'index': index[first:last].astype(float),
+                'start': start[first:last],
+                'gap': gap[first:last],
+                'unfilled': unfilled[first:last]})
+
+    return results
+
+
+def find_fills(panel: Panel, gaps: pd.DataFrame, first: dict[str, int] | None = None) -> pd.DataFrame:
+    # When each gap (ticker, date, start and gap columns) was first traded back through, from the panel's bars
+    # after it. Bars are numbered through each ticker's history, from 'first' for its first bar in the panel
+    # (0 if the panel starts with its history). Gaps with an 'after' date were searched to then before, so only
+    # the bars after it are searched, and gaps from before the panel need their 'bar' number. Adds the gap's
+    # bar, the fill date and the number of bars it took. Gaps not filled, or not in the panel, have neither
+    first = {} if first is None else first
+    gaps = gaps.reset_index(drop=True)
+    dates = pd.DatetimeIndex(pd.to_datetime(panel.dates))
+    cols = gaps['ticker'].str.upper().map(panel.index).fillna(-1).to_numpy(dtype=int)
+    rows = dates.get_indexer(pd.to_datetime(gaps['date']))
+
+    # Bars, not calendar days, so count only the ticker's actual bars
+    offset = np.array([first.get(ticker, 0) for ticker in gaps['ticker']], dtype=int)
+    bars = np.cumsum(panel.valid, axis=0) - 1
+    bar = gaps['bar'].to_numpy(dtype=float, copy=True) if 'bar' in gaps else np.full(len(gaps), np.nan)
+    inside = (rows >= 0) & (cols >= 0)
+    bar[inside] = bars[rows[inside], cols[inside]] + offset[inside]
+
+    # The search starts after the last bar searched before (-1 if that's before the panel)
+    searched = np.zeros(len(gaps), dtype=bool)
+    if 'after' in gaps:
+        searched = gaps['after'].notna().to_numpy()
+        rows[searched] = dates.searchsorted(pd.to_datetime(gaps['after'][searched]), side='right') - 1
+    found = ((rows >= 0) | searched) & (cols >= 0) & ~np.isnan(bar)
+
+    fills = np.full(len(gaps), -1)
+    fills[found] = _find_fills(panel.high, panel.low, rows[found], cols[found],
+                               gaps['start'].to_numpy(dtype=float)[found], gaps['gap'].to_numpy(dtype=float)[found] > 0.0)
+    filled = fills >= 0
+
+    fill_bars = np.full(len(gaps), np.nan)
+    fill_bars[filled] = bars[fills[filled], cols[filled]] + offset[filled] - bar[filled]
+
+    fill_date = np.full(len(gaps), None, dtype=object)
+    fill_date[filled] = dates.date[fills[filled]]
+
+    gaps['bar'] = bar
+    gaps['fill_date'] = fill_date
+    gaps['fill_bars'] = fill_bars
+
+    return gaps
+
+
+def fill_statistics(gaps: pd.DataFrame, by: tuple[str, ...] = ('size',), buckets: tuple[float, ...] = SIZE_BUCKETS,
+                    horizons: tuple[int, ...] = FILL_HORIZONS) -> pd.DataFrame:
+    # Fill probabilities by group from the gap index (see store.get_gaps()): overall and within each horizon, plus
+    # the median bars to fill. Open gaps younger than a horizon are left out of that horizon, as they may yet fill
+    if not by or not set(by) <= set(GROUPS):
+        raise ValueError(f'Invalid grouping. Must be one or more of {GROUPS}')
+
+    if gaps.empty:
+        return pd.DataFrame()
+
+    labels = [f'>{low*100:.0f}%' if np.isinf(high) else f'{low*100:.0f}-{high*100:.0f}%' for low, high in zip(buckets[:-1], buckets[1:])]
+    filled = gaps['fill_bars'].notna().to_numpy()
+
+    # The bars each open gap has had to fill, from its bar to the last bar scanned
+    elapsed = np.where(filled, gaps['fill_bars'], np.maximum(gaps['scanned_bars'] - 1 - gaps['bar'], 0.0))
+
+    frame = pd.DataFrame({
+        'ticker': gaps['ticker'],
+        'sector': gaps['sector'].fillna(''),
+        'size': pd.cut(gaps['relative'], list(buckets), labels=labels, right=False),
+        'direction': np.where(gaps['gap'] > 0.0, 'up', 'down'),
+        'count': 1,
+        'filled': filled.astype(float),
+        'bars': gaps['fill_bars']})
+
+    for horizon in horizons:
+        frame[f'hit_{horizon}'] = filled & (elapsed <= horizon)
+        frame[f'eligible_{horizon}'] = frame[f'hit_{horizon}'] | (elapsed >= horizon)
+
+    grouped = frame.groupby(list(by), observed=True)
+    statistics = grouped[['count']].sum()
+    statistics['filled'] = grouped['filled'].mean()
+    for horizon in horizons:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistics[f'fill_{horizon}'] = grouped[f'hit_{horizon}'].sum() / grouped[f'eligible_{horizon}'].sum()
+    statistics['bars_median'] = grouped['bars'].median()
+
+    return statistics.reset_index()
+
+
+def _find_fills(high: np.ndarray, low: np.ndarray, rows: np.ndarray, cols: np.ndarray, start: np.ndarray, up: np.ndarray) -> np.ndarray:
+    # Row of the first bar after each gap to trade back through its start, or -1. All the gaps are searched at
+    # once over a window of the following bars that grows on each pass, so the many that fill quickly cost little
+    fills = np.full(len(rows), -1)
+    pending = np.arange(len(rows))
+    offset, window = 1, FILL_WINDOW
+
+    while pending.size > 0:
+        first = rows[pending] + offset
+        pending, first = pending[first < len(high)], first[first < len(high)]
+        if pending.size == 0:
+            break
+
+        index = first[:, None] + np.arange(window)
+        inside = index < len(high)
+        index = np.minimum(index, len(high) - 1)
+        column = cols[pending][:, None]
+        level = start[pending][:, None]
+
+        with np.errstate(invalid='ignore'):
+            touched = inside & np.where(up[pending][:, None], low[index, column] <= level, high[index, column] >= level)
+
+        hit = touched.any(axis=1)
+        fills[pending[hit]] = index[hit, touched[hit].argmax(axis=1)]
+        pending = pending[~hit]
+
+        offset += window
+        window = min(window * 2, FILL_WINDOW_MAX)
+
+    return fills
+
+
+def _find_gaps(high: np.ndarray, low: np.ndarray, close: np.ndarray, valid: np.ndarray, threshold: float) -> tuple:
+    # Date x ticker arrays, forward filled between actual bars (valid), so the previous row always holds the
+    # previous bar. Whether a gap has been filled comes from the lowest low (or highest high) from its bar
+    # on, which is a reverse cumulative min (max) computed once rather than rescanning for each gap
+    previous_high = np.vstack([np.full((1, high.shape[1]), np.nan), high[:-1]])
+    previous_low = np.vstack([np.full((1, low.shape[1]), np.nan), low[:-1]])
+
+    with np.errstate(invalid='ignore'):
+        up = valid & ((low - previous_high) > (close * threshold))
+        down = valid & ((previous_low - high) > (close * threshold))
+
+    lowest = np.fmin.accumulate(low[::-1], axis=0)[::-1]
+    highest = np.fmax.accumulate(high[::-1], axis=0)[::-1]
+
+    rows, cols = np.nonzero(up | down)
+    is_up = up[rows, cols]
+
+    start = np.where(is_up, previous_high[rows, cols], previous_low[rows, cols])
+    gap = np.where(is_up, low[rows, cols], high[rows, cols]) - start
+    unfilled = np.where(is_up, lowest[rows, cols] - start, start - highest[rows, cols])
+    unfilled = np.maximum(unfilled, 0.0)
+
+    return rows, cols, start, gap, unfilled
+
 
 if __name__ == '__main__':
     import logging
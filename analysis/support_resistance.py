@@ -3,8 +3,11 @@ trendln: https://github.com/GregoryMorse/trendln
          https://towardsdatascience.com/programmatic-identification-of-support-resistance-trend-lines-with-python-d797a4a90530,
 '''
 
+import os
 import math
-from dataclasses import dataclass, field
+import multiprocessing
+from concurrent import futures
+from dataclasses import dataclass
 
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -12,14 +15,21 @@ import numpy as np
 import trendln
 
 from base import Threaded
+from analysis import trendline as trendline
 from data import store as store
 from utils import math as m
-from utils import ui, logger
+from utils import cache, ui, logger
 
 
 _logger = logger.get_logger()
 _rounding = 0.075
 
+CACHE_TYPE = 'srl'
+
+PROCESSES = os.cpu_count() or 1
+PROCESS_MIN_JOBS = 4  # Fewer extractions are run in-process
+PROCESS_CONTEXT = 'spawn'  # Workers don't inherit the parent's threads or database connections
+
 METHOD = {
     'NCUBED': trendln.METHOD_NCUBED,
     'NSQUREDLOGN': trendln.METHOD_NSQUREDLOGN,
@@ -28,6 +38,8 @@ METHOD = {
     'PROBHOUGH': trendln.METHOD_PROBHOUGH
 }
 
+NATIVE = 'NATIVE'  # Native extractor (see trendline.py). Finds its own pivots, so doesn't use an extmethod
+
 EXTMETHOD = {
     'NAIVE': trendln.METHOD_NAIVE,
     'NAIVECONSEC': trendln.METHOD_NAIVECONSEC,
@@ -35,69 +47,28 @@ EXTMETHOD = {
 }
 
 MAX_SCALE = 10.0
-ACCURACY = 4
-
-
-@dataclass
-class _Score:
-    fit: float = 0.0
-    width: float = 0.0
-    proximity: float = 0.0
-    points: float = 0.0
-    age: float = 0.0
-    slope: float = 0.0
-    basis: bool = True
-
-    def calculate(self) -> float:
-        score = (
-            (self.fit * 0.05) +
-            (self.width * 0.15) +
-            (self.proximity * 0.05) +
-            (self.points * 0.20) +
-            (self.age * 0.20) +
-            (self.slope * 0.30))
-
-        if self.basis:
-            score += 0.05
-
-        return score
-
-
-@dataclass
-class _Line:
-    support: bool = False
-    points: list[float] = field(default_factory=list)
-    end_point: float = 0.0
-    slope: float = 0.0
-    intercept: float = 0.0
-    fit: int = 0
-    ssr: float = 0.0
-    slope_err: float = 0.0
-    intercept_err: float = 0.0
-    area_avg: float = 0.0
-    width: float = 0.0
-    age: float = 0.0
-    proximity: float = 0.0
-    score: float = 0.0
-    _score: _Score = _Score()
-
-    def __str__(self):
-        dates = [point['date'] for point in self.points]
-        output = f'score={self.score:.2f}, '\
-                 f'fit={self.fit:4n} '\
-                 f'wid={self.width:4n} '\
-                 f'prox={self.proximity:5.1f} '\
-                 f'pnts={len(dates)} '\
-                 f'age={self.age:4n} '\
-                 f'slope={self.slope:4n} '\
-                 f'*fit={self.score.fit:5.2f} '\
-                 f'*wid={self.score.width:5.2f} '\
-                 f'*prox={self.score.proximity:5.2f} '\
-                 f'*pnts={self.score.points:5.2f} '\
-                 f'*age={self.score.age:5.2f}'\
-                 f'*slope={self.score.slope:5.2f}'
-
-        return output
+ACCURACY = 4  # Accuracy of trendln's pivots, or for NATIVE, accuracy vs speed (higher finds more pivots)
+
+# Score weights of each normalized criterion, plus a bonus when the line type matches its position
+WEIGHTS = {'fit': 0.05, 'width': 0.15, 'proximity': 0.05, 'points': 0.20, 'age': 0.20, 'slope': 0.30}
+BASIS = 0.05
+
+# Extracted lines, one record per line. Each line's pivot points are kept apart, as the indexes of its bars
+# (see extract_lines()), and scored with WEIGHTS (see _score_lines())
+LINE_DTYPE = np.dtype([
+    ('support', bool),
+    ('end_point', float),
+    ('slope', float),
+    ('intercept', float),
+    ('fit', int),
+    ('ssr', float),
+    ('slope_err', float),
+    ('intercept_err', float),
+    ('area_avg', float),
+    ('width', int),
+    ('age', int),
+    ('proximity', float),
+    ('score', float)])
 
 
 @dataclass
@@ -117,21 +88,26 @@ class _Stats:
 
 
 class SupportResistance(Threaded):
-    def __init__(self, ticker: str, methods: list[str] = ['NSQUREDLOGN'], extmethods: list[str] = ['NUMDIFF'], best: int = 8, days: int = 1000):
+    def __init__(self, ticker: str, methods: list[str] = ['NSQUREDLOGN'], extmethods: list[str] = ['NUMDIFF'], best: int = 8, days: int = 1000,
+                 accuracy: int = ACCURACY, validate: bool = True):
         if best < 1:
             raise ValueError("'best' value must be > 0")
 
         if days <= 30:
             raise ValueError('Days must be greater than 30')
 
-        if (store.is_ticker(ticker)):
+        if not validate or store.is_ticker(ticker):
+            super().__init__()
+
             self.ticker = ticker.upper()
             self.methods = methods
             self.extmethods = extmethods
             self.best = best
             self.days = days
+            self.accuracy = accuracy
             self.history = pd.DataFrame()
             self.price = 0.0
+            self.points = 0
             self.company = {}
             self.lines = pd.DataFrame()
             self.stats = _Stats()
@@ -142,193 +118,100 @@ class SupportResistance(Threaded):
         return f'Support and resistance analysis for {self.ticker} (${self.price:.2f})'
 
     @Threaded.threaded
-    def calculate(self) -> None:
+    def calculate(self, use_cache: bool = True) -> None:
         self.task_message = self.ticker
 
-        self.history = store.get_history(self.ticker, self.days)
-        if not self.history.empty:
+        history = store.get_history(self.ticker, self.days)
+        if not history.empty:
             self.task_state = 'None'
-            self.price = self.history.iloc[-1]['close']
-            self.company = store.get_company(self.ticker)
-
-            if not self.company:
-                self.company['name'] = 'Error'
-                _logger.warning(f'Unable to get company information ({self.ticker})')
-
-            self.points = len(self.history)
-
-            # Extract lines across methods, extmethods, and then flatten the results
-            lines = [self._extract_lines(method, extmethod) for method in self.methods for extmethod in self.extmethods]
-            lines = [item for sublist in lines for item in sublist]
+            self._set_history(history, store.get_company(self.ticker))
 
-            self.task_total = len(lines)
-            _logger.info(f'{__name__}: {self.task_total} total lines extracted')
+            # Extract lines across methods and extmethods
+            results = []
+            for method, extmethod in self.get_extractions():
+                result = self._load_lines(method, extmethod) if use_cache else None
+                if result is None:
+                    result = extract_lines(self.history['high'], self.history['low'], method, extmethod, self.price, self.accuracy)
+                    self._dump_lines(method, extmethod, result)
 
-            # Create dataframe of lines then sort, round, and drop duplicates
-            df = pd.DataFrame.from_records([vars(l) for l in lines])
-            df = df.dropna()
-            df = df.drop('_score', axis=1)
-            df = df.sort_values(by=['score'], ascending=False)
-            df = df.round(6)
-            df = df.drop_duplicates(subset=['slope', 'intercept'])
-            self.lines = df.reset_index(drop=True)
-            _logger.info(f'{__name__}: {len(self.lines)} rows created ({len(lines)-len(self.lines)} duplicates deleted)')
+                results.append(result)
 
-            self._calculate_stats()
+            self._set_lines(results)
 
             self.task_state = 'Done'
         else:
             self.task_state = 'Unable to get history'
 
-    def _extract_lines(self, method: str, extmethod: str) -> list[_Line]:
-        if not method in METHOD:
-            assert ValueError(f'Invalid method {method}')
-
-        result = trendln.calc_support_resistance((None, self.history['high']), method=METHOD[method], extmethod=EXTMETHOD[extmethod], accuracy=ACCURACY)
-        maximaIdxs, pmax, maxtrend, maxwindows = result
-
-        result = trendln.calc_support_resistance((self.history['low'], None), method=METHOD[method], extmethod=EXTMETHOD[extmethod], accuracy=ACCURACY)
-        minimaIdxs, pmin, mintrend, minwindows = result
-
-        self.stats.res_slope = pmax[0]
-        self.stats.res_intercept = pmax[1]
+    def get_extractions(self) -> list[tuple[str, str]]:
+        extractions = [(method, extmethod) for method in self.methods if method != NATIVE for extmethod in self.extmethods]
+        if NATIVE in self.methods:
+            extractions.append((NATIVE, ''))
 
-        lines: list[_Line] = []
-        for line in maxtrend:
-            newline = _Line()
-            newline.support = False
-            newline.end_point = 0.0
-            newline.points = [{'index': point, 'date': ''} for point in line[0]]
-            newline.slope = line[1][0]
-            newline.intercept = line[1][1]
-            newline.ssr = line[1][2]
-            newline.slope_err = line[1][3]
-            newline.intercept_err = line[1][4]
-            newline.area_avg = line[1][5]
+        return extractions
 
-            newline.width = newline.points[-1]['index'] - newline.points[0]['index']
-            newline.age = self.points - newline.points[-1]['index']
+    def _set_history(self, history: pd.DataFrame, company: dict) -> None:
+        self.history = history
+        self.price = self.history.iloc[-1]['close']
+        self.points = len(self.history)
+        self.company = company
 
-            lines.append(newline)
+        if not self.company:
+            self.company['name'] = 'Error'
+            _logger.warning(f'Unable to get company information ({self.ticker})')
 
-        self.stats.sup_slope = pmin[0]
-        self.stats.sup_intercept = pmin[1]
+    def _set_lines(self, results: list[tuple[np.ndarray, list[np.ndarray], tuple]]) -> None:
+        # Join the lines of each extraction (see extract_lines())
+        lines = np.concatenate([lines for lines, _, _ in results])
+        points = [indexes for _, sublist, _ in results for indexes in sublist]
 
-        self.stats.slope = (pmax[0] + pmin[0]) / 2.0
-        self.stats.intercept = (pmax[1] + pmin[1]) / 2.0
+        # Trends of the last extraction
+        (self.stats.res_slope, self.stats.res_intercept), (self.stats.sup_slope, self.stats.sup_intercept) = results[-1][2]
+        self.stats.slope = (self.stats.res_slope + self.stats.sup_slope) / 2.0
+        self.stats.intercept = (self.stats.res_intercept + self.stats.sup_intercept) / 2.0
 
         _logger.debug(f'{__name__}: res: m={self.stats.res_slope:.2f} b={self.stats.res_intercept:.2f}')
         _logger.debug(f'{__name__}: sup: m={self.stats.sup_slope:.2f} b={self.stats.sup_intercept:.2f}')
         _logger.debug(f'{__name__}: tnd: m={self.stats.slope:.2f} b={self.stats.intercept:.2f}')
 
-        for line in mintrend:
-            newline = _Line()
-            newline.support = True
-            newline.end_point = 0.0
-            newline.points = [{'index': point, 'date': ''} for point in line[0]]
-            newline.slope = line[1][0]
-            newline.intercept = line[1][1]
-            newline.ssr = line[1][2]
-            newline.slope_err = line[1][3]
-            newline.intercept_err = line[1][4]
-            newline.area_avg = line[1][5]
-
-            newline.width = newline.points[-1]['index'] - newline.points[0]['index']
-            newline.age = self.points - newline.points[-1]['index']
-
-            lines.append(newline)
-
-        # Calculate dates of pivot points
-        for line in lines:
-            for point in line.points:
-                date = self.history['date'].iloc[point['index']]
-                point['date'] = [date.strftime(ui.DATE_FORMAT_YMD)]
-
-        # Calculate end point extension (y = mx + b)
-        for line in lines:
-            line.end_point = (line.slope * self.points) + line.intercept
-            if line.end_point < 0.0:
-                line.end_point = 0.0
+        self.task_total = len(lines)
+        _logger.info(f'{__name__}: {self.task_total} total lines extracted')
 
-        # Sort lines based on mathematical fit (ssr) and set the line ranking
-        lines = sorted(lines, key=lambda l: l.ssr)
-        for index, line in enumerate(lines):
-            line.fit = index + 1
-
-        ##   Normalize scoring criteria to MAX_SCALE scale ##
-
-        #    Rank
-        max_ = 0.0
-        for line in lines:
-            if line.fit > max_:
-                max_ = line.fit
-        for line in lines:
-            line._score.fit = line.fit / max_
-            line._score.fit *= MAX_SCALE
-            line._score.fit = MAX_SCALE - line._score.fit  # Lower is better
-
-        #    Width
-        max_ = 0.0
-        for line in lines:
-            if line.width > max_:
-                max_ = line.width
-        for line in lines:
-            line._score.width = line.width / max_
-            line._score.width *= MAX_SCALE
-
-        #    Proximity
-        max_ = 0.0
-        for line in lines:
-            line.proximity = abs(line.end_point - self.price)
-            if line.proximity > max_:
-                max_ = line.proximity
-        for line in lines:
-            line._score.proximity = line.proximity / max_
-            line._score.proximity *= MAX_SCALE
-            line._score.proximity = MAX_SCALE - line._score.proximity  # Lower is better
-
-        #    Points
-        max_ = 0.0
-        for line in lines:
-            if len(line.points) > max_:
-                max_ = len(line.points)
-        for line in lines:
-            line._score.points = len(line.points) / max_
-            line._score.points *= MAX_SCALE
-
-        #    Age
-        max_ = 0.0
-        for line in lines:
-            if line.age > max_:
-                max_ = line.age
-        for line in lines:
-            line._score.age = line.age / max_
-            line._score.age *= MAX_SCALE
-            line._score.age = MAX_SCALE - line._score.age  # Lower is better
-
-        #    Slope
-        max_ = 0.0
-        for line in lines:
-            if line.slope > max_:
-                max_ = abs(line.slope)
-        for line in lines:
-            line._score.slope = abs(line.slope) / max_
-            line._score.slope *= MAX_SCALE
-            line._score.slope = MAX_SCALE - line._score.slope  # Lower is better
-
-        #   Basis (line type matches position. Ex: end point of support line is below current price, resistence end point above)
-        for line in lines:
-            if line.support:
-                line._score.basis = True if line.end_point < self.price else False
-            else:
-                line._score.basis = True if line.end_point >= self.price else False
+        # Create dataframe of lines then sort, round, and drop duplicates
+        df = pd.DataFrame(lines)
+        df.insert(1, 'points', pd.Series(points, dtype=object))
+        df = df.dropna()
+        df = df.sort_values(by=['score'], ascending=False)
+        df = df.round(6)
+        df = df.drop_duplicates(subset=['slope', 'intercept'])
+
+        # Dates of the pivot points
+        dates = self._get_dates()
+        df['points'] = [[{'index': index, 'date': date} for index, date in zip(indexes.tolist(), dates[indexes])] for indexes in df['points']]
+
+        self.lines = df.reset_index(drop=True)
+        _logger.info(f'{__name__}: {len(self.lines)} rows created ({len(lines)-len(self.lines)} duplicates deleted)')
+
+        self._calculate_stats()
+
+    def _load_lines(self, method: str, extmethod: str) -> tuple | None:
+        # Only used if extracted from the same bars
+        entry, _ = cache.load(self.ticker, CACHE_TYPE, today_only=False, params=self._build_key(method, extmethod))
+        return entry[1] if entry is not None and entry[0] == self._get_span() else None
+
+    def _dump_lines(self, method: str, extmethod: str, result: tuple) -> None:
+        # One entry per ticker and extraction, replaced as new bars arrive
+        cache.dump((self._get_span(), result), self.ticker, CACHE_TYPE, params=self._build_key(method, extmethod), replace=True)
 
-        for line in lines:
-            line.score = line._score.calculate()
+    def _build_key(self, method: str, extmethod: str) -> str:
+        return cache.build_key(method=method, extmethod=extmethod, days=self.days, accuracy=self.accuracy)
 
-        _logger.info(f'{__name__}: {len(lines)} lines extracted using {method} and {extmethod}')
+    def _get_span(self) -> tuple[str, str, int]:
+        # The first and last dates and length of the history identify its bars
+        return str(self.history['date'].iloc[0]), str(self.history['date'].iloc[-1]), self.points
 
-        return lines
+    def _get_dates(self) -> np.ndarray:
+        # Date labels of the whole history, converted at once
+        return pd.to_datetime(self.history['date']).dt.strftime(ui.DATE_FORMAT_YMD).to_numpy()
 
     def _get_resistance(self, method_price: bool = True, best: int = 0) -> pd.DataFrame:
         if best <= 0:
@@ -440,7 +323,8 @@ class SupportResistance(Threaded):
         ax1.tick_params(axis='x', labelrotation=45)
 
         # Highs & Lows
-        dates = [self.history.iloc[i]['date'].strftime(ui.DATE_FORMAT_YMD) for i in range(length)]
+        labels = self._get_dates()
+        dates = labels.tolist()
         ax1.plot(dates, self.history['high'], '-g', linewidth=0.5)
         ax1.plot(dates, self.history['low'], '-r', linewidth=0.5)
         ax1.fill_between(dates, self.history['high'], self.history['low'], facecolor='gray', alpha=0.4)
@@ -452,8 +336,7 @@ class SupportResistance(Threaded):
             for line in resistance.itertuples():
                 for point in line.points:
                     index = point['index']
-                    date = self.history.iloc[index]['date']
-                    dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                    dates.append(labels[index])
                     values.append(self.history.iloc[index]['high'])
             ax1.plot(dates, values, '.r')
 
@@ -463,8 +346,7 @@ class SupportResistance(Threaded):
             for line in support.itertuples():
                 for point in line.points:
                     index = point['index']
-                    date = self.history.iloc[index]['date']
-                    dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                    dates.append(labels[index])
                     values.append(self.history.iloc[index]['low'])
             ax1.plot(dates, values, '.g')
 
@@ -474,12 +356,10 @@ class SupportResistance(Threaded):
             values = []
             for line in resistance.itertuples():
                 index = line.points[0]['index']
-                date = self.history.iloc[index]['date']
-                dates = [date.strftime(ui.DATE_FORMAT_YMD)]
+                dates = [labels[index]]
                 values = [self.history.iloc[index]['high']]
                 index = line.points[-1]['index']
-                date = self.history.iloc[index]['date']
-                dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                dates.append(labels[index])
                 values.append(self.history.iloc[index]['high'])
 
                 ax1.plot(dates, values, '-r', linewidth=line_width)
@@ -489,12 +369,10 @@ class SupportResistance(Threaded):
             values = []
             for line in support.itertuples():
                 index = line.points[0]['index']
-                date = self.history.iloc[index]['date']
-                dates = [date.strftime(ui.DATE_FORMAT_YMD)]
+                dates = [labels[index]]
                 values = [self.history.iloc[index]['low']]
                 index = line.points[-1]['index']
-                date = self.history.iloc[index]['date']
-                dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                dates.append(labels[index])
                 values.append(self.history.iloc[index]['low'])
 
                 ax1.plot(dates, values, '-g', linewidth=line_width)
@@ -505,12 +383,10 @@ class SupportResistance(Threaded):
                 values = []
                 for line in resistance.itertuples():
                     index = line.points[-1]['index']
-                    date = self.history.iloc[index]['date']
-                    dates = [date.strftime(ui.DATE_FORMAT_YMD)]
+                    dates = [labels[index]]
                     values = [self.history.iloc[index]['high']]
                     index = self.points-1
-                    date = self.history.iloc[index]['date']
-                    dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                    dates.append(labels[index])
                     values.append(line.end_point)
 
                     ax1.plot(dates, values, ':r', linewidth=line_width)
@@ -520,12 +396,10 @@ class SupportResistance(Threaded):
                 values = []
                 for line in support.itertuples():
                     index = line.points[-1]['index']
-                    date = self.history.iloc[index]['date']
-                    dates = [date.strftime(ui.DATE_FORMAT_YMD)]
+                    dates = [labels[index]]
                     values = [self.history.iloc[index]['low']]
                     index = self.points-1
-                    date = self.history.iloc[index]['date']
-                    dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                    dates.append(labels[index])
                     values.append(line.end_point)
 
                     ax1.plot(dates, values, ':g', linewidth=line_width)
@@ -537,8 +411,7 @@ class SupportResistance(Threaded):
                 for index, line in enumerate(resistance.itertuples()):
                     ep = m.mround(line.end_point, _rounding)
                     if ep not in values:
-                        date = self.history['date'].iloc[-1]
-                        dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                        dates.append(labels[-1])
                         values.append(ep)
                         text.append({'text': f'{line.end_point:.2f}:{index+1}', 'value': line.end_point, 'color': 'red'})
                 ax1.plot(dates, values, '.r')
@@ -549,8 +422,7 @@ class SupportResistance(Threaded):
                 for index, line in enumerate(support.itertuples()):
                     ep = m.mround(line.end_point, _rounding)
                     if ep not in values:
-                        date = self.history['date'].iloc[-1]
-                        dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+                        dates.append(labels[-1])
                         values.append(ep)
                         text.append({'text': f'{line.end_point:.2f}:{index+1}', 'value': line.end_point, 'color': 'green'})
                 ax1.plot(dates, values, '.g')
@@ -588,11 +460,9 @@ class SupportResistance(Threaded):
 
         if trendlines or trend:
             index = 0
-            date = self.history.iloc[index]['date']
-            dates = [date.strftime(ui.DATE_FORMAT_YMD)]
+            dates = [labels[index]]
             index = self.points-1
-            date = self.history.iloc[index]['date']
-            dates.append(date.strftime(ui.DATE_FORMAT_YMD))
+            dates.append(labels[index])
 
         # Sup & Res trendlines
         if trendlines:
@@ -625,6 +495,168 @@ class SupportResistance(Threaded):
         return figure
 
 
+# Support and resistance for a list of tickers. Histories and company information are loaded in bulk, and
+# the trendln extractions not already cached are run on a process pool since they're CPU bound
+class SupportResistanceBatch(Threaded):
+    def __init__(self, tickers: list[str], methods: list[str] = ['NSQUREDLOGN'], extmethods: list[str] = ['NUMDIFF'], best: int = 8,
+                 days: int = 1000, accuracy: int = ACCURACY, processes: int = PROCESSES):
+        # All the tickers are checked at once, rather than by each analysis
+        invalid = store.get_invalid_tickers(tickers)
+        if invalid:
+            raise ValueError(f'{__name__}: Invalid tickers: {", ".join(invalid)}')
+
+        super().__init__()
+
+        self.analyses = [SupportResistance(ticker, methods=methods, extmethods=extmethods, best=best, days=days, accuracy=accuracy, validate=False)
+                         for ticker in tickers]
+        self.days = days
+        self.processes = processes
+
+    def __repr__(self):
+        return f'<SupportResistanceBatch ({len(self.analyses)} tickers)>'
+
+    @Threaded.threaded
+    def calculate(self, use_cache: bool = True) -> None:
+        self.task_state = 'None'
+        tickers = [analysis.ticker for analysis in self.analyses]
+        self.task_message = 'History'
+
+        panel = store.get_history_panel(tickers, days=self.days)
+        companies = store.get_companies(tickers)
+
+        # Cached extractions are used as is. The rest are run together
+        results = {}
+        jobs = {}
+        for n, analysis in enumerate(self.analyses):
+            history = panel.get_history(analysis.ticker)
+            if history.empty:
+                analysis.task_state = 'Unable to get history'
+                continue
+
+            analysis._set_history(history, dict(companies.get(analysis.ticker, {})))
+            for method, extmethod in analysis.get_extractions():
+                result = analysis._load_lines(method, extmethod) if use_cache else None
+                if result is None:
+                    jobs[(n, method, extmethod)] = (history['high'], history['low'], method, extmethod, analysis.price, analysis.accuracy)
+                else:
+                    results[(n, method, extmethod)] = result
+
+        self.task_total = len(results) + len(jobs)
+        self.task_completed = self.task_counter = len(results)
+        self.task_message = 'Extracting'
+
+        def collect(key: tuple[int, str, str], result: tuple) -> None:
+            n, method, extmethod = key
+            self.analyses[n]._dump_lines(method, extmethod, result)
+            results[key] = result
+            self.task_ticker = self.analyses[n].ticker
+            self.task_completed += 1
+
+        if self.processes > 1 and len(jobs) >= PROCESS_MIN_JOBS:
+            context = multiprocessing.get_context(PROCESS_CONTEXT)
+            with futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as executor:
+                tasks = {executor.submit(extract_lines, *args): key for key, args in jobs.items()}
+                for task in futures.as_completed(tasks):
+                    try:
+                        collect(tasks[task], task.result())
+                    except Exception as e:
+                        self.task_completed += 1
+                        _logger.error(f'{__name__}: Exception extracting lines for {self.analyses[tasks[task][0]].ticker}: {e}')
+        else:
+            for key, args in jobs.items():
+                try:
+                    collect(key, extract_lines(*args))
+                except Exception as e:
+                    self.task_completed += 1
+                    _logger.error(f'{__name__}: Exception extracting lines for {self.analyses[key[0]].ticker}: {e}')
+
+        for n, analysis in enumerate(self.analyses):
+            if analysis.history.empty:
+                pass
+            elif all((n, method, extmethod) in results for method, extmethod in analysis.get_extractions()):
+                analysis._set_lines([results[(n, method, extmethod)] for method, extmethod in analysis.get_extractions()])
+                analysis.task_state = 'Done'
+                self.task_success += 1
+            else:
+                analysis.task_state = 'Error extracting lines'
+
+        self.task_object = [analysis for analysis in self.analyses if analysis.task_state == 'Done']
+        self.task_state = 'Done'
+
+        _logger.info(f'{__name__}: {self.task_success} of {len(self.analyses)} tickers analyzed. {self.task_counter} extractions cached')
+
+
+def extract_lines(high: pd.Series, low: pd.Series, method: str, extmethod: str, price: float,
+                  accuracy: int = ACCURACY) -> tuple[np.ndarray, list[np.ndarray], tuple]:
+    # Returns the lines (LINE_DTYPE records sorted by fit), the index of each line's pivot points and the
+    # (slope, intercept) of the resistance and support trends. A function so it can run in worker processes
+    if method == NATIVE:
+        pmax, maxtrend = trendline.find_trends(high.to_numpy(dtype=float), False, accuracy)
+        pmin, mintrend = trendline.find_trends(low.to_numpy(dtype=float), True, accuracy)
+    elif method in METHOD:
+        result = trendln.calc_support_resistance((None, high), method=METHOD[method], extmethod=EXTMETHOD[extmethod], accuracy=accuracy)
+        maximaIdxs, pmax, maxtrend, maxwindows = result
+
+        result = trendln.calc_support_resistance((low, None), method=METHOD[method], extmethod=EXTMETHOD[extmethod], accuracy=accuracy)
+        minimaIdxs, pmin, mintrend, minwindows = result
+    else:
+        raise ValueError(f'Invalid method {method}')
+
+    # Each trend is the pivot point indexes and (slope, intercept, ssr, slope err, intercept err, area avg)
+    trends = maxtrend + mintrend
+    lines = np.zeros(len(trends), dtype=LINE_DTYPE)
+    points = [np.asarray(trend[0], dtype=int) for trend in trends]
+
+    if trends:
+        lines['support'][len(maxtrend):] = True
+
+        fits = np.array([trend[1][:6] for trend in trends], dtype=float)
+        lines['slope'], lines['intercept'], lines['ssr'], lines['slope_err'], lines['intercept_err'], lines['area_avg'] = fits.T
+
+        first = np.array([indexes[0] for indexes in points])
+        last = np.array([indexes[-1] for indexes in points])
+        lines['width'] = last - first
+        lines['age'] = len(high) - last
+
+        # Sort lines based on mathematical fit (ssr) and set the line ranking
+        order = np.argsort(lines['ssr'], kind='stable')
+        lines = lines[order]
+        points = [points[n] for n in order]
+        lines['fit'] = np.arange(1, len(lines) + 1)
+
+        count = np.array([len(indexes) for indexes in points], dtype=float)
+        _score_lines(lines, count, price, len(high))
+
+    _logger.info(f'{__name__}: {len(lines)} lines extracted using {method} and {extmethod}')
+
+    return lines, points, ((pmax[0], pmax[1]), (pmin[0], pmin[1]))
+
+
+def _score_lines(lines: np.ndarray, count: np.ndarray, price: float, length: int) -> None:
+    # Fills in the end point, proximity and score of LINE_DTYPE records. Each criterion is normalized to
+    # MAX_SCALE over all the lines (inverted where lower is better), then weighted and summed
+    lines['end_point'] = np.maximum(lines['slope'] * length + lines['intercept'], 0.0)  # y = mx + b
+    lines['proximity'] = np.abs(lines['end_point'] - price)
+
+    scores = {
+        'fit': MAX_SCALE - _normalize(lines['fit']),
+        'width': _normalize(lines['width']),
+        'proximity': MAX_SCALE - _normalize(lines['proximity']),
+        'points': _normalize(count),
+        'age': MAX_SCALE - _normalize(lines['age']),
+        'slope': MAX_SCALE - _normalize(np.abs(lines['slope']))}
+
+    # Basis (line type matches position. Ex: end point of support line is below current price, resistence end point above)
+    basis = np.where(lines['support'], lines['end_point'] < price, lines['end_point'] >= price)
+
+    lines['score'] = sum(scores[criterion] * weight for criterion, weight in WEIGHTS.items()) + np.where(basis, BASIS, 0.0)
+
+
+def _normalize(values: np.ndarray) -> np.ndarray:
+    top = np.max(values) if len(values) > 0 else 0.0
+    return values / top * MAX_SCALE if top > 0.0 else np.zeros(len(values))
+
+
 if __name__ == '__main__':
     import sys
     import logging
@@ -633,7 +665,7 @@ if __name__ == '__main__':
     logger.get_logger(logging.DEBUG)
 
     if len(sys.argv) > 1:
-        # methods = ['NSQUREDLOGN', 'NCUBED', 'HOUGHLINES', 'PROBHOUGH']
+        # methods = ['NSQUREDLOGN', 'NCUBED', 'HOUGHLINES', 'PROBHOUGH', 'NATIVE']
         # extmethods = ['NAIVE', 'NAIVECONSEC', 'NUMDIFF']
         # sr = SupportResistance(sys.argv[1], methods=methods, extmethods=extmethods)
         sr = SupportResistance(sys.argv[1], days=500)
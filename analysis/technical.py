@@ -2,11 +2,14 @@
 ta: https://technical-analysis-library-in-python.readthedocs.io/en/latest/index.html
 '''
 
+from collections.abc import Iterable
+
+import numpy as np
 import pandas as pd
-from ta import trend, momentum, volatility, volume
+from ta import trend, volume
 
 from data import store as store
-from utils import logger
+from utils import memo, logger
 
 _logger = logger.get_logger()
 
@@ -34,16 +37,35 @@ class Technical:
     def calc_sma(self, interval: int) -> pd.Series:
         sr = pd.Series(dtype=float)
         if interval > 5 and interval < self.days:
-            sr = trend.sma_indicator(self.history['close'], window=interval, fillna=True)
+            sr = self.calc_smas([interval])[interval]
         else:
             _logger.warning(f'{__name__}: Invalid interval for SMA')
 
         return sr
 
+    def calc_smas(self, intervals: Iterable[int]) -> dict[int, pd.Series]:
+        # Several SMA lengths from one pass over the history. Each is memoized separately
+        intervals = [interval for interval in intervals if interval > 5 and interval < self.days]
+        close = self.history['close']
+
+        smas = {}
+        computed = {}
+        for interval in intervals:
+            def compute(interval: int = interval) -> pd.Series:
+                if not computed:
+                    computed.update(rolling_mean(close.to_numpy(dtype=float), intervals))
+                return pd.Series(computed[interval], index=close.index, name=f'sma_{interval}')
+
+            smas[interval] = memo.get(self.ticker, 'sma', self.history, compute, interval=interval)
+
+        return smas
+
     def calc_ema(self, interval: int) -> pd.Series:
         sr = pd.Series(dtype=float)
         if interval > 5 and interval < self.days:
-            sr = trend.ema_indicator(self.history['close'], window=interval, fillna=True)
+            close = self.history['close']
+            sr = memo.get(self.ticker, 'ema', self.history,
+                lambda: pd.Series(ema(close.to_numpy(dtype=float), interval), index=close.index, name=f'ema_{interval}'), interval=interval)
         else:
             _logger.warning(f'{__name__}: Invalid interval for EMA')
 
@@ -52,12 +74,36 @@ class Technical:
     def calc_rsi(self, interval: int = 14) -> pd.Series:
         sr = pd.Series(dtype=float)
         if interval > 5 and interval < self.days:
-            sr = momentum.rsi(self.history['close'], window=interval, fillna=True)
+            close = self.history['close']
+            sr = memo.get(self.ticker, 'rsi', self.history,
+                lambda: pd.Series(rsi(close.to_numpy(dtype=float), interval), index=close.index, name='rsi'), interval=interval)
         else:
             _logger.warning(f'{__name__}: Invalid interval for RSI')
 
         return sr
 
+    def calc_log_returns(self) -> pd.Series:
+        sr = pd.Series(dtype=float)
+        if not self.history.empty:
+            sr = memo.get(self.ticker, 'logret', self.history,
+                lambda: np.log(self.history['close']).diff().rename('logret'))
+
+        return sr
+
+    def calc_volatility(self, interval: int = 20, annualize: bool = True) -> pd.Series:
+        # Realized volatility: rolling standard deviation of daily log returns
+        sr = pd.Series(dtype=float)
+        if interval > 1 and interval < self.days:
+            def compute() -> pd.Series:
+                vol = self.calc_log_returns().rolling(interval).std()
+                return (vol * np.sqrt(252.0) if annualize else vol).rename(f'vol_{interval}')
+
+            sr = memo.get(self.ticker, 'vol', self.history, compute, interval=interval, annualize=annualize)
+        else:
+            _logger.warning(f'{__name__}: Invalid interval for volatility')
+
+        return sr
+
     def calc_vwap(self) -> pd.Series:
         sr = pd.Series(dtype=float)
         vwap = volume.VolumeWeightedAveragePrice(self.history['high'], self.history['low'], self.history['close'], self.history['volume'], fillna=True)
@@ -80,19 +126,110 @@ class Technical:
     def calc_bb(self, interval: int = 14, std: int = 2) -> pd.DataFrame:
         sr = pd.DataFrame()
         if interval > 5 and interval < self.days:
-            bb = volatility.BollingerBands(self.history['close'], window=interval, window_dev=std, fillna=True)
-            high = bb.bollinger_hband()
-            mid = bb.bollinger_mavg()
-            low = bb.bollinger_lband()
+            close = self.history['close']
+            mid = self.calc_sma(interval)
+            dev = memo.get(self.ticker, 'std', self.history,
+                lambda: pd.Series(rolling_std(close.to_numpy(dtype=float), interval), index=close.index), interval=interval)
 
-            sr = pd.concat([high, mid, low], axis=1)
-            sr.columns = ['High', 'Mid', 'Low']
+            sr = pd.DataFrame({'High': mid + (std * dev), 'Mid': mid, 'Low': mid - (std * dev)})
         else:
             _logger.warning(f'{__name__}: Invalid interval for BB')
 
         return sr
 
 
+# Native rolling kernels. These take a 1-D series or a 2-D dates x tickers panel (oldest first) and match
+# the ta library with fillna=True: windows are partial at the start, and NaNs before a ticker's first
+# value are skipped and stay NaN in the output
+
+def rolling_mean(values: np.ndarray, windows: Iterable[int]) -> dict[int, np.ndarray]:
+    # All window lengths from one pair of cumulative sums
+    values, shape = _as_2d(values)
+    valid = ~np.isnan(values)
+    sums = _cumsum(np.where(valid, values, 0.0))
+    counts = _cumsum(valid.astype(float))
+
+    means = {}
+    upper = np.arange(1, len(values) + 1)
+    for window in windows:
+        if window < 1:
+            raise ValueError('Invalid window')
+
+        lower = np.maximum(upper - window, 0)
+        total = sums[upper] - sums[lower]
+        count = counts[upper] - counts[lower]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+
+        means[window] = np.where(valid, mean, np.nan).reshape(shape)
+
+    return means
+
+
+def rolling_std(values: np.ndarray, window: int) -> np.ndarray:
+    # Population standard deviation (ddof=0), as used for Bollinger Bands
+    values, shape = _as_2d(values)
+    mean = rolling_mean(values, [window])[window]
+    square = rolling_mean(values * values, [window])[window]
+
+    return np.sqrt(np.maximum(square - (mean * mean), 0.0)).reshape(shape)
+
+
+def ema(values: np.ndarray, window: int) -> np.ndarray:
+    if window < 1:
+        raise ValueError('Invalid window')
+
+    values, shape = _as_2d(values)
+    return _recursive(values, 2.0 / (window + 1.0), values[0]).reshape(shape)
+
+
+def rsi(values: np.ndarray, window: int = 14) -> np.ndarray:
+    if window < 1:
+        raise ValueError('Invalid window')
+
+    values, shape = _as_2d(values)
+    up, down = rsi_averages(values, window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(down == 0.0, 100.0, 100.0 - (100.0 / (1.0 + (up / down))))
+
+    return np.where(np.isnan(values), np.nan, result).reshape(shape)
+
+
+def rsi_averages(values: np.ndarray, window: int) -> tuple[np.ndarray, np.ndarray]:
+    # Smoothed gains and losses the RSI is calculated from, each starting at 0 on the first row
+    values, _ = _as_2d(values)
+    diff = np.diff(values, axis=0, prepend=np.nan)
+    up = np.where(diff > 0.0, diff, 0.0)
+    down = np.where(diff < 0.0, -diff, 0.0)
+
+    alpha = 1.0 / window
+    return _recursive(up, alpha, up[0]), _recursive(down, alpha, down[0])
+
+
+def _recursive(values: np.ndarray, alpha: float, first: np.ndarray) -> np.ndarray:
+    # y[t] = (1 - alpha) * y[t-1] + alpha * x[t], starting at each column's first value.
+    # The loop is over dates only, each step works on all tickers at once
+    result = np.empty_like(values)
+    state = first.copy()
+    for row in range(len(values)):
+        value = values[row]
+        state = np.where(np.isnan(state), value, np.where(np.isnan(value), state, ((1.0 - alpha) * state) + (alpha * value)))
+        result[row] = state
+
+    return np.where(np.isnan(values), np.nan, result)
+
+
+def _cumsum(values: np.ndarray) -> np.ndarray:
+    # Cumulative sums with a leading row of zeros, so window sums are differences of two rows
+    return np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+
+
+def _as_2d(values: np.ndarray) -> tuple[np.ndarray, tuple]:
+    values = np.asarray(values, dtype=float)
+    return (values.reshape(-1, 1) if values.ndim == 1 else values), values.shape
+
+
 if __name__ == '__main__':
     import sys
     from analysis.chart import plot_technical_history
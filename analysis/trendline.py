@@ -0,0 +1,139 @@
+'''
+Trend lines through price pivots, without trendln. Same results layout as trendln.calc_support_resistance():
+    (point indexes, (slope, intercept, ssr, slope err, intercept err, area avg))
+'''
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils import logger
+
+
+_logger = logger.get_logger()
+
+WINDOW = 125        # Bars. Pivots more than two windows apart aren't paired (as in trendln)
+TOLERANCE = 0.005   # Band either side of a candidate line, as a fraction of the price range, that pivots must be within
+ERROR = 0.005       # Max standard error of a line's slope, as a fraction of the price range per bar (as in trendln)
+MIN_POINTS = 3      # Two pivots make a candidate. A line needs a third to be tested
+CHUNK = 2048        # Candidate lines evaluated per batch
+
+
+def find_pivots(values: np.ndarray, order: int, support: bool) -> np.ndarray:
+    # Indexes of the bars that are the lowest (support) or highest of the 'order' bars either side of them.
+    # Ties go to the first bar, and bars without 'order' bars on both sides aren't pivots
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2 * order + 1:
+        return np.array([], dtype=int)
+
+    windows = sliding_window_view(values, 2 * order + 1)
+    position = windows.argmin(axis=1) if support else windows.argmax(axis=1)
+
+    return np.nonzero(position == order)[0] + order
+
+
+def find_trends(values: np.ndarray, support: bool, accuracy: int = 4) -> tuple[list[float], list[tuple[list[int], tuple]]]:
+    # Returns the (slope, intercept) of the line through all the pivots, and the trend lines. Higher accuracy
+    # finds pivots over fewer bars, giving more pivots and candidates (slower) and catching shorter swings
+    if accuracy < 1:
+        raise ValueError('Invalid accuracy')
+
+    values = np.asarray(values, dtype=float)
+    order = max(round(16 / accuracy), 1)
+    pivots = find_pivots(values, order, support)
+
+    overall = list(np.polyfit(pivots, values[pivots], 1)) if len(pivots) > 1 else [np.nan, np.nan]
+    if len(pivots) < MIN_POINTS:
+        return overall, []
+
+    x = pivots.astype(float)
+    y = values[pivots]
+    scale = np.nanmax(values) - np.nanmin(values)
+    band = scale * TOLERANCE
+    error = scale / len(values) * ERROR
+
+    # Candidates are the lines through each pair of pivots close enough to be on one trend
+    first, second = np.triu_indices(len(pivots), k=1)
+    near = x[second] - x[first] <= 2 * WINDOW
+    first, second = first[near], second[near]
+
+    touches = []
+    for n in range(0, len(first), CHUNK):
+        touches += [_touch(x, y, first[n:n+CHUNK], second[n:n+CHUNK], band)]
+
+    touches = np.concatenate(touches) if touches else np.zeros((0, len(pivots)), dtype=bool)
+
+    # Pairs on the same line give the same pivots, so keep each set of pivots once
+    if len(touches) > 0:
+        _, unique = np.unique(np.packbits(touches, axis=1), axis=0, return_index=True)
+        touches = touches[np.sort(unique)]
+
+    slope, intercept, ssr, slope_err, intercept_err = _fit(x, y, touches)
+
+    # Lines that don't fit their pivots closely enough are dropped
+    keep = slope_err <= error
+    touches, slope, intercept, ssr, slope_err, intercept_err = \
+        touches[keep], slope[keep], intercept[keep], ssr[keep], slope_err[keep], intercept_err[keep]
+
+    # Nor are lines the price trades well through between their pivots
+    area = _area(values, pivots, touches, slope, intercept, support)
+    keep = area <= band
+    touches, slope, intercept, ssr, slope_err, intercept_err, area = \
+        touches[keep], slope[keep], intercept[keep], ssr[keep], slope_err[keep], intercept_err[keep], area[keep]
+
+    trends = [(pivots[touch].tolist(), fit) for touch, fit in zip(touches, zip(slope, intercept, ssr, slope_err, intercept_err, area))]
+    _logger.debug(f'{__name__}: {len(trends)} {"support" if support else "resistance"} lines from {len(pivots)} pivots and {len(first)} candidates')
+
+    return overall, trends
+
+
+def _touch(x: np.ndarray, y: np.ndarray, first: np.ndarray, second: np.ndarray, band: float) -> np.ndarray:
+    # Pivots within the band of each candidate line and the span of pivots that can pair with its first.
+    # Candidates without a third pivot are pruned here, before any fitting
+    slope = (y[second] - y[first]) / (x[second] - x[first])
+    intercept = y[first] - slope * x[first]
+
+    span = (x >= x[first, None]) & (x <= x[first, None] + 2 * WINDOW)
+    touch = span & (np.abs(y - (slope[:, None] * x + intercept[:, None])) <= band)
+
+    return touch[touch.sum(axis=1) >= MIN_POINTS]
+
+
+def _fit(x: np.ndarray, y: np.ndarray, touches: np.ndarray) -> tuple[np.ndarray, ...]:
+    # Least squares line through each row's pivots at once, with the standard errors as in trendln
+    weights = touches.astype(float)
+    count = weights.sum(axis=1)
+    sx = weights @ x
+    sy = weights @ y
+    sxx = weights @ (x * x)
+    sxy = weights @ (x * y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = sxx - sx * sx / count
+        slope = (sxy - sx * sy / count) / xs
+        intercept = (sy - slope * sx) / count
+
+        residuals = np.where(touches, y - (slope[:, None] * x + intercept[:, None]), 0.0)
+        ssr = (residuals * residuals).sum(axis=1)
+        slope_err = np.sqrt(ssr / ((count - 2) * xs))
+        intercept_err = slope_err * np.sqrt(sxx / count)
+
+    return slope, intercept, ssr, slope_err, intercept_err
+
+
+def _area(values: np.ndarray, pivots: np.ndarray, touches: np.ndarray, slope: np.ndarray, intercept: np.ndarray, support: bool) -> np.ndarray:
+    # Average of how far the price goes through each line between its first and last pivots
+    if len(touches) == 0:
+        return np.array([])
+
+    start = np.where(touches, pivots, len(values)).min(axis=1)
+    stop = np.where(touches, pivots, -1).max(axis=1)
+    length = stop - start + 1
+
+    index = start[:, None] + np.arange(length.max())
+    inside = index <= stop[:, None]
+    index = np.minimum(index, len(values) - 1)
+
+    line = slope[:, None] * index + intercept[:, None]
+    through = (line - values[index]) if support else (values[index] - line)
+
+    return np.where(inside, np.maximum(through, 0.0), 0.0).sum(axis=1) / length
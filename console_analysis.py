@@ -15,8 +15,9 @@ import strategies.strategy_list as sl
 import data as d
 import screener.screener as screener
 from screener.screener import Screener
+from screener.backtest import Backtest
 from strategies.strategy import Strategy
-from analysis.support_resistance import SupportResistance
+from analysis.support_resistance import SupportResistance, SupportResistanceBatch
 from analysis.correlate import Correlate
 from analysis.chart import Chart
 from data import store as store
@@ -46,7 +47,9 @@ class Interface:
     days: int
     commands: list[dict] = []
     screener: Screener | None
+    walk_forward: Backtest | None
     trend: SupportResistance | None
+    trends: SupportResistanceBatch | None
     correlate: Correlate | None
     chart: Chart
     strategy: Strategy
@@ -61,6 +64,8 @@ class Interface:
         self.days = 365
         self.backtest = 0
         self.screener = None
+        self.walk_forward = None
+        self.trends = None
         self.correlate = None
         self.commands: list[dict] = []
 
@@ -104,9 +109,11 @@ class Interface:
             # {'name': 'd', 'menu': 'Refresh Screen', 'function': self.m_refresh_screen, 'condition': '', 'value': ''},
             {'name': 'e', 'menu': 'Analyze Results', 'function': self.m_analyze_result_files, 'condition': '', 'value': ''},
             {'name': 'f', 'menu': 'Run Backtest Screen', 'function': self.m_run_backtest, 'condition': 'self.backtest', 'value': 'self.backtest'},
+            {'name': 'p', 'menu': 'Run Walk-Forward Backtest', 'function': self.m_run_walk_forward, 'condition': '', 'value': ''},
             {'name': 'g', 'menu': 'Run Option Strategy', 'function': self.m_select_option_strategy, 'condition': '', 'value': ''},
             {'name': 'h', 'menu': 'Run Support & Resistance Analysis', 'function': self.m_select_support_resistance, 'condition': 'self.quick', 'value': '"quick"'},
             {'name': 'i', 'menu': 'Run Correlation', 'function': self.m_run_correlate, 'condition': '', 'value': ''},
+            {'name': 'q', 'menu': 'Show Correlation Clusters', 'function': self.m_show_correlation_clusters, 'condition': '', 'value': ''},
             # {'name': 'j', 'menu': 'Show Chart', 'function': self.m_show_chart, 'condition': '', 'value': ''},
             {'name': 'k', 'menu': 'Show by Sector', 'function': self.m_filter_by_sector, 'condition': '', 'value': ''},
             {'name': 'l', 'menu': 'Show Top Results', 'function': self.m_show_top, 'condition': _c, 'value': _v},
@@ -185,6 +192,10 @@ class Interface:
             if self.screener.valids:
                 self.show_backtest(top=LISTTOP_SCREEN)
 
+    def m_run_walk_forward(self) -> None:
+        if self.run_walk_forward():
+            self.show_walk_forward()
+
     def m_refresh_screen(self) -> None:
         self.refresh_screen()
         if self.screener.valids:
@@ -262,6 +273,20 @@ class Interface:
         if self.correlate is not None and len(self.correlate.results) > 0:
             self.show_correlations()
 
+    def m_show_correlation_clusters(self) -> None:
+        if self.correlate is None or self.correlate.results.empty:
+            ui.print_error('Please first run correlation')
+        else:
+            clusters = ui.input_integer('Input number of clusters (2-50)', 2, 50)
+            self.correlate.compute_clusters(clusters)
+            self.show_correlation_clusters()
+
+            # Mean correlation between the screened symbols over time
+            if self.screener is not None and self.screener.valids:
+                valids = [result.company.ticker for result in self.screener.valids]
+                self.correlate.compute_rolling(tickers=valids)
+                self.show_rolling_correlation()
+
     def m_analyze_result_files(self) -> None:
         if self.table:
             summary, multiples = screener.analyze_results(self.table)
@@ -430,6 +455,37 @@ class Interface:
 
         return success
 
+    def run_walk_forward(self, prompt: bool = True, bullish: bool = True) -> bool:
+        success = False
+
+        if not self.table:
+            ui.print_error('No exchange, index, or ticker specified')
+        elif not self.screen:
+            ui.print_error('No screen specified')
+        else:
+            period = ui.input_integer('Input number of days to backtest (10-250)', 10, 250) if prompt else 60
+            horizon = ui.input_integer('Input number of days to hold (1-50)', 1, 50) if prompt else 10
+
+            try:
+                self.walk_forward = Backtest(self.table, self.screen, days=self.days, period=period, horizon=horizon, bullish=bullish)
+            except ValueError as e:
+                ui.print_error(f'{__name__}: {str(e)}')
+            else:
+                # Start the working thread
+                self.task = threading.Thread(target=self.walk_forward.run)
+                self.task.start()
+
+                # Show thread progress. Blocking while thread is active
+                self.show_progress_walk_forward()
+
+                if self.walk_forward.task_state == 'Done':
+                    ui.print_message(f'{len(self.walk_forward.results)} days backtested in {self.walk_forward.task_time:.1f} seconds', pre_creturn=1)
+                    success = True
+                else:
+                    ui.print_error(self.walk_forward.task_state)
+
+        return success
+
     def refresh_screen(self) -> None:
         self.run_screen(False)
 
@@ -497,13 +553,26 @@ class Interface:
 
     def run_support_resistance(self, tickers: list[str]) -> None:
         if tickers:
-            for ticker in tickers:
-                if self.quick:
-                    self.trend = SupportResistance(ticker, days=self.days)
-                else:
-                    methods = ['NSQUREDLOGN', 'NCUBED', 'HOUGHLINES', 'PROBHOUGH']
-                    extmethods = ['NAIVE', 'NAIVECONSEC', 'NUMDIFF']
-                    self.trend = SupportResistance(ticker, methods=methods, extmethods=extmethods, days=self.days)
+            if self.quick:
+                methods = ['NATIVE']
+                extmethods = ['NUMDIFF']
+            else:
+                methods = ['NSQUREDLOGN', 'NCUBED', 'HOUGHLINES', 'PROBHOUGH']
+                extmethods = ['NAIVE', 'NAIVECONSEC', 'NUMDIFF']
+
+            if len(tickers) > 1:
+                # All the tickers at once, with the extractions spread across processes
+                self.trends = SupportResistanceBatch(tickers, methods=methods, extmethods=extmethods, days=self.days)
+
+                self.task = threading.Thread(target=self.trends.calculate)
+                self.task.start()
+
+                # Show thread progress. Blocking while thread is active
+                self.show_progress_support_resistance_batch()
+
+                analyses = self.trends.task_object or []
+            else:
+                self.trend = SupportResistance(tickers[0], methods=methods, extmethods=extmethods, days=self.days)
 
                 # Start the working thread
                 self.task = threading.Thread(target=self.trend.calculate)
@@ -512,10 +581,14 @@ class Interface:
                 # Show thread progress. Blocking while thread is active
                 self.show_progress_support_resistance()
 
-                figure = self.trend.plot()
+                analyses = [self.trend] if self.trend.task_state == 'Done' else []
+
+            for analysis in analyses:
+                figure = analysis.plot()
                 plt.figure(figure)
 
-            plt.show()
+            if analyses:
+                plt.show()
         else:
             ui.print_error('No valid results to analyze')
 
@@ -593,6 +666,19 @@ class Interface:
                 ui.print_message('Backtest Errors', post_creturn=1)
                 print(tabulate(errors, headers=headers, tablefmt=ui.TABULATE_FORMAT, floatfmt='.2f'))
 
+    def show_walk_forward(self) -> None:
+        if self.walk_forward is None or self.walk_forward.results.empty:
+            ui.print_message('No results were located')
+        else:
+            wf = self.walk_forward
+            ui.print_message(f'Walk-Forward Results ({wf.screen.title()}, {wf.period} days, {wf.horizon} day hold): '
+                             f'Signals = {wf.task_success}, Hit Rate = {wf.hit_rate*100:.2f}%, Return = {wf.return_mean*100:.2f}%', post_creturn=1)
+
+            results = wf.results.copy()
+            results['date'] = pd.to_datetime(results['date']).dt.strftime(ui.DATE_FORMAT_YMD)
+            headers = ui.format_headers(results.columns)
+            print(tabulate(results, headers=headers, tablefmt=ui.TABULATE_FORMAT, floatfmt='.3f', showindex=False))
+
     def m_show_chart(self) -> None:
         ticker = ui.input_table(ticker=True).upper()
         if ticker:
@@ -628,6 +714,29 @@ class Interface:
         else:
             ui.print_message('No significant correlations found')
 
+    def show_correlation_clusters(self) -> None:
+        clusters = self.correlate.clusters
+        if not clusters.empty:
+            summary = clusters.groupby('cluster', sort=False)['ticker'].agg(['count', lambda tickers: ' '.join(tickers.head(LISTTOP_CORR))])
+            summary.columns = ['count', 'tickers']
+            summary = summary.reset_index()
+            headers = ui.format_headers(summary.columns)
+            ui.print_message(f'Correlation Clusters ({len(summary)})', post_creturn=1)
+            print(tabulate(summary, headers=headers, tablefmt=ui.TABULATE_FORMAT, showindex=False))
+        else:
+            ui.print_message('No clusters found')
+
+    def show_rolling_correlation(self) -> None:
+        rolling = self.correlate.rolling
+        if not rolling.empty:
+            rolling = rolling.copy()
+            rolling['date'] = pd.to_datetime(rolling['date']).dt.strftime(ui.DATE_FORMAT_YMD)
+            headers = ui.format_headers(rolling.columns)
+            ui.print_message('Rolling Correlation of Screened Symbols', post_creturn=1)
+            print(tabulate(rolling.tail(LISTTOP_ANALYSIS), headers=headers, tablefmt=ui.TABULATE_FORMAT, floatfmt='.4f', showindex=False))
+        else:
+            ui.print_message('Not enough history for a rolling correlation')
+
     def show_progress_screen(self) -> None:
         print()
         while not self.screener.task_state:
@@ -707,8 +816,33 @@ class Interface:
 
         print()
 
+    def show_progress_support_resistance_batch(self) -> None:
+        print()
+        while not self.trends.task_state:
+            pass
+
+        if self.trends.task_state == 'None':
+            prefix = 'Analyzing S & R'
+            ui.progress_bar(0, 0, prefix=prefix, reset=True)
+
+            while self.task.is_alive() and self.trends.task_state == 'None':
+                time.sleep(ui.PROGRESS_SLEEP)
+                total = self.trends.task_total
+                completed = self.trends.task_completed
+                ticker = self.trends.task_ticker
+                ui.progress_bar(completed, total, prefix=prefix, ticker=ticker, suffix=self.trends.task_message)
+
+            if self.trends.task_state == 'Done':
+                ui.print_message(f'{self.trends.task_success} tickers analyzed in {self.trends.task_time:.1f} seconds '
+                                 f'({self.trends.task_counter} of {self.trends.task_total} extractions cached)', pre_creturn=2)
+        else:
+            ui.print_message(f'{self.trends.task_state}')
+
+        print()
+
     def show_progress_correlate(self) -> None:
         print()
+        completed = 0
         while not self.correlate.task_state:
             pass
 
@@ -745,6 +879,21 @@ class Interface:
 
             print()
 
+    def show_progress_walk_forward(self) -> None:
+        print()
+        while not self.walk_forward.task_state:
+            pass
+
+        if self.walk_forward.task_state == 'None':
+            prefix = f'Backtesting {self.table}/{self.screen.title()}'
+            ui.progress_bar(self.walk_forward.task_completed, self.walk_forward.task_total, prefix=prefix, reset=True)
+
+            while self.task.is_alive() and self.walk_forward.task_state == 'None':
+                time.sleep(ui.PROGRESS_SLEEP)
+                ui.progress_bar(self.walk_forward.task_completed, self.walk_forward.task_total, prefix=prefix)
+
+        print()
+
     def show_progress_chart(self) -> None:
         print()
         while not self.chart.task_state:
@@ -1,4 +1,5 @@
 import datetime as dt
+import json
 import logging
 import webbrowser
 
@@ -8,10 +9,10 @@ from tabulate import tabulate
 
 import etrade.auth as auth
 from etrade.accounts import Accounts
-from etrade.quotes import Quotes
 from etrade.options import Options
 from etrade.lookup import Lookup
 from etrade.alerts import Alerts
+from fetcher import aio
 from utils import math as m
 from utils import ui, logger
 
@@ -174,17 +175,17 @@ class Client:
             ui.print_error(f'No information for {ticker} located')
 
     def m_show_quotes(self) -> None:
-        quotes = Quotes()
-
         if not self.quote:
             tickers = ui.input_list('Please enter symbols separated with commas').upper()
         else:
             tickers = self.quote
 
         self.quote = ''
-        quote_data = quotes.quote(tickers.split(','))
 
-        if quotes.message == 'success':
+        # Fetched 25 symbols per request (the E*Trade limit), with the requests overlapping
+        quote_data = aio.get_quotes([ticker for ticker in tickers.split(',') if ticker])
+
+        if quote_data:
             ui.print_message('Quotes', pre_creturn=1, post_creturn=1)
             for quote in quote_data:
                 if quote is not None:
@@ -204,10 +205,10 @@ class Client:
                     print()
 
             if ui.input_yesno('Show JSON'):
-                print(quotes.raw)
+                print(json.dumps(quote_data, indent=2, sort_keys=True))
 
         else:
-            ui.print_error(quotes.message)
+            ui.print_error('No quotes returned')
 
     def m_show_options_expiry(self) -> None:
         ticker = ui.input_text('Please enter ticker').upper()
@@ -233,33 +234,28 @@ class Client:
                 print(options.raw)
 
     def m_show_options_chain(self) -> None:
-        ticker = ui.input_text('Please enter ticker').upper()
+        tickers = ui.input_list('Please enter tickers separated with commas').upper()
 
+        # The chains of all the tickers are fetched at once
         date = m.third_friday()
-        options = Options()
-        chain = options.chain(ticker, date.month, date.year)
-
-        if 'error' in options.message.lower():
-            message = options.message.replace('Error ', '')
-            message = message.replace('\n', '')
-            ui.print_error(message)
-        elif chain is None:
-            message = options.message.replace('Error ', '')
-            message = message.replace('\n', '')
-            ui.print_error(message)
-        else:
-            order = [
-                'symbol',
-                'type',
-                'strikePrice',
-                'lastPrice',
-                'inTheMoney',
-                'volume',
-            ]
+        chains = aio.get_etrade_chains([ticker for ticker in tickers.split(',') if ticker], date.month, date.year)
+
+        if not chains:
+            ui.print_error('No option chains returned')
+
+        order = [
+            'symbol',
+            'type',
+            'strikePrice',
+            'lastPrice',
+            'inTheMoney',
+            'volume',
+        ]
 
+        for ticker, chain in chains.items():
             chain = chain.reindex(columns=order)
 
-            ui.print_message('Options Chain', post_creturn=1)
+            ui.print_message(f'Options Chain ({ticker})', post_creturn=1)
             chain_calls = chain[chain['type'] == 'call']
             print(tabulate(chain_calls, headers=chain_calls.columns, tablefmt=ui.TABULATE_FORMAT, floatfmt='.02f'))
 
@@ -268,9 +264,6 @@ class Client:
             print(tabulate(chain_puts, headers=chain_puts.columns, tablefmt=ui.TABULATE_FORMAT, floatfmt='.02f'))
             print()
 
-            if ui.input_yesno('Show JSON'):
-                print(options.raw)
-
 
 def main():
     parser = argparse.ArgumentParser(description='Database Management')
@@ -11,7 +11,7 @@ from matplotlib.widgets import Cursor
 from tabulate import tabulate
 
 from analysis.chart import Chart
-from analysis.gap import Gap
+from analysis.gap import Gap, fill_statistics
 from data import store as store
 from utils import logger, ui
 
@@ -47,7 +47,8 @@ class Interface:
             {'menu': 'Calculate & Analyze', 'function': self.m_calculate, 'condition': '', 'value': ''},
             {'menu': 'Show Results', 'function': self.m_show_results, 'condition': 'not self.dirty', 'value': 'str(len(self.gap.results))'},
             {'menu': 'Show Analysis', 'function': self.m_show_analysis, 'condition': 'not self.dirty', 'value': 'str(len(self.gap.analysis))'},
-            {'menu': 'Show Plot', 'function': self.m_show_plot, 'condition': '', 'value': ''}
+            {'menu': 'Show Plot', 'function': self.m_show_plot, 'condition': '', 'value': ''},
+            {'menu': 'Show Fill Statistics', 'function': self.m_show_statistics, 'condition': '', 'value': ''}
         ]
 
         # Create the menu
@@ -214,6 +215,24 @@ class Interface:
         else:
             ui.print_error(f'No gaps', post_creturn=1)
 
+    def m_show_statistics(self) -> None:
+        if self.tickers:
+            value = ui.input_text("Group by ticker, sector or size ('t', 's', or 'z') or 'x' to cancel", valids=['t', 's', 'z', 'x'], default='z')
+            if value != 'x':
+                by = {'t': ('ticker',), 's': ('sector', 'size'), 'z': ('size', 'direction')}[value]
+
+                # From the gap index, so only the tickers the database manager has indexed
+                gaps = store.get_gaps(self.tickers)
+                if gaps.empty:
+                    ui.print_error('No gaps indexed. Update the gap index from the database manager', post_creturn=1)
+                else:
+                    statistics = fill_statistics(gaps, by=by)
+                    ui.print_message(f'Fill Statistics ({len(gaps)} gaps)', pre_creturn=1, post_creturn=1)
+                    headers = ui.format_headers(statistics.columns, case='title')
+                    print(tabulate(statistics, headers=headers, tablefmt=ui.TABULATE_FORMAT, floatfmt='.2f'))
+        else:
+            ui.print_error('Enter a ticker or list first', post_creturn=1)
+
     def show_progress(self) -> None:
         while not self.gap.task_state:
             pass
@@ -9,6 +9,7 @@ import argparse
 import data as d
 from data import store as store
 from data import manager as manager
+from analysis.correlate import Correlate
 from utils import ui, logger
 
 
@@ -76,6 +77,7 @@ class Interface:
             {'menu': 'Ticker Information (previous)', 'function': self.m_show_ticker_information, 'params': 'self.ticker, prompt=True', 'condition': 'True', 'value': ''},
             {'menu': 'Update History', 'function': self.m_update_history, 'params': '', 'condition': '', 'value': ''},
             {'menu': 'Update Company', 'function': self.m_update_company, 'params': '', 'condition': '', 'value': ''},
+            {'menu': 'Update Gap Index', 'function': self.m_update_gaps, 'params': '', 'condition': '', 'value': ''},
             {'menu': 'Check Integrity', 'function': self.m_check_integrity, 'params': '', 'condition': '', 'value': ''},
             {'menu': 'Re-Check Inactive', 'function': self.m_recheck_inactive, 'params': '', 'condition': '', 'value': ''},
             {'menu': 'Mark Active/Inactive', 'function': self.m_change_active, 'params': '', 'condition': '', 'value': ''},
@@ -272,11 +274,44 @@ class Interface:
                 ui.print_message(f'{self.manager.task_total} tickers refreshed in {self.manager.task_time:.0f} seconds.')
                 ui.print_message(f'{self.manager.task_counter} pricing records added.')
 
+                # Add the new days to the exchange's running correlation and to the gap index
+                if store.is_exchange(table):
+                    self.update_correlation(table)
+
+                self.m_update_gaps(table)
+
                 if not self.stop and len(self.manager.invalid_tickers) > 0:
                     if ui.input_yesno('Show unsuccessful tickers?'):
                         ui.print_message(f'{len(self.manager.invalid_tickers)} unsuccessful tickers')
                         ui.print_tickers(self.manager.invalid_tickers)
 
+    def update_correlation(self, exchange: str) -> None:
+        tickers = store.get_exchange_tickers(exchange)
+        if tickers:
+            correlate = Correlate(tickers, exchange)
+            correlate.update()
+
+            if correlate.task_state == 'Done':
+                ui.print_message(f'{exchange.upper()} correlation updated with {correlate.task_success} day(s) in {correlate.task_time:.0f} seconds')
+            else:
+                ui.print_error(correlate.task_state)
+
+    def m_update_gaps(self, table: str = '') -> None:
+        if not table:
+            table = ui.input_table(exchange=True, index=True, all=True)
+
+        if table:
+            self.task = threading.Thread(target=self.manager.update_gaps, args=[table])
+            self.task.start()
+
+            # Show thread progress. Blocking while thread is active
+            self.show_progress()
+
+            if self.manager.task_state == 'Done':
+                ui.print_message(f'{self.manager.task_counter} gaps added to the index for {self.manager.task_success} tickers in {self.manager.task_time:.0f} seconds')
+        else:
+            ui.print_message('Invalid table')
+
     def m_update_company(self, ticker: str = '') -> None:
         table = ui.input_table(exchange=True, ticker=True, all=True)
 
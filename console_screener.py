@@ -7,7 +7,7 @@ import argparse
 
 import data as d
 import screener.screener as screener
-from screener.screener import Screener, Result
+from screener.screener import Screener, Result, PROCESS_AUTO
 from data import store as store
 from utils import ui, logger
 
@@ -16,11 +16,14 @@ logger.get_logger(logging.WARNING, logfile='')
 
 
 class Interface:
-    def __init__(self, table: str = '', screen: str = '', backtest: int = 0, exit: bool = False, live: bool = False):
+    def __init__(self, table: str = '', screen: str = '', backtest: int = 0, exit: bool = False, live: bool = False,
+                 short_circuit: bool = False, processes: int = 0):
         self.table = table.upper()
         self.screen = screen
         self.exit = exit
         self.live = live if store.is_database_connected() else True
+        self.short_circuit = short_circuit
+        self.processes = processes
         self.auto = False
         self.valids: list[Result] = []
         self.commands: list[dict] = []
@@ -159,7 +162,8 @@ class Interface:
                 self.live = False
 
             try:
-                self.screener = Screener(self.table, screen=self.screen, backtest=self.backtest, live=self.live)
+                self.screener = Screener(self.table, screen=self.screen, backtest=self.backtest, live=self.live,
+                                         short_circuit=self.short_circuit, processes=self.processes)
             except ValueError as e:
                 ui.print_error(f'{__name__}: {str(e)}')
             else:
@@ -304,6 +308,9 @@ def main():
     parser.add_argument('-s', '--screen', help='Specify a screening script', metavar='screen', required=False, default='')
     parser.add_argument('-b', '--backtest', help='Run a backtest (only valid with -t and -s)', required=False, default=0)
     parser.add_argument('-x', '--exit', help='Run the script and quit (only valid with -t and -s) then exit', action='store_true')
+    parser.add_argument('-f', '--fast', help='Stop screening each symbol at its first failed filter', action='store_true')
+    parser.add_argument('-p', '--processes', help='Screen with this many worker processes (default is one per core for large tables only)',
+                        metavar='processes', nargs='?', type=int, const=PROCESS_AUTO, default=0)
 
     command = vars(parser.parse_args())
     table = ''
@@ -316,9 +323,10 @@ def main():
         screen = command['screen']
 
     if screen and table and command['exit']:
-        Interface(table, screen, backtest=int(command['backtest']), exit=True)
+        Interface(table, screen, backtest=int(command['backtest']), exit=True, short_circuit=command['fast'],
+                  processes=command['processes'])
     else:
-        Interface(table, screen, backtest=int(command['backtest']))
+        Interface(table, screen, backtest=int(command['backtest']), short_circuit=command['fast'], processes=command['processes'])
 
 
 if __name__ == '__main__':
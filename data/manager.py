@@ -1,13 +1,16 @@
 import time
 import random
+import threading
 import datetime as dt
 from pathlib import Path
 from concurrent import futures
 from urllib.error import HTTPError
 
-from sqlalchemy import create_engine, inspect, and_, or_
+from sqlalchemy import create_engine, inspect, bindparam, func, and_, or_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import numpy as np
 import pandas as pd
 
@@ -15,6 +18,8 @@ from base import Threaded
 import data as d
 from data import store as store
 from data import models as models
+from analysis import gap as gap
+from fetcher import aio
 from utils import ui, logger
 
 _logger = logger.get_logger()
@@ -22,6 +27,12 @@ _logger = logger.get_logger()
 LOG_DIR = './log'
 LOG_SUFFIX = 'log'
 
+BULK_BATCH_SIZE = 5000  # Price rows per bulk insert statement
+QUERY_CHUNK_SIZE = 500  # Tickers per IN clause
+UPDATE_DAYS = 60        # Days of live history fetched for updates. Change value if severely out of date
+UPDATE_BATCH_SIZE = 50  # Tickers per batched live history download
+GAP_MARGIN_DAYS = 7     # Calendar days of history loaded before the last bar scanned for gaps
+
 
 class Manager(Threaded):
     def __init__(self):
@@ -30,6 +41,9 @@ class Manager(Threaded):
         self.exchange = ''
         self.invalid_tickers = []
         self.retry = 0
+        self._pending: list[dict] = []
+        self._pending_lock = threading.Lock()
+        self._batching = False
 
         if d.ACTIVE_URI:
             self.engine = create_engine(d.ACTIVE_URI, echo=False)
@@ -276,17 +290,20 @@ class Manager(Threaded):
 
         self.task_state = 'Done'
 
-    def update_history_ticker(self, ticker: str, inactive: bool = False) -> int:
+    def update_history_ticker(self, ticker: str, inactive: bool = False, last: tuple[int, dt.date | None] | None = None,
+                              history: pd.DataFrame | None = None) -> int:
         ticker = ticker.upper()
         days = -1
 
-        if store.is_ticker(ticker, inactive):
+        # Use the security id and last price date if already known (ex: from an exchange update)
+        if last is None:
+            last = self.get_last_price_dates([ticker], inactive=inactive).get(ticker)
+
+        if last is not None:
             today = dt.date.today()
+            security_id, date_db = last
 
-            history = store.get_history(ticker, inactive=inactive)
-            if history is None:
-                _logger.error(f'{__name__}: \'None\' object for {ticker} (2)')
-            elif history.empty:
+            if date_db is None:
                 if self._add_live_history_to_ticker(ticker):
                     _logger.info(f'{__name__}: Added full price history for {ticker}')
 
@@ -294,14 +311,11 @@ class Manager(Threaded):
                 else:
                     _logger.warning(f'{__name__}: No price history for {ticker}')
             else:
-                date_db = history.iloc[-1]['date']
-                if date_db is None:
-                    date_db = today - dt.date(2000, 1, 1)
-                    _logger.warning(f'{__name__}: No price history for {ticker} in database')
-
                 delta = (today - date_db).days
                 if delta > 0:
-                    history = store.get_history(ticker, days=60, live=True)  # Change days value if severely out of data
+                    if history is None:
+                        history = store.get_history(ticker, days=UPDATE_DAYS, live=True)
+
                     if history is None:
                         _logger.error(f'{__name__}: \'None\' object for {ticker} (3)')
                     elif history.empty:
@@ -314,27 +328,14 @@ class Manager(Threaded):
                         _logger.info(f'{__name__}: {date_cloud:%Y-%m-%d} - {date_db:%Y-%m-%d} = {delta} days')
                         if delta > 0:
                             days = delta
-                            history = history[-delta:]
-                            history = history.reset_index()
-
-                            with self.session.begin() as session:
-                                t = session.query(models.Security).filter(models.Security.ticker == ticker).one()
-
-                                # Add any newer price records
-                                for price in history.itertuples():
-                                    date = price.date.to_pydatetime().date()
-                                    if date > date_db:
-                                        q = session.query(models.Price.date).filter(and_(models.Price.security_id == t.id, models.Price.date == date)).one_or_none()
-                                        if q is None:
-                                            p = models.Price()
-                                            p.date = date
-                                            p.open = price.open
-                                            p.high = price.high
-                                            p.low = price.low
-                                            p.close = price.close
-                                            p.volume = price.volume
-
-                                            t.pricing += [p]
+
+                            # Add any newer price records. Existing dates are skipped by the upsert
+                            history = history.assign(date=pd.to_datetime(history['date']).dt.date)
+                            history = history[history['date'] > date_db]
+                            history = history.reindex(columns=['date', 'open', 'high', 'low', 'close', 'volume'])
+                            history = history.astype({'open': float, 'high': float, 'low': float, 'close': float, 'volume': float})
+                            history['security_id'] = security_id
+                            self._write_prices(history.to_dict('records'))
 
                             _logger.info(f'{__name__}: Updated {days} days pricing for {ticker} to {date_cloud:%Y-%m-%d}')
                         else:
@@ -356,13 +357,17 @@ class Manager(Threaded):
 
         def update(tickers: list[str]) -> None:
             for ticker in tickers:
+                # Tickers the batches missed fall back to a single ticker live fetch
+                history = histories.pop(ticker, None)
+                if history is not None and history.empty:
+                    history = None
+
                 tic = time.perf_counter()
                 self.task_ticker = ticker
                 days = -1
 
                 try:
-                    time.sleep(0.05)
-                    days = self.update_history_ticker(ticker)
+                    days = self.update_history_ticker(ticker, last=last_dates.get(ticker), history=history)
                 except IntegrityError as e:
                     _logger.error(f'{__name__}: IntegrityError exception occurred for {ticker} (1): {e.__cause__}')
                 except Exception as e:
@@ -384,23 +389,202 @@ class Manager(Threaded):
         if self.task_total > 0:
             self.task_state = 'None'
 
-            with futures.ThreadPoolExecutor(max_workers=self._concurrency) as executor:
-                if self._concurrency > 1:
-                    random.shuffle(tickers)
-                    lists = np.array_split(tickers, self._concurrency)
-                    lists = [item.tolist() for item in lists if item.size > 0]
-                    self.task_futures = [executor.submit(update, item) for item in lists]
-                else:
-                    self.task_futures = [executor.submit(update, tickers)]
+            # One query for the last price date of every ticker, and batch the new rows across tickers
+            last_dates = self.get_last_price_dates(tickers)
+
+            # The recent history of the tickers already in the database, downloaded in batches that overlap
+            today = dt.date.today()
+            current = [ticker for ticker in tickers if ticker in last_dates and last_dates[ticker][1] is not None and last_dates[ticker][1] < today]
+            histories = {}
+            if current and store.is_live_connection():
+                try:
+                    histories = aio.get_histories(current, days=UPDATE_DAYS)
+                except Exception as e:
+                    _logger.error(f'{__name__}: Exception fetching batch history: {e}')
+
+            self._batching = True
+
+            try:
+                with futures.ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+                    if self._concurrency > 1:
+                        random.shuffle(tickers)
+                        lists = np.array_split(tickers, self._concurrency)
+                        lists = [item.tolist() for item in lists if item.size > 0]
+                        self.task_futures = [executor.submit(update, item) for item in lists]
+                    else:
+                        self.task_futures = [executor.submit(update, tickers)]
+
+                    for future in futures.as_completed(self.task_futures):
+                        running -= 1
+                        _logger.info(f'{__name__}: Thread completed: {future.result()}. {running} threads remaining')
+            finally:
+                self._batching = False
+                self._flush_prices()
 
-                for future in futures.as_completed(self.task_futures):
-                    running -= 1
-                    _logger.info(f'{__name__}: Thread completed: {future.result()}. {running} threads remaining')
         if log:
             _write_tickers_log(self.invalid_tickers)
 
         self.task_state = 'Done'
 
+    def get_last_price_dates(self, tickers: list[str], inactive: bool = False) -> dict[str, tuple[int, dt.date | None]]:
+        last_dates = {}
+
+        with self.session() as session:
+            for n in range(0, len(tickers), QUERY_CHUNK_SIZE):
+                chunk = [ticker.upper() for ticker in tickers[n:n+QUERY_CHUNK_SIZE]]
+                q = session.query(models.Security.ticker, models.Security.id, func.max(models.Price.date)).outerjoin(
+                    models.Price, models.Price.security_id == models.Security.id)
+
+                if inactive:
+                    q = q.filter(models.Security.ticker.in_(chunk))
+                else:
+                    q = q.filter(and_(models.Security.ticker.in_(chunk), models.Security.active))
+
+                q = q.group_by(models.Security.ticker, models.Security.id)
+                last_dates.update({ticker: (id, date) for ticker, id, date in q.all()})
+
+        _logger.debug(f'{__name__}: Fetched last price dates for {len(last_dates)} tickers')
+
+        return last_dates
+
+    @Threaded.threaded
+    def update_gaps(self, table: str) -> None:
+        # Add the gaps in the bars since each ticker was last scanned to the gap index, and record the fills
+        # of gaps still open. Tickers never scanned are done separately as they need their full history
+        tickers = store.get_tickers(table)
+        self.task_total = len(tickers)
+
+        if self.task_total > 0:
+            self.task_state = 'None'
+            models.Base.metadata.create_all(self.engine, tables=[models.Gap.__table__, models.GapScan.__table__])
+
+            scans = self.get_gap_scans(tickers)
+            unscanned = [ticker for ticker in tickers if ticker in scans and scans[ticker][1] is None]
+            scanned = [ticker for ticker in tickers if ticker in scans and scans[ticker][1] is not None]
+            self.task_completed = self.task_total - len(unscanned) - len(scanned)
+
+            for group in (unscanned, scanned):
+                for n in range(0, len(group), QUERY_CHUNK_SIZE):
+                    chunk = group[n:n+QUERY_CHUNK_SIZE]
+                    self.task_ticker = chunk[0]
+
+                    try:
+                        self.task_counter += self._update_gaps({ticker: scans[ticker] for ticker in chunk})
+                        self.task_success += len(chunk)
+                    except Exception as e:
+                        _logger.error(f'{__name__}: Exception updating gaps for chunk starting with {chunk[0]}: {e}')
+
+                    self.task_completed += len(chunk)
+
+            _logger.info(f'{__name__}: Added {self.task_counter} gaps for {self.task_success} tickers')
+
+        self.task_state = 'Done'
+
+    def get_gap_scans(self, tickers: list[str]) -> dict[str, tuple[int, dt.date | None, int | None, int]]:
+        # Security id, last date scanned for gaps, bars scanned and number of gaps still open for each active ticker
+        scans = {}
+
+        with self.session() as session:
+            for n in range(0, len(tickers), QUERY_CHUNK_SIZE):
+                chunk = [ticker.upper() for ticker in tickers[n:n+QUERY_CHUNK_SIZE]]
+                q = session.query(models.Security.ticker, models.Security.id, models.GapScan.date, models.GapScan.bars, func.count(models.Gap.id)) \
+                    .outerjoin(models.GapScan, models.GapScan.security_id == models.Security.id) \
+                    .outerjoin(models.Gap, and_(models.Gap.security_id == models.Security.id, models.Gap.fill_date.is_(None))) \
+                    .filter(and_(models.Security.ticker.in_(chunk), models.Security.active)) \
+                    .group_by(models.Security.ticker, models.Security.id, models.GapScan.date, models.GapScan.bars)
+
+                scans.update({ticker: (id, scanned, bars, opened) for ticker, id, scanned, bars, opened in q.all()})
+
+        return scans
+
+    def _update_gaps(self, scans: dict[str, tuple[int, dt.date | None, int | None, int]]) -> int:
+        tickers = list(scans)
+
+        # Only the bars since the last scan, and the few before it that new gaps at the start gap from
+        scan_dates = [scan[1] for scan in scans.values()]
+        days = -1 if None in scan_dates else (dt.date.today() - min(scan_dates)).days + GAP_MARGIN_DAYS
+        panel = store.get_history_panel(tickers, days=days)
+        dates = pd.DatetimeIndex(pd.to_datetime(panel.dates)).date
+
+        # Bar numbers carry on from the bars already scanned
+        first = {ticker: bars - int(panel.valid[dates <= last_scan, panel.index[ticker]].sum())
+                 for ticker, (_, last_scan, bars, _) in scans.items() if last_scan is not None and ticker in panel}
+
+        # New gaps, after the last bar scanned
+        frames = []
+        for ticker, results in gap.find_gaps_panel(panel, tickers, gap.THRESHOLD).items():
+            scan_date = scans[ticker][1]
+            if scan_date is not None:
+                results = results[pd.to_datetime(results['date']) > pd.Timestamp(scan_date)]
+
+            frames.append(results.assign(ticker=ticker)[['ticker', 'date', 'start', 'gap']])
+
+        added = gap.find_fills(panel, pd.concat(frames, ignore_index=True), first) if frames else pd.DataFrame()
+
+        # Gaps that were open as of the last scan, searched only over the bars since
+        opened = self._get_open_gaps([id for id, _, _, opened in scans.values() if opened > 0])
+        filled = pd.DataFrame()
+        if not opened.empty:
+            opened['after'] = opened['ticker'].map({ticker: scan[1] for ticker, scan in scans.items()})
+            filled = gap.find_fills(panel, opened, first)
+            filled = filled[filled['fill_date'].notna()]
+
+        records = [{
+            'date': pd.Timestamp(row.date).date(),
+            'start': row.start,
+            'gap': row.gap,
+            'relative': abs(row.gap) / row.start,
+            'fill_date': row.fill_date,
+            'fill_bars': None if np.isnan(row.fill_bars) else int(row.fill_bars),
+            'bar': int(row.bar),
+            'security_id': scans[row.ticker][0]} for row in added.itertuples()]
+
+        fills = [{'gap_id': row.id, 'filled': row.fill_date, 'bars': int(row.fill_bars)} for row in filled.itertuples()]
+
+        # Each ticker's last bar and bar count, where the next scan picks up
+        last = []
+        for ticker in tickers:
+            valid = panel.valid[:, panel.index[ticker]] if ticker in panel else np.array([], dtype=bool)
+            if valid.any():
+                last.append({'security_id': scans[ticker][0], 'date': dates[valid][-1], 'bars': first.get(ticker, 0) + int(valid.sum())})
+
+        insert = postgres_insert if d.ACTIVE_DB == d.VALID_DBS[1] else sqlite_insert
+
+        # One transaction, so the index never holds gaps past its scan dates
+        with self.engine.begin() as connection:
+            if records:
+                statement = insert(models.Gap.__table__).on_conflict_do_nothing(index_elements=['date', 'security_id'])
+                connection.execute(statement, records)
+
+            if fills:
+                statement = models.Gap.__table__.update() \
+                    .where(models.Gap.id == bindparam('gap_id')) \
+                    .values(fill_date=bindparam('filled'), fill_bars=bindparam('bars'))
+                connection.execute(statement, fills)
+
+            if last:
+                statement = insert(models.GapScan.__table__)
+                statement = statement.on_conflict_do_update(index_elements=['security_id'], set_={'date': statement.excluded.date, 'bars': statement.excluded.bars})
+                connection.execute(statement, last)
+
+        _logger.info(f'{__name__}: Added {len(records)} gaps and {len(fills)} fills for {len(tickers)} tickers')
+
+        return len(records)
+
+    def _get_open_gaps(self, security_ids: list[int]) -> pd.DataFrame:
+        frames = []
+
+        with self.session() as session:
+            for n in range(0, len(security_ids), QUERY_CHUNK_SIZE):
+                chunk = security_ids[n:n+QUERY_CHUNK_SIZE]
+                q = session.query(models.Gap.id, models.Security.ticker, models.Gap.date, models.Gap.start, models.Gap.gap, models.Gap.bar) \
+                    .join(models.Security, models.Security.id == models.Gap.security_id) \
+                    .filter(and_(models.Gap.security_id.in_(chunk), models.Gap.fill_date.is_(None)))
+
+                frames.append(pd.read_sql(q.statement, self.engine))
+
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
     def delete_database(self, recreate: bool = False):
         if d.ACTIVE_DB == d.VALID_DBS[1]: # Postfres
             models.Base.metadata.drop_all(self.engine)
@@ -495,9 +679,9 @@ class Manager(Threaded):
 
         if (len(tables) > 0):
             with self.session() as session:
-                tables = models.Base.metadata.tables
-                for table in tables:
-                    count = session.query(tables[table]).count()
+                # Tables added since the database was created (ex: the gap index) may not exist yet
+                for table in [table for table in models.Base.metadata.tables if table in tables]:
+                    count = session.query(models.Base.metadata.tables[table]).count()
                     info.append({'table': table, 'count': count})
         else:
             _logger.warning('{__name__}: No tables in database')
@@ -857,6 +1041,38 @@ class Manager(Threaded):
                 _logger.info(f'{__name__}: Added {t} to index {index}')
 
 
+    def _write_prices(self, prices: list[dict]) -> None:
+        if self._batching:
+            with self._pending_lock:
+                self._pending += prices
+                flush = len(self._pending) >= BULK_BATCH_SIZE
+
+            if flush:
+                self._flush_prices()
+        elif prices:
+            self._insert_prices(prices)
+
+    def _flush_prices(self) -> None:
+        with self._pending_lock:
+            prices = self._pending
+            self._pending = []
+
+        if prices:
+            self._insert_prices(prices)
+
+    def _insert_prices(self, prices: list[dict]) -> int:
+        insert = postgres_insert if d.ACTIVE_DB == d.VALID_DBS[1] else sqlite_insert
+
+        with self.engine.begin() as connection:
+            for n in range(0, len(prices), BULK_BATCH_SIZE):
+                statement = insert(models.Price.__table__).on_conflict_do_nothing(index_elements=['date', 'security_id'])
+                connection.execute(statement, prices[n:n+BULK_BATCH_SIZE])
+
+        _logger.info(f'{__name__}: Inserted up to {len(prices)} price records')
+
+        return len(prices)
+
+
 def _write_tickers_log(tickers: list[str], filename: str = '') -> str:
     if tickers:
         date_time = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
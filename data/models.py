@@ -106,3 +106,37 @@ class Price(Base):
 
     def __str__(self):
         return f'{self.date}: {self.security_id}'
+
+
+class Gap(Base):
+    __tablename__ = 'gap'
+    __table_args__ = (UniqueConstraint('date', 'security_id', name='gap_date_id_uc'), )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    date = Column('date', Date, nullable=False)
+    start = Column('start', Float, nullable=False)
+    gap = Column('gap', Float, nullable=False)
+    relative = Column('relative', Float, nullable=False)
+    fill_date = Column('fill_date', Date)    # None while unfilled
+    fill_bars = Column('fill_bars', Integer) # Bars from the gap to the fill
+    bar = Column('bar', Integer, nullable=False)  # Number of the gap's bar in the ticker's history
+    security_id = Column(Integer, ForeignKey('security.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+
+    def __repr__(self):
+        return f'<Gap Model ({self.security_id})>'
+
+    def __str__(self):
+        return f'{self.date}: {self.security_id}'
+
+
+class GapScan(Base):
+    __tablename__ = 'gap_scan'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    date = Column('date', Date, nullable=False)  # Last bar scanned for gaps
+    bars = Column('bars', Integer, nullable=False)  # Bars scanned, up to and including the last
+    security_id = Column(Integer, ForeignKey('security.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f'<GapScan Model ({self.security_id})>'
+
+    def __str__(self):
+        return f'{self.date}: {self.security_id}'
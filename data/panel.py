@@ -0,0 +1,186 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from utils import logger
+
+_logger = logger.get_logger()
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+# Price history for many tickers as contiguous date x ticker arrays (oldest first) with a ticker index.
+# Values are forward filled after each ticker's first bar, so rows before it are NaN. The mask of
+# actual bars is kept so per-ticker histories can be recreated exactly
+class Panel:
+    def __init__(self, tickers: list[str], dates: np.ndarray, data: dict[str, np.ndarray], valid: np.ndarray):
+        if valid.shape != (len(dates), len(tickers)):
+            raise ValueError('Panel shape does not match tickers and dates')
+
+        self.tickers = list(tickers)
+        self.dates = dates
+        self.index = {ticker: n for n, ticker in enumerate(self.tickers)}
+        self.valid = valid
+        self.open = data['open']
+        self.high = data['high']
+        self.low = data['low']
+        self.close = data['close']
+        self.volume = data['volume']
+
+    def __repr__(self):
+        return f'<Panel ({len(self.dates)} dates x {len(self.tickers)} tickers)>'
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker.upper() in self.index
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, field).nbytes for field in FIELDS) + self.valid.nbytes + self.dates.nbytes
+
+    @classmethod
+    def from_records(cls, records: pd.DataFrame, tickers: list[str]) -> 'Panel':
+        # Long format records with ticker, date and price columns, as returned by a bulk query
+        tickers = [ticker.upper() for ticker in tickers]
+        index = {ticker: n for n, ticker in enumerate(tickers)}
+
+        records = records[records['ticker'].isin(list(index))]
+        dates, rows = np.unique(records['date'].to_numpy(), return_inverse=True)
+        columns = records['ticker'].map(index).to_numpy(dtype=int)
+
+        shape = (len(dates), len(tickers))
+        valid = np.zeros(shape, dtype=bool)
+        valid[rows, columns] = True
+
+        data = {}
+        for field in FIELDS:
+            array = np.full(shape, np.nan)
+            array[rows, columns] = records[field].to_numpy(dtype=float)
+            data[field] = _ffill(array)
+
+        return cls(tickers, dates, data, valid)
+
+    @classmethod
+    def from_histories(cls, histories: dict[str, pd.DataFrame], tickers: list[str] | None = None) -> 'Panel':
+        tickers = list(histories) if tickers is None else tickers
+        frames = [history.assign(ticker=ticker.upper()) for ticker, history in histories.items() if history is not None and not history.empty]
+        records = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ticker', 'date', *FIELDS])
+
+        return cls.from_records(records, tickers)
+
+    def truncate(self, end: int, start: int = 0) -> 'Panel':
+        # Panel without the first 'start' and last 'end' dates (views, not copies)
+        if end < 0:
+            raise ValueError('Invalid value for \'end\'')
+        if start < 0:
+            raise ValueError('Invalid value for \'start\'')
+        if end == 0 and start == 0:
+            return self
+
+        stop = max(len(self.dates) - end, 0)
+        start = min(start, stop)
+        data = {field: getattr(self, field)[start:stop] for field in FIELDS}
+
+        return Panel(self.tickers, self.dates[start:stop], data, self.valid[start:stop])
+
+    def get_history(self, ticker: str) -> pd.DataFrame:
+        # Same layout as store.get_history()
+        column = self.index[ticker.upper()]
+        rows = self.valid[:, column]
+
+        history = pd.DataFrame({'date': self.dates[rows]})
+        for field in FIELDS:
+            history[field] = getattr(self, field)[rows, column]
+
+        return history
+
+    def compact(self, columns: np.ndarray | None = None, end: bool = True) -> dict[str, np.ndarray]:
+        # Price arrays of each column's actual bars only, without the forward filled rows
+        columns = np.arange(len(self.tickers)) if columns is None else np.asarray(columns, dtype=int)
+        valid = self.valid[:, columns]
+
+        return {field: compact(getattr(self, field)[:, columns], valid, end=end) for field in FIELDS}
+
+    def get_last(self, field: str = 'close') -> np.ndarray:
+        array = getattr(self, field)
+        return array[-1] if len(array) > 0 else np.full(len(self.tickers), np.nan)
+
+    def share(self) -> tuple[dict, list[shared_memory.SharedMemory]]:
+        # Copy the arrays into shared memory once. The spec is small enough to send to other processes,
+        # which attach() to it without copying. The caller owns the blocks and must close and unlink them
+        spec = {'tickers': self.tickers, 'dates': self.dates, 'arrays': {}}
+        blocks = []
+        try:
+            for field in (*FIELDS, 'valid'):
+                array = getattr(self, field)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                spec['arrays'][field] = (block.name, array.shape, array.dtype.str)
+        except Exception:
+            release(blocks)
+            raise
+
+        return spec, blocks
+
+    @classmethod
+    def attach(cls, spec: dict) -> tuple['Panel', list[shared_memory.SharedMemory]]:
+        # Keep the returned blocks referenced for as long as the panel is used. Only the process that
+        # shared the panel tracks and unlinks the blocks
+        blocks = []
+        arrays = {}
+        for field, (name, shape, dtype) in spec['arrays'].items():
+            try:
+                block = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13 attaching always registers with the resource tracker, which worker
+                # processes share with their parent, so the parent's unlink still unregisters it
+                block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            arrays[field] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+        valid = arrays.pop('valid')
+        return cls(spec['tickers'], spec['dates'], arrays, valid), blocks
+
+
+def release(blocks: list[shared_memory.SharedMemory], unlink: bool = True) -> None:
+    # Unlink even if arrays still use a block, so it's never left to the resource tracker
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            _logger.debug(f'{__name__}: Shared block {block.name} still in use')
+
+        if unlink:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def compact(array: np.ndarray, valid: np.ndarray, end: bool = True) -> np.ndarray:
+    # Move each column's valid rows together, in order. Aligned to the last row (leading NaN) so row -n is
+    # each column's n-th last bar, or to the first row (trailing NaN) so row n is its n-th bar
+    lengths = valid.sum(axis=0)
+    count = int(lengths.max()) if lengths.size > 0 else 0
+    bars, owners = np.nonzero(valid)
+    positions = np.cumsum(valid, axis=0)[bars, owners] - 1
+    if end:
+        positions += count - lengths[owners]
+
+    compacted = np.full((count, array.shape[1]), np.nan)
+    compacted[positions, owners] = array[bars, owners]
+
+    return compacted
+
+
+def _ffill(array: np.ndarray) -> np.ndarray:
+    # Forward fill each column. Leading NaNs are left as they are
+    rows = np.where(np.isnan(array), 0, np.arange(array.shape[0])[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+
+    return np.ascontiguousarray(array[rows, np.arange(array.shape[1])])
@@ -1,8 +1,10 @@
 import datetime as dt
+import threading
 
 import pandas as pd
-from sqlalchemy import create_engine, and_, or_
-from sqlalchemy.orm import sessionmaker
+from cachetools import TTLCache
+from sqlalchemy import create_engine, inspect, func, and_, or_
+from sqlalchemy.orm import sessionmaker, joinedload
 
 import data as d
 from fetcher import fetcher as fetcher
@@ -10,6 +12,7 @@ from fetcher.google import Sheet
 from fetcher.google import Google
 from fetcher.excel import Excel
 from data import models as models
+from data.panel import Panel
 from utils import ui, logger
 
 
@@ -28,6 +31,15 @@ _master_indexes: dict = {
     # d.INDEXES[2]['abbreviation']: set()
 }
 
+# Company information shared across Company objects, populated by get_companies(). Keyed by (live, extra)
+# so live and database results (and entries with and without price record counts) are never mixed. Live
+# results expire, so a long session picks up changes from the provider
+_companies: dict[tuple[bool, bool], dict[str, dict]] = {}
+_companies_lock = threading.Lock()
+_COMPANIES_CHUNK = 500      # Keep IN clauses under the SQLite parameter limit
+_COMPANIES_LIVE_TTL = 600   # Secs before live company information is fetched again
+_COMPANIES_LIVE_SIZE = 5000
+
 if d.ACTIVE_DB == 'Postgres':
     _engine = create_engine(d.ACTIVE_URI, echo=False, pool_size=10, max_overflow=20)
     _session = sessionmaker(bind=_engine)
@@ -61,6 +73,26 @@ def is_ticker(ticker: str, inactive: bool = False) -> bool:
     return valid
 
 
+def get_invalid_tickers(tickers: list[str], inactive: bool = False) -> list[str]:
+    # Same check as is_ticker(), with one query per chunk of tickers
+    tickers = [ticker.upper() for ticker in tickers]
+
+    if _session is not None:
+        valid = set()
+        with _session() as session:
+            for n in range(0, len(tickers), _COMPANIES_CHUNK):
+                chunk = tickers[n:n+_COMPANIES_CHUNK]
+                q = session.query(models.Security.ticker).filter(models.Security.ticker.in_(chunk))
+                if not inactive:
+                    q = q.filter(models.Security.active)
+
+                valid.update(symbol[0] for symbol in q.all())
+    else:
+        valid = {ticker for ticker in tickers if fetcher.validate_ticker(ticker)}
+
+    return [ticker for ticker in tickers if ticker not in valid]
+
+
 def is_exchange(exchange: str) -> bool:
     exchange = exchange.upper()
 
@@ -277,6 +309,21 @@ def get_last_price(ticker: str) -> float:
     return price
 
 
+def get_database_revision(live: bool = False) -> str:
+    # Changes whenever new price history is added, so can be used to invalidate derived results
+    live = True if _session is None else live
+
+    if live:
+        revision = f'{d.ACTIVE_HISTORYDATASOURCE}:{dt.date.today():%Y-%m-%d}'
+    else:
+        with _session() as session:
+            last = session.query(func.max(models.Price.date)).scalar()
+
+        revision = f'{d.ACTIVE_DB}:{last:%Y-%m-%d}' if last is not None else f'{d.ACTIVE_DB}:'
+
+    return revision
+
+
 def get_history(ticker: str, days: int = -1, end: int = 0, live: bool = False, inactive: bool = False) -> pd.DataFrame:
     if end < 0:
         raise ValueError('Invalid value for \'end\'')
@@ -333,6 +380,98 @@ def get_history(ticker: str, days: int = -1, end: int = 0, live: bool = False, i
     return history
 
 
+def get_history_live_batch(tickers: list[str], days: int = -1) -> dict[str, pd.DataFrame]:
+    histories = fetcher.get_history_live_batch(tickers, days)
+    _logger.debug(f'{__name__}: Fetched live price history for {len(histories)} tickers')
+
+    return histories
+
+
+def get_history_panel(tickers: list[str], days: int = -1, live: bool = False, inactive: bool = False) -> Panel:
+    # Price history for all the tickers aligned into one panel, using one query per chunk of tickers
+    tickers = [ticker.upper() for ticker in tickers]
+    live = True if _session is None else live
+
+    if live:
+        panel = Panel.from_histories(get_history_live_batch(tickers, days), tickers)
+    else:
+        start = dt.datetime.today() - dt.timedelta(days=days) if days > 1 else None
+        frames = []
+
+        with _session() as session:
+            for n in range(0, len(tickers), _COMPANIES_CHUNK):
+                chunk = tickers[n:n+_COMPANIES_CHUNK]
+                q = session.query(
+                        models.Security.ticker,
+                        models.Price.date,
+                        models.Price.open,
+                        models.Price.high,
+                        models.Price.low,
+                        models.Price.close,
+                        models.Price.volume) \
+                    .join(models.Price, models.Price.security_id == models.Security.id) \
+                    .filter(models.Security.ticker.in_(chunk))
+
+                if not inactive:
+                    q = q.filter(models.Security.active)
+                if start is not None:
+                    q = q.filter(models.Price.date >= start)
+
+                frames.append(pd.read_sql(q.statement, _engine))
+
+        records = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        panel = Panel.from_records(records, tickers) if not records.empty else Panel.from_histories({}, tickers)
+
+    _logger.debug(f'{__name__}: Loaded {panel} ({panel.nbytes / 1e6:.1f} MB)')
+
+    return panel
+
+
+def get_gaps(tickers: list[str], filled: bool | None = None) -> pd.DataFrame:
+    # Gaps recorded in the gap index (see Manager.update_gaps()), with each ticker's sector and the
+    # last date it was scanned. Only available from the database
+    tickers = [ticker.upper() for ticker in tickers]
+    gaps = pd.DataFrame()
+
+    if _session is None:
+        _logger.warning(f'{__name__}: Gap index requires a database')
+    elif not inspect(_engine).has_table(models.Gap.__tablename__):
+        _logger.warning(f'{__name__}: No gap index in {d.ACTIVE_DB}')
+    else:
+        frames = []
+        with _session() as session:
+            for n in range(0, len(tickers), _COMPANIES_CHUNK):
+                chunk = tickers[n:n+_COMPANIES_CHUNK]
+                q = session.query(
+                        models.Security.ticker,
+                        models.Company.sector,
+                        models.Gap.date,
+                        models.Gap.start,
+                        models.Gap.gap,
+                        models.Gap.relative,
+                        models.Gap.fill_date,
+                        models.Gap.fill_bars,
+                        models.Gap.bar,
+                        models.GapScan.date.label('scanned'),
+                        models.GapScan.bars.label('scanned_bars')) \
+                    .join(models.Gap, models.Gap.security_id == models.Security.id) \
+                    .outerjoin(models.Company, models.Company.security_id == models.Security.id) \
+                    .outerjoin(models.GapScan, models.GapScan.security_id == models.Security.id) \
+                    .filter(models.Security.ticker.in_(chunk))
+
+                if filled is not None:
+                    q = q.filter(models.Gap.fill_date.isnot(None) if filled else models.Gap.fill_date.is_(None))
+
+                frames.append(pd.read_sql(q.statement, _engine))
+
+        if frames:
+            gaps = pd.concat(frames, ignore_index=True).sort_values(['ticker', 'date'], ignore_index=True)
+
+        _logger.debug(f'{__name__}: Fetched {len(gaps)} gaps for {len(tickers)} tickers')
+
+    return gaps
+
+
 def get_company(ticker: str, live: bool = False, extra: bool = False) -> dict:
     ticker = ticker.upper()
     live = True if _session is None else live
@@ -412,6 +551,91 @@ def get_company(ticker: str, live: bool = False, extra: bool = False) -> dict:
     return results
 
 
+def get_companies(tickers: list[str], live: bool = False, extra: bool = False, refresh: bool = False) -> dict[str, dict]:
+    tickers = [ticker.upper() for ticker in tickers]
+    live = True if _session is None else live
+    results = {}
+
+    with _companies_lock:
+        if (live, extra) not in _companies:
+            _companies[(live, extra)] = TTLCache(maxsize=_COMPANIES_LIVE_SIZE, ttl=_COMPANIES_LIVE_TTL) if live else {}
+
+        cached = _companies[(live, extra)]
+        if not refresh:
+            # get(), as a live entry can expire between a membership test and the lookup
+            results = {ticker: company for ticker in tickers if (company := cached.get(ticker)) is not None}
+
+    missing = [ticker for ticker in dict.fromkeys(tickers) if ticker not in results]
+    if not missing:
+        pass
+    elif live:
+        for ticker in missing:
+            company = get_company(ticker, live=True)
+            if company:
+                results[ticker] = company
+    else:
+        with _session() as session:
+            for n in range(0, len(missing), _COMPANIES_CHUNK):
+                chunk = missing[n:n+_COMPANIES_CHUNK]
+                symbols = session.query(models.Security).options(
+                    joinedload(models.Security.company),
+                    joinedload(models.Security.exchange),
+                    joinedload(models.Security.index1),
+                    joinedload(models.Security.index2),
+                    joinedload(models.Security.index3)).filter(models.Security.ticker.in_(chunk)).all()
+
+                # Number of price records
+                records = {}
+                if extra and symbols:
+                    ids = [symbol.id for symbol in symbols]
+                    counts = session.query(models.Price.security_id, func.count(models.Price.id)).filter(
+                        models.Price.security_id.in_(ids)).group_by(models.Price.security_id).all()
+                    records = {id: count for id, count in counts}
+
+                for symbol in symbols:
+                    if symbol.company:
+                        results[symbol.ticker] = _company_to_dict(symbol, records.get(symbol.id, 0))
+                    else:
+                        _logger.warning(f'{__name__}: No company information for {symbol.ticker}')
+
+        _logger.info(f'{__name__}: Fetched company information for {len(results)} of {len(tickers)} tickers')
+
+    if missing:
+        with _companies_lock:
+            cached.update({ticker: results[ticker] for ticker in missing if ticker in results})
+
+    # Callers get their own copies, so changes to them don't reach the cache
+    return {ticker: dict(company) for ticker, company in results.items()}
+
+
+def clear_companies() -> None:
+    with _companies_lock:
+        _companies.clear()
+
+
+def _company_to_dict(symbol: models.Security, precords: int = 0) -> dict:
+    company = symbol.company[0]
+    results = {}
+    results['name'] = company.name
+    results['description'] = company.description
+    results['url'] = company.url
+    results['sector'] = company.sector
+    results['industry'] = company.industry
+    results['marketcap'] = company.marketcap
+    results['beta'] = company.beta
+    results['rating'] = company.rating
+
+    # Non-database fields
+    results['active'] = str(symbol.active)
+    results['indexes'] = ', '.join([index.abbreviation for index in (symbol.index1, symbol.index2, symbol.index3) if index is not None])
+    results['precords'] = precords
+
+    if symbol.exchange is not None:
+        results['exchange'] = symbol.exchange.abbreviation
+
+    return results
+
+
 def get_company_name(ticker: str) -> str:
     name = '< error >'
     results = get_company(ticker)
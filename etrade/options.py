@@ -84,6 +84,7 @@ class Options:
             _logger.debug(f'{__name__}: Response Body: {response.text}')
             self.message = f'Error: E*TRADE API service error: {response.text}'
 
+        chain = pd.DataFrame()
         calls_table = pd.DataFrame()
         puts_table = pd.DataFrame()
         if self.message == 'success':
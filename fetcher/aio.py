@@ -0,0 +1,322 @@
+'''
+Asyncio fetch layer. The underlying fetchers (requests, yfinance, E*Trade OAuth sessions) are blocking,
+so calls run on a shared thread pool and overlap instead of queueing behind each other
+'''
+
+import asyncio
+import datetime as dt
+import functools
+from concurrent import futures
+from collections.abc import Callable, Hashable
+from urllib.parse import urlsplit
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+import data as d
+import etrade.auth as auth
+from etrade.options import Options
+from etrade.quotes import Quotes
+from fetcher import fetcher as fetcher
+from fetcher.throttle import backoff
+from utils import logger
+
+_logger = logger.get_logger()
+
+PROVIDER_CONCURRENCY = {  # Max in-flight calls per provider
+    'yfinance': 8,
+    'quandl': 2,
+    'etrade': 4,
+    'default': 8,
+}
+POOL_SIZE = 16           # Connections kept per host
+RETRIES = 3              # Number of retries after a retryable error
+BACKOFF_BASE = 0.5       # Secs of first retry backoff, doubled for each retry
+BACKOFF_CAP = 8.0        # Max secs of retry backoff
+TIMEOUT = 10.0           # Secs per HTTP request
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.RequestException, ConnectionError, TimeoutError)
+QUOTES_PER_CALL = 25     # E*Trade limit of symbols per quote request
+
+
+class AsyncFetcher:
+    def __init__(self, concurrency: dict[str, int] | None = None, retries: int = RETRIES, max_workers: int = 32):
+        if retries < 0:
+            raise ValueError('Invalid number of retries')
+
+        self.concurrency = dict(PROVIDER_CONCURRENCY)
+        if concurrency:
+            self.concurrency.update(concurrency)
+
+        self.retries = retries
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._sessions: dict[str, requests.Session] = {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    def __repr__(self):
+        return f'<AsyncFetcher ({len(self._sessions)} hosts, {len(self._inflight)} in-flight)>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        for session in self._sessions.values():
+            session.close()
+
+        self._sessions = {}
+        self._executor.shutdown(wait=False)
+
+    def session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        if host not in self._sessions:
+            self.register_session(url, requests.Session())
+
+        return self._sessions[host]
+
+    def register_session(self, url: str, session: requests.Session) -> None:
+        # Use an existing session for the host (ex: an authorized E*Trade OAuth session) with a larger connection pool
+        parts = urlsplit(url)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        session.mount(f'{parts.scheme}://{parts.netloc}', adapter)
+
+        self._sessions[parts.netloc] = session
+
+    async def call(self, provider: str, key: Hashable | None, func: Callable, *args, **kwargs) -> any:
+        # Duplicate requests with the same key share the response of the request already in flight
+        if key is None:
+            return await self._call(provider, func, *args, **kwargs)
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._call(provider, func, *args, **kwargs))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self._inflight[key] = task
+        else:
+            _logger.debug(f'{__name__}: Coalesced request {key}')
+
+        return await asyncio.shield(task)
+
+    async def get(self, url: str, params: dict | None = None, provider: str = 'default', session: requests.Session | None = None) -> requests.Response:
+        if session is None:
+            session = self.session(url)
+
+        def get() -> requests.Response:
+            response = session.get(url, params=params, timeout=TIMEOUT)
+            if response.status_code in RETRY_STATUS:
+                raise requests.HTTPError(f'HTTP status {response.status_code} for {url}', response=response)
+
+            return response
+
+        key = (url, _freeze(params))
+        return await self.call(provider, key, get)
+
+    async def get_json(self, url: str, params: dict | None = None, provider: str = 'default', session: requests.Session | None = None) -> dict:
+        response = await self.get(url, params=params, provider=provider, session=session)
+        return response.json()
+
+    async def get_histories(self, tickers: list[str], days: int = -1, batch: int = fetcher._BATCH_FETCH) -> dict[str, pd.DataFrame]:
+        tickers = [ticker.upper() for ticker in tickers]
+        batches = [tickers[n:n+batch] for n in range(0, len(tickers), batch)]
+        calls = [self.call('yfinance', ('history', tuple(b), days), fetcher.get_history_live_batch, b, days) for b in batches]
+
+        histories = {}
+        for result in await asyncio.gather(*calls, return_exceptions=True):
+            if isinstance(result, Exception):
+                _logger.error(f'{__name__}: Exception fetching history: {result}')
+            else:
+                histories.update(result)
+
+        return histories
+
+    async def get_option_chains(self, ticker: str, expiries: list[dt.datetime]) -> dict[dt.datetime, pd.DataFrame]:
+        ticker = ticker.upper()
+        provider = d.ACTIVE_OPTIONDATASOURCE
+        if provider == 'etrade':
+            self._register_etrade()
+        calls = [self.call(provider, ('chain', ticker, expiry), fetcher.get_option_chain, ticker, expiry) for expiry in expiries]
+        results = await asyncio.gather(*calls, return_exceptions=True)
+
+        chains = {}
+        for expiry, result in zip(expiries, results):
+            if isinstance(result, Exception):
+                _logger.error(f'{__name__}: Exception fetching {ticker} chain for {expiry:%Y-%m-%d}: {result}')
+                chains[expiry] = pd.DataFrame()
+            else:
+                chains[expiry] = result
+
+        return chains
+
+    async def get_quotes(self, symbols: list[str]) -> list[dict]:
+        self._register_etrade()
+
+        def quote(symbols: tuple[str]) -> list[dict]:
+            # Quotes keeps per-call state, so use an instance per call
+            quotes = Quotes()
+            return _etrade_result(quotes.quote(list(symbols)), quotes.message)
+
+        symbols = sorted(set(symbol.upper() for symbol in symbols))
+        chunks = [tuple(symbols[n:n+QUOTES_PER_CALL]) for n in range(0, len(symbols), QUOTES_PER_CALL)]
+        calls = [self.call('etrade', ('quote', chunk), quote, chunk) for chunk in chunks]
+
+        quotes = []
+        for result in await asyncio.gather(*calls, return_exceptions=True):
+            if isinstance(result, Exception):
+                _logger.error(f'{__name__}: Exception fetching quotes: {result}')
+            else:
+                quotes += result
+
+        return quotes
+
+    async def get_etrade_chains(self, tickers: list[str], month: int, year: int) -> dict[str, pd.DataFrame]:
+        # E*Trade chains of several tickers for the same expiry month. Failed tickers are left out
+        self._register_etrade()
+
+        def chain(ticker: str) -> pd.DataFrame:
+            options = Options()
+            return _etrade_result(options.chain(ticker, month, year), options.message)
+
+        tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+        calls = [self.call('etrade', ('chain', ticker, month, year), chain, ticker) for ticker in tickers]
+
+        chains = {}
+        for ticker, result in zip(tickers, await asyncio.gather(*calls, return_exceptions=True)):
+            if isinstance(result, Exception):
+                _logger.error(f'{__name__}: Exception fetching {ticker} chain: {result}')
+            else:
+                chains[ticker] = result
+
+        return chains
+
+    async def _call(self, provider: str, func: Callable, *args, **kwargs) -> any:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphore(provider)
+        error: Exception | None = None
+
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+                except RETRY_EXCEPTIONS as e:
+                    error = e
+                    _logger.warning(f'{__name__}: {provider} attempt {attempt+1} failed: {e}')
+
+            # Back off outside the semaphore so other requests can proceed
+            if attempt < self.retries:
+                await asyncio.sleep(backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP))
+
+        raise ConnectionError(f'{provider} request failed after {self.retries+1} attempts') from error
+
+    def _register_etrade(self) -> None:
+        # E*Trade calls share the authorized OAuth session, with a connection pool sized for the concurrency
+        if auth.Session is None:
+            raise AssertionError('Etrade session not initialized')
+
+        if urlsplit(auth.base_url).netloc not in self._sessions:
+            self.register_session(auth.base_url, auth.Session)
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        # Semaphores belong to an event loop, so start over if used from a new one
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {}
+
+        if provider not in self._semaphores:
+            limit = self.concurrency.get(provider, self.concurrency['default'])
+            self._semaphores[provider] = asyncio.Semaphore(limit)
+
+        return self._semaphores[provider]
+
+
+def run(coroutine) -> any:
+    # Entry point for blocking callers (ex: threaded console tasks)
+    return asyncio.run(coroutine)
+
+
+def get_histories(tickers: list[str], days: int = -1) -> dict[str, pd.DataFrame]:
+    with AsyncFetcher() as fetch:
+        return run(fetch.get_histories(tickers, days))
+
+
+def get_option_chains(ticker: str, expiries: list[dt.datetime]) -> dict[dt.datetime, pd.DataFrame]:
+    with AsyncFetcher() as fetch:
+        return run(fetch.get_option_chains(ticker, expiries))
+
+
+def get_quotes(symbols: list[str]) -> list[dict]:
+    with AsyncFetcher() as fetch:
+        return run(fetch.get_quotes(symbols))
+
+
+def get_etrade_chains(tickers: list[str], month: int, year: int) -> dict[str, pd.DataFrame]:
+    with AsyncFetcher() as fetch:
+        return run(fetch.get_etrade_chains(tickers, month, year))
+
+
+def _etrade_result(result: any, message: str) -> any:
+    # The E*Trade classes report errors in their message. Service errors are retried, others (ex: an unknown symbol) aren't
+    if message == 'success':
+        return result
+    elif 'service error' in message.lower():
+        raise ConnectionError(message)
+
+    raise ValueError(message)
+
+
+def _freeze(params: dict | None) -> tuple:
+    if not params:
+        return ()
+
+    return tuple(sorted((key, str(value)) for key, value in params.items()))
+
+
+if __name__ == '__main__':
+    import json
+    import time
+    import logging
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    logger.get_logger(logging.INFO)
+
+    # Local stub server: slow responses and an occasional 503 to exercise coalescing and retries
+    class _Handler(BaseHTTPRequestHandler):
+        hits = 0
+
+        def do_GET(self):
+            _Handler.hits += 1
+            hit = _Handler.hits
+            time.sleep(0.2)
+            status = 503 if hit == 2 else 200
+            body = json.dumps({'path': self.path, 'hit': hit}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    async def main(fetch: AsyncFetcher) -> list:
+        calls = [fetch.get_json(f'{url}/quote/{symbol}') for symbol in ['AAPL', 'AAPL', 'MSFT', 'IBM', 'AAPL']]
+        return await asyncio.gather(*calls)
+
+    with AsyncFetcher() as fetch:
+        tic = time.perf_counter()
+        results = run(main(fetch))
+        toc = time.perf_counter()
+
+    server.shutdown()
+    print(results)
+    print(f'{len(results)} responses, {_Handler.hits} server hits, {toc-tic:.2f}s')
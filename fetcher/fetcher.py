@@ -3,30 +3,43 @@ yfinance: https://github.com/ranaroussi/yfinance
 '''
 
 import time
+import threading
 import datetime as dt
 import configparser
 import socket
 from pathlib import Path
+from collections.abc import Callable
 
 import quandl as qd
 import yfinance as yf
 import pandas as pd
+from cachetools import TTLCache
 
 import fetcher as f
 import data as d
 import etrade.auth as auth
 from etrade.options import Options
+from fetcher.throttle import TokenBucket, backoff
 from utils import ui, logger
 
 
 _THROTTLE_FETCH = 0.10  # Min secs between calls to fetch pricing
-_THROTTLE_ERROR = 1.00  # Min secs between calls after error
+_THROTTLE_ERROR = 1.00  # Base secs of backoff between calls after error
 _RETRIES = 2            # Number of fetch retries after error
+_BATCH_FETCH = 50       # Max tickers per batched history download
+_CACHE_SIZE = 256       # Max ticker handles and payloads cached
+_CACHE_TTL = 600        # Secs before cached ticker handles and payloads expire
 
 _logger = logger.get_logger()
-_last_company: pd.DataFrame = pd.DataFrame()
-_last_ticker: str = ''
-_elapsed = 0.0
+
+# Ticker handles keyed by ticker, and their fetched payloads keyed by (ticker, 'info'), (ticker, 'options')
+# or (ticker, 'chain', expiry). Shared by all threads, so only access them while holding the lock
+_tickers: TTLCache = TTLCache(maxsize=_CACHE_SIZE, ttl=_CACHE_TTL)
+_payloads: TTLCache = TTLCache(maxsize=_CACHE_SIZE, ttl=_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+# Shared by all fetching threads. Allows a full batch as a burst, then 1/_THROTTLE_FETCH requests per second
+_limiter = TokenBucket(1.0 / _THROTTLE_FETCH, capacity=_BATCH_FETCH)
 
 # Quandl credentials
 CREDENTIALS = Path(__file__).resolve().parent  / 'quandl.ini'
@@ -71,10 +84,7 @@ def get_history_live(ticker: str, days: int = -1) -> pd.DataFrame:
         raise ConnectionError('No internet connection')
 
     # Throttle requests to help avoid being cut off by data provider
-    global _elapsed
-    while (time.perf_counter() - _elapsed) < _THROTTLE_FETCH:
-        time.sleep(_THROTTLE_FETCH)
-    _elapsed = time.perf_counter()
+    _limiter.acquire()
 
     _logger.info(f'{__name__}: Fetching {ticker} history from {d.ACTIVE_HISTORYDATASOURCE}...')
 
@@ -94,12 +104,34 @@ def get_history_live(ticker: str, days: int = -1) -> pd.DataFrame:
     return history
 
 
+def get_history_live_batch(tickers: list[str], days: int = -1) -> dict[str, pd.DataFrame]:
+    if not _connected:
+        raise ConnectionError('No internet connection')
+
+    tickers = [ticker.upper() for ticker in tickers]
+    histories = {}
+
+    if d.ACTIVE_HISTORYDATASOURCE == 'yfinance':
+        for n in range(0, len(tickers), _BATCH_FETCH):
+            batch = tickers[n:n+_BATCH_FETCH]
+
+            # The provider sees one request per ticker, so take a token for each
+            _limiter.acquire(len(batch))
+
+            _logger.info(f'{__name__}: Fetching history of {len(batch)} tickers from {d.ACTIVE_HISTORYDATASOURCE}...')
+            histories.update(_get_history_yfinance_batch(batch, days=days))
+    else:
+        histories = {ticker: get_history_live(ticker, days=days) for ticker in tickers}
+
+    return histories
+
+
 def get_company_live(ticker: str) -> dict:
     company = {}
 
     c = _get_yfinance_live(ticker)
     if c is not None:
-        company = c.info
+        company = _get_cached((ticker.upper(), 'info'), lambda: c.info)
 
     return company
 
@@ -147,7 +179,7 @@ def get_ratings(ticker: str) -> list[int]:
     results = []
     try:
         _logger.info(f'{__name__}: Fetching Yahoo rating information for {ticker}...')
-        company = yf.Ticker(ticker)
+        company = _get_yfinance_live(ticker)
         if company is not None:
             ratings = company.recommendations
             if ratings is not None and not ratings.empty:
@@ -191,25 +223,48 @@ def get_treasury_rate(ticker: str) -> float:
     return df['Value'][0] / 100.0
 
 
-def _get_yfinance_live(ticker: str) -> yf.Ticker:
-    global _last_company, _last_ticker
+def clear_cache() -> None:
+    with _cache_lock:
+        _tickers.clear()
+        _payloads.clear()
+
 
+def _get_yfinance_live(ticker: str) -> yf.Ticker:
     if not _connected:
         raise ConnectionError('No internet connection')
 
-    if ticker == _last_ticker:
-        company = _last_company
+    ticker = ticker.upper()
+    with _cache_lock:
+        company = _tickers.get(ticker)
+
+    if company is not None:
         _logger.info(f'{__name__}: Using cached company information for {ticker} from Yahoo')
     else:
         company = yf.Ticker(ticker)
         _logger.info(f'{__name__}: Fetched live company information for {ticker} from Yahoo')
 
-    _last_company = company
-    _last_ticker = ticker
+        with _cache_lock:
+            company = _tickers.setdefault(ticker, company)
 
     return company
 
 
+def _get_cached(key: tuple, fetch: Callable) -> any:
+    with _cache_lock:
+        payload = _payloads.get(key)
+
+    # Fetch outside the lock so slow downloads don't block other threads
+    if payload is None:
+        payload = fetch()
+        if payload is not None:
+            with _cache_lock:
+                _payloads[key] = payload
+    else:
+        _logger.debug(f'{__name__}: Using cached payload {key}')
+
+    return payload
+
+
 def _get_history_yfinance(ticker: str, days: int = -1) -> pd.DataFrame:
     if not _connected:
         raise ConnectionError('No internet connection')
@@ -235,14 +290,14 @@ def _get_history_yfinance(ticker: str, days: int = -1) -> pd.DataFrame:
                     if history is None:
                         history = pd.DataFrame()
                         _logger.warning(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} history for {ticker} is None ({retry+1})')
-                        time.sleep(_THROTTLE_ERROR)
+                        time.sleep(backoff(retry, base=_THROTTLE_ERROR))
                     elif history.empty:
                         _logger.warning(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} history for {ticker} is empty ({retry+1})')
-                        time.sleep(_THROTTLE_ERROR)
+                        time.sleep(backoff(retry, base=_THROTTLE_ERROR))
                     elif history.shape[1] == 0:
                         history = pd.DataFrame()
                         _logger.warning(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} history for {ticker} has no columns ({retry+1})')
-                        time.sleep(_THROTTLE_ERROR)
+                        time.sleep(backoff(retry, base=_THROTTLE_ERROR))
                     else:
                         days = history.shape[0]
                         history = history.reset_index()
@@ -257,11 +312,70 @@ def _get_history_yfinance(ticker: str, days: int = -1) -> pd.DataFrame:
                 except Exception as e:
                     _logger.error(f'{__name__}: Exception: {e}: During attempt {retry+1} to fetch history of {ticker} from {d.ACTIVE_HISTORYDATASOURCE}')
                     history = pd.DataFrame()
-                    time.sleep(_THROTTLE_ERROR)
+                    time.sleep(backoff(retry, base=_THROTTLE_ERROR))
 
     return history
 
 
+def _get_history_yfinance_batch(tickers: list[str], days: int = -1) -> dict[str, pd.DataFrame]:
+    if not _connected:
+        raise ConnectionError('No internet connection')
+
+    histories = {ticker: pd.DataFrame() for ticker in tickers}
+
+    if days < 0:
+        days = 7300  # 20 years
+
+    if days > 0 and tickers:
+        end = dt.datetime.today()
+        start = end - dt.timedelta(days=days)
+
+        for retry in range(_RETRIES):
+            try:
+                # Adjusted prices to match the single ticker fetch, which auto adjusts by default
+                data = yf.download(tickers, start=start, end=end, interval='1d', group_by='ticker',
+                                   auto_adjust=True, threads=False, progress=False, timeout=10.0)
+            except Exception as e:
+                _logger.error(f'{__name__}: Exception: {e}: During attempt {retry+1} to fetch batch history from {d.ACTIVE_HISTORYDATASOURCE}')
+                time.sleep(backoff(retry, base=_THROTTLE_ERROR))
+            else:
+                if data is None or data.empty:
+                    _logger.warning(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} batch history is empty ({retry+1})')
+                    time.sleep(backoff(retry, base=_THROTTLE_ERROR))
+                    continue
+
+                # Grouped by ticker, columns are (ticker, field). Some yfinance versions drop the ticker level for a single ticker
+                grouped = isinstance(data.columns, pd.MultiIndex)
+                for ticker in tickers:
+                    if not grouped:
+                        if len(tickers) > 1:
+                            _logger.error(f'{__name__}: Unexpected batch history columns from {d.ACTIVE_HISTORYDATASOURCE}')
+                            break
+                        history = data
+                    elif ticker in data.columns.get_level_values(0):
+                        history = data[ticker]
+                    else:
+                        continue
+
+                    history = history.dropna(how='all')
+                    if not history.empty:
+                        history = history.reset_index()
+
+                        # Clean some things up and make colums consistent with Postgres column names
+                        history.columns = history.columns.str.lower()
+                        history = history.drop(['adj close'], axis=1, errors='ignore')
+                        history = history.sort_values('date', ascending=True).reset_index(drop=True)
+                        histories[ticker] = history
+
+                empty = [ticker for ticker in tickers if histories[ticker].empty]
+                _logger.info(f'{__name__}: Fetched live history of {len(tickers)-len(empty)} tickers starting {start:%Y-%m-%d}')
+                if empty:
+                    _logger.info(f'{__name__}: Empty live history for {", ".join(empty)}')
+                break
+
+    return histories
+
+
 def _get_history_quandl(ticker: str, days: int = -1) -> pd.DataFrame:
     if not _connected:
         raise ConnectionError('No internet connection')
@@ -284,10 +398,10 @@ def _get_history_quandl(ticker: str, days: int = -1) -> pd.DataFrame:
                 if history is None:
                     history = pd.DataFrame()
                     _logger.warning(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} history for {ticker} is None ({retry+1})')
-                    time.sleep(_THROTTLE_ERROR)
+                    time.sleep(backoff(retry, base=_THROTTLE_ERROR))
                 elif history.empty:
                     _logger.info(f'{__name__}: {d.ACTIVE_HISTORYDATASOURCE} history for {ticker} is empty ({retry+1})')
-                    time.sleep(_THROTTLE_ERROR)
+                    time.sleep(backoff(retry, base=_THROTTLE_ERROR))
                 else:
                     history = history.reset_index()
 
@@ -301,7 +415,7 @@ def _get_history_quandl(ticker: str, days: int = -1) -> pd.DataFrame:
             except Exception as e:
                 _logger.error(f'{__name__}: Exception: {e}: Retry {retry} to fetch history of {ticker} from {d.ACTIVE_HISTORYDATASOURCE}')
                 history = pd.DataFrame()
-                time.sleep(_THROTTLE_ERROR)
+                time.sleep(backoff(retry, base=_THROTTLE_ERROR))
 
     return history
 
@@ -311,11 +425,11 @@ def _get_option_expiry_yfinance(ticker: str) -> tuple[str]:
     for retry in range(_RETRIES):
         company = _get_yfinance_live(ticker)
         if company is not None:
-            expiry = company.options
+            expiry = _get_cached((ticker.upper(), 'options'), lambda: company.options)
             break
         else:
             _logger.warning(f'{__name__}: Retry {retry} to fetch option expiry for {ticker} using yfinance')
-            time.sleep(_THROTTLE_ERROR)
+            time.sleep(backoff(retry, base=_THROTTLE_ERROR))
 
     return expiry
 
@@ -336,9 +450,13 @@ def _get_option_chain_yfinance(ticker: str, expiry: dt.datetime) -> pd.DataFrame
     for retry in range(_RETRIES):
         company = _get_yfinance_live(ticker)
         if company is not None:
-            chain_c = company.option_chain(expiry.strftime(ui.DATE_FORMAT_YMD)).calls
+            date = expiry.strftime(ui.DATE_FORMAT_YMD)
+            options = _get_cached((ticker.upper(), 'chain', date), lambda: company.option_chain(date))
+
+            # Copy so callers can't modify the cached frames
+            chain_c = options.calls.copy()
             chain_c['type'] = 'call'
-            chain_p = company.option_chain(expiry.strftime(ui.DATE_FORMAT_YMD)).puts
+            chain_p = options.puts.copy()
             chain_p['type'] = 'put'
             chain = pd.concat([chain_c, chain_p], axis=0)
 
@@ -357,7 +475,7 @@ def _get_option_chain_yfinance(ticker: str, expiry: dt.datetime) -> pd.DataFrame
             break
         else:
             _logger.warning(f'{__name__}: Retry {retry} to fetch option chain for {ticker}')
-            time.sleep(_THROTTLE_ERROR)
+            time.sleep(backoff(retry, base=_THROTTLE_ERROR))
 
     return chain
 
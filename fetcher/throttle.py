@@ -0,0 +1,52 @@
+import time
+import random
+import threading
+
+
+# Thread-safe token bucket rate limiter. Tokens refill continuously at 'rate' per second up to
+# 'capacity', so short bursts are allowed while the long-run rate stays bounded
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        if rate <= 0.0:
+            raise ValueError('Invalid rate')
+        if capacity < 1.0:
+            raise ValueError('Invalid capacity')
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<TokenBucket ({self.rate:.2f}/s, {self.capacity:.0f})>'
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        if tokens > self.capacity:
+            raise ValueError('Tokens requested exceed bucket capacity')
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + ((now - self._updated) * self.rate))
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    break
+
+                delay = (tokens - self._tokens) / self.rate
+
+            # Sleep outside the lock so other threads can refill and check
+            time.sleep(delay)
+            waited += delay
+
+        return waited
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    # Exponential backoff with jitter. Half of the delay is fixed, the other half random so that
+    # threads failing together don't all retry together
+    delay = min(cap, base * (2 ** attempt))
+    return (delay / 2.0) + random.uniform(0.0, delay / 2.0)
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from base import Threaded
+from data import store as store
+from .screener import load_scripts, get_table_tickers
+from .plan import Plan
+from utils import logger, ui
+
+
+_logger = logger.get_logger()
+
+
+# Walk-forward backtest of a screen. The universe's history is loaded once, then the compiled screen is evaluated
+# in one pass as of every date in the period over the same lookback ('days') the live screen uses, and compared
+# to the return over the following 'horizon' bars
+class Backtest(Threaded):
+    def __init__(self, table: str, screen: str, days: int = 365, period: int = 60, horizon: int = 10,
+                 bullish: bool = True, live: bool = False):
+        if period < 1:
+            raise ValueError('Invalid backtest period')
+        if horizon < 1:
+            raise ValueError('Invalid backtest horizon')
+
+        super().__init__()
+
+        scripts = load_scripts(screen)
+        if not scripts:
+            raise ValueError(f'Script not found or invalid format: {screen}')
+
+        try:
+            self.plan = Plan(scripts)
+        except SyntaxError as e:
+            raise ValueError(f'Invalid script {screen}: {e}') from e
+
+        self.table = table.upper()
+        self.tickers = get_table_tickers(self.table)
+        if not self.tickers:
+            raise ValueError(f'No symbols in table {self.table}')
+
+        self.screen = screen
+        self.days = days
+        self.period = period
+        self.horizon = horizon
+        self.bullish = bullish
+        self.live = live if store.is_database_connected() else True
+        self.results: pd.DataFrame = pd.DataFrame()  # One row per date
+        self.signals: pd.DataFrame = pd.DataFrame()  # One row per date and ticker passing the screen
+        self.hit_rate = 0.0
+        self.return_mean = 0.0
+
+    def __repr__(self):
+        return f'<Backtest ({self.table} - {self.screen}, {self.period}/{self.horizon})>'
+
+    def __str__(self):
+        return f'{self.table} - {self.screen}'
+
+    @Threaded.threaded
+    def run(self) -> None:
+        self.results = pd.DataFrame()
+        self.signals = pd.DataFrame()
+        self.task_state = 'None'
+
+        information = store.get_companies(self.tickers, live=self.live) if self.plan.requires_information else {}
+
+        # Enough calendar days for the screen's history at the first date, plus the period and the forward returns
+        days = self.days + int((self.period + self.horizon) * 7 / 5) + 7
+        panel = store.get_history_panel(self.tickers, days, live=self.live)
+
+        stop = len(panel) - self.horizon
+        rows = np.arange(max(stop - self.period, 0), max(stop, 0))
+        if rows.size == 0:
+            self.task_state = 'Not enough history'
+            _logger.warning(f'{__name__}: {self.task_state}')
+            return
+
+        # Each date sees the 'days' calendar days up to and including it, as the live screen would
+        dates = panel.dates.astype('datetime64[D]')
+        starts = np.searchsorted(dates, dates[rows] - np.timedelta64(self.days, 'D'), side='left')
+        self.task_total = len(self.plan)
+
+        def progress(steps: int) -> None:
+            self.task_completed = steps
+
+        try:
+            evaluation = self.plan.evaluate_range(panel.close, panel.high, panel.low, panel.volume, panel.tickers,
+                                                  information, self.days, rows, starts=starts, valid=panel.valid,
+                                                  progress=progress)
+        except Exception as e:
+            self.task_state = str(e)
+            _logger.error(f'{__name__}: Exception: {self.task_state}')
+            return
+
+        valid = evaluation.valid
+        scores = evaluation.scores
+
+        # Forward returns, only where the ticker had a bar on the date
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = panel.close[rows + self.horizon] / panel.close[rows] - 1.0
+        returns = np.where(panel.valid[rows] & np.isfinite(returns), returns, np.nan)
+
+        available = ~np.isnan(returns)
+        picked = valid & available
+        hits = picked & ((returns > 0.0) if self.bullish else (returns < 0.0))
+
+        count = picked.sum(axis=1)
+        total = np.where(picked, returns, 0.0).sum(axis=1)
+        universe = available.sum(axis=1)
+        benchmark = np.where(available, returns, 0.0).sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.results = pd.DataFrame({
+                'date': panel.dates[rows],
+                'count': count,
+                'hits': hits.sum(axis=1),
+                'hit_rate': hits.sum(axis=1) / count,
+                'return_mean': total / count,
+                'benchmark': benchmark / universe,
+            })
+
+        self.results['excess'] = self.results['return_mean'] - self.results['benchmark']
+
+        dates, columns = np.nonzero(picked)
+        self.signals = pd.DataFrame({
+            'date': panel.dates[rows[dates]],
+            'ticker': [panel.tickers[column] for column in columns],
+            'score': scores[dates, columns],
+            'return': returns[dates, columns],
+        })
+
+        self.task_success = int(count.sum())
+        self.hit_rate = float(hits.sum() / self.task_success) if self.task_success > 0 else 0.0
+        self.return_mean = float(total.sum() / self.task_success) if self.task_success > 0 else 0.0
+        self.task_object = self.results
+        self.task_state = 'Done'
+
+        _logger.info(f'{__name__}: {len(rows)} dates backtested. {self.task_success} signals, hit rate {self.hit_rate:.2f}')
+
+
+if __name__ == '__main__':
+    import logging
+    from tabulate import tabulate
+
+    logger.get_logger(logging.INFO)
+
+    b = Backtest('SP500', 'bulltrend', period=30, horizon=10)
+    b.run()
+
+    if not b.results.empty:
+        headers = ui.format_headers(b.results.columns)
+        print(tabulate(b.results, headers=headers, tablefmt=ui.TABULATE_FORMAT, floatfmt='.3f'))
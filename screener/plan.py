@@ -0,0 +1,609 @@
+import time
+import threading
+from dataclasses import dataclass, field, astuple
+from collections.abc import Callable
+
+import numpy as np
+
+from analysis import technical
+from data.panel import compact
+from .interpreter import VALID_TECHNICALS, VALID_CONDITIONALS, VALID_SERIES
+from utils import memo, logger
+
+_logger = logger.get_logger()
+
+BASE_TECHNICALS = ('close', 'volume', 'sma', 'rsi', 'beta', 'rating', 'mcap', 'true')
+CRITERIA_TECHNICALS = ('value', 'high', 'low', 'close', 'volume', 'sma')
+PRICE_TECHNICALS = ('high', 'low', 'close', 'volume')
+INDICATOR_TECHNICALS = ('sma', 'rsi')
+INFO_TECHNICALS = {'beta': 'beta', 'rating': 'rating', 'mcap': 'marketcap'}
+
+# Cost classes used to order steps in short-circuit mode, with the assumed seconds per ticker until measured
+COST_PRICE = 0
+COST_INDICATOR = 1
+COST_INFORMATION = 2
+COST_DEFAULTS = (1e-7, 1e-5, 1e-3)
+
+# Measured per step across runs: tickers evaluated, tickers passed, seconds
+_stats: dict[tuple, list] = {}
+_stats_lock = threading.Lock()
+
+
+@dataclass
+class Operand:
+    technical: str
+    length: float
+    start: int
+    stop: int
+    series: str
+    factor: float
+    value: float = 0.0
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.technical, int(self.length))
+
+
+@dataclass
+class Step:
+    note: str
+    weight: float
+    base: Operand
+    conditional: str
+    criteria: Operand
+
+    @property
+    def key(self) -> tuple:
+        return astuple(self)
+
+    @property
+    def cost(self) -> int:
+        technicals = [self.base.technical] if self.base.technical == 'true' else [self.base.technical, self.criteria.technical]
+        if any(technical in INFO_TECHNICALS for technical in technicals):
+            return COST_INFORMATION
+        if any(technical in INDICATOR_TECHNICALS for technical in technicals):
+            return COST_INDICATOR
+        return COST_PRICE
+
+
+@dataclass
+class Evaluation:
+    tickers: list[str]
+    successes: np.ndarray                       # tickers x steps
+    scores: np.ndarray                          # tickers x steps
+    descriptions: list[list[str]] = field(default_factory=list)
+    evaluated: np.ndarray | None = None         # tickers x steps, False where skipped by short-circuiting
+
+
+@dataclass
+class RangeEvaluation:
+    tickers: list[str]
+    rows: np.ndarray                            # Rows (dates) of the price matrices evaluated
+    valid: np.ndarray                           # rows x tickers, passed every step
+    scores: np.ndarray                          # rows x tickers, mean score over the steps
+
+
+# A screen script compiled once into a list of steps, then evaluated for all tickers together over
+# date x ticker matrices. The results match running an Interpreter per ticker and filter
+class Plan:
+    def __init__(self, scripts: list[dict]):
+        self.steps = [compile_filter(filter) for filter in scripts]
+
+    def __repr__(self):
+        return f'<Plan ({len(self.steps)} steps)>'
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def indicators(self) -> set[tuple[str, int]]:
+        indicators = set()
+        for step in self.steps:
+            if step.base.technical in INDICATOR_TECHNICALS:
+                indicators.add(step.base.key)
+            if step.base.technical != 'true' and step.criteria.technical in INDICATOR_TECHNICALS:
+                indicators.add(step.criteria.key)
+
+        return indicators
+
+    @property
+    def requires_information(self) -> bool:
+        return any(step.base.technical in INFO_TECHNICALS for step in self.steps)
+
+    @property
+    def order(self) -> list[int]:
+        # Cheapest class first (prices, then indicators, then company information), then within a class by the
+        # measured cost per ticker relative to the fraction of tickers each step removes
+        def rank(n: int) -> tuple[int, float, int]:
+            step = self.steps[n]
+            evaluated, passed, seconds = get_stats(step)
+            if evaluated > 0:
+                cost = seconds / evaluated
+                rejected = 1.0 - (passed / evaluated)
+            else:
+                cost = COST_DEFAULTS[step.cost]
+                rejected = 0.5
+
+            return (step.cost, cost / max(rejected, 0.01), n)
+
+        return sorted(range(len(self.steps)), key=rank)
+
+    def estimate(self, count: int) -> float:
+        # Seconds to evaluate 'count' tickers in-process, from the measured cost per ticker of each step.
+        # Steps not yet measured aren't counted, so the first run of a screen is in-process and measures them
+        seconds = 0.0
+        for step in self.steps:
+            evaluated, _, elapsed = get_stats(step)
+            if evaluated > 0:
+                seconds += elapsed / evaluated
+
+        return seconds * count
+
+    def evaluate(self, close: np.ndarray, high: np.ndarray, low: np.ndarray, volume: np.ndarray, tickers: list[str],
+                 information: dict[str, dict] | Callable[[list[str]], dict[str, dict]], days: int,
+                 short_circuit: bool = False, spans: list[str | None] | None = None) -> Evaluation:
+        # Price matrices are dates x tickers, oldest first, with NaN before each ticker's first bar (ex: Panel.compact()).
+        # Slices count bars from each ticker's first bar, as they would on its own history.
+        # Information is either loaded for all the tickers, or a function to load it for the tickers that need it.
+        # In short-circuit mode the steps run cheapest first and each only sees the tickers that passed every
+        # earlier step, so the results are only complete for tickers that pass the whole screen.
+        # With the span of each ticker's bars (see memo.build_spans()), indicators are memoized per ticker
+        if close.shape != (close.shape[0], len(tickers)):
+            raise ValueError('Price matrices do not match tickers')
+        if spans is not None and len(spans) != len(tickers):
+            raise ValueError('Spans do not match tickers')
+
+        data = _Data({'close': close, 'high': high, 'low': low, 'volume': volume}, tickers, information, self.indicators, days, spans)
+
+        count = len(tickers)
+        successes = np.zeros((count, len(self.steps)), dtype=bool)
+        scores = np.ones((count, len(self.steps)), dtype=float)
+        evaluated = np.zeros((count, len(self.steps)), dtype=bool)
+        descriptions = [[''] * len(self.steps) for _ in range(count)]
+
+        for n in (self.order if short_circuit else range(len(self.steps))):
+            step = self.steps[n]
+            columns = data.columns
+            if columns.size == 0:
+                break
+
+            start = time.perf_counter()
+            success, score, description = self._evaluate_step(step, data, [tickers[i] for i in columns])
+            record_stats(step, columns.size, int(success.sum()), time.perf_counter() - start)
+
+            successes[columns, n] = success
+            scores[columns, n] = score
+            evaluated[columns, n] = True
+            for i, text in zip(columns, description):
+                descriptions[i][n] = text
+
+            if short_circuit:
+                data.select(columns[success])
+
+        # Steps skipped by short-circuiting fail
+        for i, n in zip(*np.nonzero(~evaluated)):
+            descriptions[i][n] = f'{tickers[i]:6s} Skip {"":6s}: {self.steps[n].note:18s}: not evaluated'
+
+        return Evaluation(tickers, successes, scores, descriptions, evaluated)
+
+    def _evaluate_step(self, step: Step, data: '_Data', tickers: list[str]) -> tuple[np.ndarray, np.ndarray, list[str]]:
+        count = len(tickers)
+
+        if step.base.technical == 'true':
+            return np.ones(count, dtype=bool), np.ones(count), [''] * count
+
+        # Base value: last value of the slice
+        if step.base.technical in INFO_TECHNICALS:
+            base = data.get_info(step.base.technical).copy()
+        else:
+            matrix = data[step.base.key] if step.base.technical in INDICATOR_TECHNICALS else data[step.base.technical]
+            base = _slice(matrix, step.base, data.first, 'none')
+
+        base = base * step.base.factor
+
+        # Criteria value: last, min or max of the slice. 'eq' always uses the min
+        if step.criteria.technical == 'value':
+            criteria = np.full(count, float(step.criteria.value))
+        else:
+            matrix = data[step.criteria.key] if step.criteria.technical in INDICATOR_TECHNICALS else data[step.criteria.technical]
+            series = 'min' if step.conditional == 'eq' else step.criteria.series
+            criteria = _slice(matrix, step.criteria, data.first, series)
+
+        success, score, criteria = _compare(step, base, criteria)
+
+        return success, score, _describe(step, tickers, success, score, base, criteria, np.isnan(base))
+
+    def evaluate_range(self, close: np.ndarray, high: np.ndarray, low: np.ndarray, volume: np.ndarray, tickers: list[str],
+                       information: dict[str, dict], days: int, rows: np.ndarray, starts: np.ndarray | None = None,
+                       valid: np.ndarray | None = None, progress: Callable[[int], None] | None = None) -> RangeEvaluation:
+        # The screen as of each of the given rows (dates) of the price matrices, in one pass rather than once per date.
+        # Each row sees the rows from its start (the first row by default) up to and including it, and gives the same
+        # result as evaluating the matrices truncated to them. Company information is the current information for
+        # every date. With the mask of actual bars (ex: a forward filled panel), each ticker is evaluated over its own
+        # bars only, and rows after its last bar don't pass. Progress is called with the steps done
+        if close.shape != (close.shape[0], len(tickers)):
+            raise ValueError('Price matrices do not match tickers')
+        if valid is not None and valid.shape != close.shape:
+            raise ValueError('Valid mask does not match the price matrices')
+
+        rows = np.asarray(rows, dtype=int)
+        starts = np.zeros_like(rows) if starts is None else np.asarray(starts, dtype=int)
+        if rows.size > 0 and (rows.min() < 0 or rows.max() >= close.shape[0]):
+            raise ValueError('Invalid rows')
+        if starts.shape != rows.shape or (starts.size > 0 and (starts.min() < 0 or (starts > rows).any())):
+            raise ValueError('Invalid starts')
+
+        # Without a mask, each ticker's bars are the rows from its first close
+        if valid is None:
+            valid = np.maximum.accumulate(~np.isnan(close), axis=0)
+
+        # Bars of each ticker before each row's start and up to the row, indexing its bars moved to the top of its column
+        shape = (len(rows), len(tickers))
+        last = np.where(valid.any(axis=0), valid.shape[0] - 1 - np.argmax(valid[::-1], axis=0), valid.shape[0])
+        after = rows[:, None] > last
+        counts = np.concatenate([np.zeros((1, len(tickers)), dtype=int), np.cumsum(valid, axis=0)])
+        first = counts[starts]
+        lengths = counts[rows + 1] - first
+        close, high, low, volume = (compact(matrix, valid, end=False) for matrix in (close, high, low, volume))
+
+        data = _Range({'close': close, 'high': high, 'low': low, 'volume': volume}, self.indicators, days)
+
+        passed = np.ones(shape, dtype=bool)
+        total = np.zeros(shape, dtype=float)
+
+        for n, step in enumerate(self.steps):
+            if step.base.technical == 'true':
+                total += 1.0
+            else:
+                if step.base.technical in INFO_TECHNICALS:
+                    key = INFO_TECHNICALS[step.base.technical]
+                    base = np.array([_to_float(information.get(ticker, {}).get(key)) for ticker in tickers])
+                    base = np.broadcast_to(base, shape)
+                else:
+                    key = step.base.key if step.base.technical in INDICATOR_TECHNICALS else step.base.technical
+                    base = _window(data, key, step.base, first, lengths, 'none')
+
+                base = base * step.base.factor
+
+                if step.criteria.technical == 'value':
+                    criteria = np.full(shape, float(step.criteria.value))
+                else:
+                    key = step.criteria.key if step.criteria.technical in INDICATOR_TECHNICALS else step.criteria.technical
+                    series = 'min' if step.conditional == 'eq' else step.criteria.series
+                    criteria = _window(data, key, step.criteria, first, lengths, series)
+
+                success, score, _ = _compare(step, base, criteria)
+                passed &= success
+                total += score
+
+            if progress is not None:
+                progress(n + 1)
+
+        scores = total / len(self.steps) if self.steps else total
+        passed &= ~after
+        scores = np.where(after, np.nan, scores)
+
+        return RangeEvaluation(tickers, rows, passed, scores)
+
+
+# Price, indicator and information arrays for the tickers (columns) still being evaluated. Indicators
+# and information are only calculated or loaded when first needed, and only for those columns
+class _Data:
+    def __init__(self, prices: dict[str, np.ndarray], tickers: list[str],
+                 information: dict[str, dict] | Callable[[list[str]], dict[str, dict]],
+                 indicators: set[tuple[str, int]], days: int, spans: list[str | None] | None = None):
+        self.prices = prices
+        self.tickers = tickers
+        self.information = information
+        self.indicators = indicators
+        self.days = days
+        self.spans = spans
+        self.columns = np.arange(len(tickers))
+        self._calculated: dict[object, tuple[np.ndarray, np.ndarray]] = {}
+        self._selected: dict[object, np.ndarray] = {}
+
+    def __getitem__(self, key: str | tuple[str, int]) -> np.ndarray:
+        if key not in self._selected:
+            if key in self.prices:
+                self._selected[key] = self._select(self.columns, self.prices[key])
+            else:
+                if key not in self._calculated:
+                    # All the indicators not yet calculated, in one pass over the remaining columns
+                    pending = {indicator for indicator in self.indicators if indicator not in self._calculated}
+                    close = self.prices['close'][:, self.columns] if self.columns.size < len(self.tickers) else self.prices['close']
+                    spans = [self.spans[i] for i in self.columns] if self.spans is not None else None
+                    for indicator, matrix in _calculate_indicators(pending, close, self.days, spans).items():
+                        self._calculated[indicator] = (self.columns, matrix)
+
+                columns, matrix = self._calculated[key]
+                self._selected[key] = self._select(np.searchsorted(columns, self.columns), matrix, len(columns))
+
+        return self._selected[key]
+
+    @property
+    def first(self) -> np.ndarray:
+        # Row of each column's first bar, or the number of rows if it has none
+        if 'first' not in self._selected:
+            close = self['close']
+            bars = ~np.isnan(close)
+            self._selected['first'] = np.where(bars.any(axis=0), np.argmax(bars, axis=0), close.shape[0])
+
+        return self._selected['first']
+
+    def get_info(self, technical: str) -> np.ndarray:
+        if technical not in self._calculated:
+            tickers = [self.tickers[i] for i in self.columns]
+            if callable(self.information):
+                self.information = self.information(tickers)
+
+            for name, key in INFO_TECHNICALS.items():
+                values = np.array([_to_float(self.information.get(ticker, {}).get(key)) for ticker in tickers])
+                self._calculated.setdefault(name, (self.columns, values))
+
+        columns, values = self._calculated[technical]
+        return values[np.searchsorted(columns, self.columns)]
+
+    def select(self, columns: np.ndarray) -> None:
+        # Columns are kept in ascending order, so positions in earlier results can be found by searching
+        self.columns = columns
+        self._selected = {}
+
+    def _select(self, positions: np.ndarray, matrix: np.ndarray, total: int = -1) -> np.ndarray:
+        total = len(self.tickers) if total < 0 else total
+        return matrix if positions.size == total else matrix[:, positions]
+
+
+# Prices and indicators of start-aligned price matrices as of histories starting at any bar, so indicators are
+# calculated once for every start. SMAs are window sums cut at the start. RSIs are the smoothed gains and losses over
+# all the bars less their values at the start decayed to each bar, which is what they'd be if started there
+class _Range:
+    def __init__(self, prices: dict[str, np.ndarray], indicators: set[tuple[str, int]], days: int):
+        self.prices = prices
+        self.present = ~np.isnan(prices['close'])
+        self.averages: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self.invalid: set[tuple[str, int]] = set()
+
+        close = np.where(self.present, prices['close'], 0.0)
+        zeros = np.zeros((1, close.shape[1]))
+        self.sums = np.concatenate([zeros, np.cumsum(close, axis=0)])
+        self.counts = np.concatenate([zeros, np.cumsum(self.present, axis=0)])
+
+        # Same validity rule as Technical: invalid lengths give no values
+        for indicator, length in indicators:
+            if length > 5 and length < days:
+                if indicator == 'rsi':
+                    self.averages[length] = technical.rsi_averages(prices['close'], length)
+            else:
+                _logger.warning(f'{__name__}: Invalid interval for {indicator.upper()}')
+                self.invalid.add((indicator, length))
+
+    def values(self, key: str | tuple[str, int], bars: np.ndarray, first: np.ndarray) -> np.ndarray:
+        # Values at the 'bars' of each column (rows x columns) of histories starting at its 'first' bars
+        rows = self.present.shape[0]
+        if rows == 0 or key in self.invalid:
+            return np.full(bars.shape, np.nan)
+
+        columns = np.arange(bars.shape[-1])
+        bars = np.clip(bars, 0, rows - 1)
+        first = np.minimum(first, bars)
+        if key in self.prices:
+            return self.prices[key][bars, columns]
+
+        indicator, length = key
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if indicator == 'sma':
+                lower = np.maximum(first, bars - length + 1)
+                total = self.sums[bars + 1, columns] - self.sums[lower, columns]
+                count = self.counts[bars + 1, columns] - self.counts[lower, columns]
+                result = np.where(count > 0, total / count, np.nan)
+            else:
+                gains, losses = self.averages[length]
+                decay = (1.0 - (1.0 / length)) ** (bars - first)
+                up = gains[bars, columns] - (decay * gains[first, columns])
+                start = decay * losses[first, columns]
+                down = losses[bars, columns] - start
+                # No losses since the start leaves rounding error, not zero
+                down = np.where(down <= start * 1e-9, 0.0, down)
+                result = np.where(down == 0.0, 100.0, 100.0 - (100.0 / (1.0 + (up / down))))
+
+        return np.where(self.present[bars, columns], result, np.nan)
+
+
+def compile_filter(filter: dict) -> Step:
+    try:
+        base = filter['base']
+        criteria = filter['criteria']
+
+        if base['technical'] not in VALID_TECHNICALS:
+            raise SyntaxError('Invalid "base technical" specified in script')
+        if base['series'] not in VALID_SERIES:
+            raise SyntaxError('Invalid "base series" specified in script')
+        if filter['conditional'] not in VALID_CONDITIONALS:
+            raise SyntaxError('Invalid "conditional" specified in script')
+        if criteria['technical'] not in VALID_TECHNICALS:
+            raise SyntaxError('Invalid "criteria technical" specified in script')
+        if criteria['series'] not in VALID_SERIES:
+            raise SyntaxError('Invalid "criteria series" specified in script')
+        if base['technical'] not in BASE_TECHNICALS:
+            raise SyntaxError('Invalid "base technical" specified in screen file')
+        if base['technical'] != 'true' and criteria['technical'] not in CRITERIA_TECHNICALS:
+            raise SyntaxError('Invalid "criteria technical" specified in screen file')
+
+        step = Step(
+            filter['note'],
+            filter.get('weight', 1.0),
+            Operand(base['technical'], base['length'], base['start'], base['stop'], base['series'], base['factor']),
+            filter['conditional'],
+            Operand(criteria['technical'], criteria['length'], criteria['start'], criteria['stop'], criteria['series'],
+                    criteria['factor'], criteria['value']))
+    except KeyError as e:
+        raise SyntaxError(f'Missing {e} in script') from e
+
+    return step
+
+
+def _calculate_indicators(indicators: set[tuple[str, int]], close: np.ndarray, days: int,
+                          spans: list[str | None] | None = None) -> dict[tuple[str, int], np.ndarray]:
+    # Same validity rule as Technical: invalid lengths give no values
+    results = {}
+    valid = set()
+    for indicator, length in indicators:
+        if length > 5 and length < days:
+            valid.add((indicator, length))
+        else:
+            _logger.warning(f'{__name__}: Invalid interval for {indicator.upper()}')
+            results[(indicator, length)] = np.full(close.shape, np.nan)
+
+    if spans is None:
+        # All SMA lengths in one pass
+        smas = technical.rolling_mean(close, sorted(length for indicator, length in valid if indicator == 'sma'))
+        results.update({('sma', length): sma for length, sma in smas.items()})
+
+        for indicator, length in valid:
+            if indicator == 'rsi':
+                results[(indicator, length)] = technical.rsi(close, length)
+    else:
+        # Each ticker's indicators are memoized, so only those not already calculated (ex: by an earlier screen
+        # or divergence over the same bars) are. Bars end at the last row, as in the price matrices
+        lengths = (~np.isnan(close)).sum(axis=0)
+        for indicator, length in valid:
+            if indicator == 'sma':
+                compute = lambda columns, length=length: technical.rolling_mean(close[:, columns], [length])[length]
+            else:
+                compute = lambda columns, length=length: technical.rsi(close[:, columns], length)
+
+            results[(indicator, length)] = memo.get_columns(spans, lengths, indicator, compute, len(close), end=True, interval=length)
+
+    return results
+
+
+def _compare(step: Step, base: np.ndarray, criteria: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Same rules as the Interpreter for any shape of values. Also returns the criteria as described
+    base_empty = np.isnan(base)
+    criteria_empty = np.isnan(criteria)
+    criteria = np.where(criteria_empty, 0.0, criteria * step.criteria.factor)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if step.conditional == 'le':
+            score = np.where(base > 0.0, criteria / base, 1.0)
+            success = base <= criteria
+        elif step.conditional == 'ge':
+            score = np.where(criteria > 0.0, base / criteria, 1.0)
+            success = base >= criteria
+        else:
+            score = np.ones(base.shape)
+            success = base == criteria
+
+    success &= ~criteria_empty & ~base_empty
+    score = np.where(criteria_empty, 1.0, score)
+    score = score * step.weight if step.weight > 0.0 else np.ones(base.shape)
+    score = np.where(base_empty, 1.0, score)
+
+    return success, score, criteria
+
+
+def _bounds(operand: Operand, lengths: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Bounds Python slicing would give for the operand's slice of histories of 'lengths' bars
+    if operand.start == 0:
+        lower = np.zeros_like(lengths)
+    elif operand.start > 0:
+        lower = np.minimum(operand.start, lengths)
+    else:
+        lower = np.maximum(lengths + operand.start, 0)
+
+    if operand.stop == 0:
+        upper = lengths
+    elif operand.stop > 0:
+        upper = np.minimum(operand.stop, lengths)
+    else:
+        upper = np.maximum(lengths + operand.stop, 0)
+
+    return lower, upper
+
+
+def _slice(matrix: np.ndarray, operand: Operand, first: np.ndarray, series: str) -> np.ndarray:
+    # Last, min or max of the operand's slice of each column's history, which starts at its 'first' row
+    lower, upper = _bounds(operand, matrix.shape[0] - first)
+    lower, upper = lower + first, upper + first
+    if matrix.shape[0] == 0:
+        return np.full(matrix.shape[1], np.nan)
+
+    if series not in ('min', 'max'):
+        values = matrix[np.maximum(upper - 1, 0), np.arange(matrix.shape[1])]
+    else:
+        index = np.arange(matrix.shape[0])[:, None]
+        inside = (index >= lower) & (index < upper)
+        ufunc = np.fmin if series == 'min' else np.fmax
+        values = ufunc.reduce(np.where(inside, matrix, np.nan), axis=0)
+
+    return np.where(upper <= lower, np.nan, values).astype(float)
+
+
+def _window(data: _Range, key: str | tuple[str, int], operand: Operand, first: np.ndarray, lengths: np.ndarray,
+            series: str) -> np.ndarray:
+    # Last, min or max of the operand's slice of each column's history of 'lengths' bars from its 'first' bar
+    # (rows x columns), with the same bounds Python slicing would give on the truncated history
+    lower, upper = _bounds(operand, lengths)
+    empty = upper <= lower
+
+    if series not in ('min', 'max'):
+        values = data.values(key, first + np.maximum(upper - 1, 0), first)
+    else:
+        # One bar of every slice at a time, as indicators depend on where each history starts
+        ufunc = np.fmin if series == 'min' else np.fmax
+        widths = upper - lower
+        values = np.full(lengths.shape, np.nan)
+        for offset in range(int(widths.max(initial=0))):
+            inside = offset < widths
+            values = ufunc(values, np.where(inside, data.values(key, first + lower + offset, first), np.nan))
+
+    return np.where(empty, np.nan, values).astype(float)
+
+
+def get_stats(step: Step) -> tuple[int, int, float]:
+    with _stats_lock:
+        evaluated, passed, seconds = _stats.get(step.key, (0, 0, 0.0))
+
+    return evaluated, passed, seconds
+
+
+def clear_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def record_stats(step: Step, evaluated: int, passed: int, seconds: float) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault(step.key, [0, 0, 0.0])
+        stats[0] += evaluated
+        stats[1] += passed
+        stats[2] += seconds
+
+
+def _to_float(value: object) -> float:
+    try:
+        return float(value) if value is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _describe(step: Step, tickers: list[str], success: np.ndarray, score: np.ndarray,
+              base: np.ndarray, criteria: np.ndarray, empty: np.ndarray) -> list[str]:
+    # Same text as the Interpreter
+    descriptions = []
+    for ticker, s, sc, b, c, e in zip(tickers, success, score, base, criteria, empty):
+        pf = 'Pass' if s else 'Fail'
+        if e:
+            basef = criteriaf = '***'
+        else:
+            basef = f'{b:.2f}' if b < 1e5 else f'{b:.1e}'
+            criteriaf = f'{c:.2f}' if c < 1e5 else f'{c:.1e}'
+
+        descriptions.append(
+            f'{ticker:6s} {pf} {sc:6.2f}: {step.note:18s}: ' +
+            f'{step.base.technical}({step.base.length})/{basef}@{step.base.factor:.2f} ' +
+            f'{step.conditional} ' +
+            f'{step.criteria.technical}({step.criteria.length})/{step.criteria.start}/{step.criteria.series}/{criteriaf}@{step.criteria.factor:.2f} ' +
+            f'w={step.weight:.1f}')
+
+    return descriptions
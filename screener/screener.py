@@ -1,9 +1,12 @@
+import os
 import json
-import random
+import time
+import threading
+import multiprocessing
 import datetime as dt
 from pathlib import Path
-from concurrent import futures
 from dataclasses import dataclass
+from concurrent import futures
 
 import numpy as np
 import pandas as pd
@@ -11,8 +14,10 @@ import pandas as pd
 from base import Threaded
 from analysis.company import Company
 from data import store as store
-from .interpreter import Interpreter
-from utils import ui, cache, logger
+from data import panel as panel_
+from data.panel import Panel
+from .plan import Plan, Evaluation, get_stats, record_stats
+from utils import ui, cache, memo, logger
 
 
 _logger = logger.get_logger()
@@ -22,6 +27,14 @@ SCREEN_SUFFIX = 'screen'
 SCREEN_INIT_NAME = 'init'
 
 CACHE_TYPE = 'scr'
+SCHEMA_VERSION = 2  # Increment when the cached results table changes
+
+PROCESS_AUTO = -1  # One worker process per core, only when the screen's estimate says they're faster
+PROCESS_START_SECONDS = 2.0  # Assumed cost of starting a pool of workers until one has been measured
+PROCESS_CHUNKS = 4  # Ticker ranges per worker process
+PROCESS_CONTEXT = 'spawn'  # Workers don't inherit the parent's threads or database connections
+
+_process_seconds = PROCESS_START_SECONDS  # Measured cost of starting the last pool
 
 
 @dataclass
@@ -49,7 +62,8 @@ class Result:
 
 
 class Screener(Threaded):
-    def __init__(self, table: str, screen: str, days: int = 365, backtest: int = 0, live: bool = False):
+    def __init__(self, table: str, screen: str, days: int = 365, backtest: int = 0, live: bool = False, short_circuit: bool = False,
+                 processes: int = 0):
         if not table:
             raise ValueError('Table not specified')
         if not screen:
@@ -58,6 +72,8 @@ class Screener(Threaded):
             raise ValueError('Invalid number of days')
         if backtest < 0:
             raise ValueError('Invalid backtest days')
+        if processes < PROCESS_AUTO:
+            raise ValueError('Invalid number of processes')
 
         super().__init__()
 
@@ -66,6 +82,8 @@ class Screener(Threaded):
         self.days = days
         self.backtest = backtest
         self.live = live if store.is_database_connected() else True
+        self.short_circuit = short_circuit  # Stop at the first failed filter. Scores are only complete for valid results
+        self.processes = processes  # Worker processes, PROCESS_AUTO for large lists only, or 0 to screen in-process
 
         if self.table == 'EVERY':
             self.type = 'every'
@@ -79,11 +97,12 @@ class Screener(Threaded):
             self.type = ''
             raise ValueError(f'Table not found: {self.table}')
 
-        self.script_path: str = f'{SCREEN_BASEPATH}/{screen}.{SCREEN_SUFFIX}'
-        self.init_path = f'{SCREEN_BASEPATH}/{SCREEN_INIT_NAME}.{SCREEN_SUFFIX}'
         self.cache_name: str = ''
+        self.cache_key: str = ''
         self.cache_used = False
         self.scripts: list[dict] = []
+        self.plan: Plan = None
+        self.panel: Panel = None
         self.companies: list[Company] = []
         self.results: list[Result] = []
         self.valids: list[Result] = []
@@ -93,6 +112,7 @@ class Screener(Threaded):
         self.cache_available = False
         self.cache_date: str = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
         self.cache_today_only: bool = cache.CACHE_TODAY_ONLY
+        self._lock = threading.Lock()
 
         if not self._load_screen():
             raise ValueError(f'Script not found or invalid format: {screen}')
@@ -100,9 +120,19 @@ class Screener(Threaded):
             raise AssertionError('Error opening screen')
 
         self.cache_name = f'{table.lower()}-{screen.lower()}'
-        self.cache_available = cache.exists(self.cache_name, CACHE_TYPE, today_only=self.cache_today_only)
+        self.cache_key = cache.build_key(
+            table=self.table,
+            scripts=self.scripts,
+            days=self.days,
+            backtest=self.backtest,
+            short_circuit=self.short_circuit,
+            revision=store.get_database_revision(live=self.live))
+
+        table, self.cache_date = cache.load(self.cache_name, CACHE_TYPE, today_only=self.cache_today_only, params=self.cache_key)
+        results = table_to_results(table, self.days, backtest=self.backtest, live=self.live)
+        self.cache_available = results is not None
         if self.cache_available:
-            self.results, self.cache_date = cache.load(self.cache_name, CACHE_TYPE, today_only=self.cache_today_only)
+            self.results = results
 
     def __repr__(self):
         return f'<Screener ({self.table} - {self.screen})>'
@@ -146,16 +176,20 @@ class Screener(Threaded):
             else:
                 _logger.info(f'{__name__}: Screening {self.table} (days={self.days}, end={self.backtest})')
 
-            # Randomize and split up the lists
-            random.shuffle(self.companies)
-            companies: list[np.ndarray] = np.array_split(self.companies, self.concurrency)
-            companies = [i.tolist() for i in companies if i is not None]
-
-            with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-                self.task_futures = [executor.submit(self._run, list) for list in companies]
+            # Load company information for the whole list with one query rather than one per ticker. When
+            # short-circuiting, it is only loaded for the tickers that reach the first filter that needs it
+            tickers = [company.ticker for company in self.companies]
+            information = {}
+            if not self.short_circuit and (not self.live or self.plan.requires_information):
+                information = store.get_companies(tickers, live=self.live)
+
+            # Load all the histories into one panel, then evaluate the compiled screen over all the tickers at once.
+            # Backtests load extra days, then screen the panel without the last 'backtest' days
+            days = self.days if self.live else self.days + self.backtest
+            self.panel = store.get_history_panel(tickers, days, live=self.live)
+            self.task_completed = self.task_total
 
-                for future in futures.as_completed(self.task_futures):
-                    _logger.info(f'{__name__}: Thread completed: {future.result()}')
+            self._run(information)
 
             # Extract the successful screens, sort based on score, then summarize
             self.valids = [result for result in self.results if result]
@@ -165,7 +199,8 @@ class Screener(Threaded):
             self.task_state = 'Done'
 
             if save_results:
-                cache.dump(self.results, self.cache_name, CACHE_TYPE)
+                table = results_to_table(self.results, self.days, backtest=self.backtest, live=self.live)
+                cache.dump(table, self.cache_name, CACHE_TYPE, params=self.cache_key)
 
     def get_score(self, ticker: str) -> float:
         ticker = ticker.upper()
@@ -177,76 +212,132 @@ class Screener(Threaded):
 
         return score
 
-    def _run(self, companies: list[Company]) -> None:
-        for company in companies:
-            successes = []
-            scores = []
-            descriptions = []
-            self.task_ticker = str(company)
-            for filter in self.scripts:
-                try:
-                    interpreter = Interpreter(company, filter)
-                    successes.append(interpreter.run())
-                    scores.append(interpreter.score)
-                    descriptions.append(interpreter.description)
-                except SyntaxError as e:
-                    self.task_state = str(e)
-                    _logger.error(f'{__name__}: SyntaxError: {self.task_state}')
-                    break
-                except RuntimeError as e:
-                    self.task_state = str(e)
-                    _logger.error(f'{__name__}: RuntimeError: {self.task_state}')
-                    break
-                except Exception as e:
-                    self.task_state = str(e)
-                    _logger.error(f'{__name__}: Exception: {self.task_state} for {company}')
-                    break
-
-            if self.task_state == 'None':
-                self.task_completed += 1
-
-                price = store.get_last_price(company.ticker)
-                self.results.append(Result(company, self.screen, successes, scores, descriptions, price))
-                if (bool(self.results[-1])):
-                    self.task_success += 1
+    def _run(self, information: dict[str, dict]) -> None:
+        tickers = [company.ticker for company in self.companies]
+        panel = self.panel.truncate(self.backtest) if not self.live else self.panel
+        prices = self.panel.get_last('close')
+
+        def load_information(tickers: list[str]) -> dict[str, dict]:
+            information.update(store.get_companies(tickers, live=self.live))
+            return information
+
+        try:
+            if self._use_processes(len(tickers)):
+                # Workers can't call back for information, so load it for all the tickers first
+                if self.short_circuit and self.plan.requires_information:
+                    load_information(tickers)
+
+                evaluation = self._evaluate_processes(panel, information)
             else:
-                self.task_completed = self.task_total
-                self.results = []
-                self.valids = []
-                break
+                # Each ticker's own bars, as in its history, not the rows forward filled across the panel's dates
+                bars = panel.compact()
+                evaluation = self.plan.evaluate(bars['close'], bars['high'], bars['low'], bars['volume'], tickers,
+                                                load_information if self.short_circuit else information, self.days,
+                                                short_circuit=self.short_circuit, spans=memo.build_spans(panel, tickers))
+        except Exception as e:
+            self.task_state = str(e)
+            self.results = []
+            self.valids = []
+            _logger.error(f'{__name__}: Exception: {self.task_state}')
+        else:
+            for n, company in enumerate(self.companies):
+                company.panel = panel
+                if not company.information and information.get(company.ticker):
+                    company.information = information[company.ticker]
+
+                price = 0.0 if np.isnan(prices[n]) else float(prices[n])
+                result = Result(company, self.screen, evaluation.successes[n].tolist(), evaluation.scores[n].tolist(),
+                                evaluation.descriptions[n], price)
+                self.results.append(result)
+                if bool(result):
+                    with self._lock:
+                        self.task_success += 1
+
+    def _use_processes(self, count: int) -> bool:
+        # A number of workers always uses them. Otherwise they only pay for their start up on large screens,
+        # so stay in-process unless the plan's measured cost, spread over the cores, saves more than the
+        # measured cost of starting a pool
+        if self.processes == PROCESS_AUTO:
+            workers = os.cpu_count() or 1
+            seconds = self.plan.estimate(count)
+            return workers > 1 and seconds - (seconds / workers) >= _process_seconds
+
+        return self.processes > 0
+
+    def _evaluate_processes(self, panel: Panel, information: dict[str, dict]) -> Evaluation:
+        # The panel is copied into shared memory once, then each worker attaches to it and evaluates
+        # ranges of tickers (columns) without copying. Results are combined in ticker order, and the
+        # workers' step stats are added to this process's
+        global _process_seconds
+
+        count = len(panel.tickers)
+        workers = self.processes if self.processes > 0 else (os.cpu_count() or 1)
+        steps = len(self.plan)
+        successes = np.zeros((count, steps), dtype=bool)
+        scores = np.ones((count, steps), dtype=float)
+        evaluated = np.zeros((count, steps), dtype=bool)
+        descriptions: list[list[str]] = [[] for _ in range(count)]
+
+        chunks = np.array_split(np.arange(count), workers * PROCESS_CHUNKS)
+        ranges = [(int(chunk[0]), int(chunk[-1]) + 1) for chunk in chunks if chunk.size > 0]
+
+        start_time = time.perf_counter()
+        working = 0.0
+        spec, blocks = panel.share()
+        try:
+            context = multiprocessing.get_context(PROCESS_CONTEXT)
+            with futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                             initializer=_attach_worker, initargs=(spec, self.scripts)) as executor:
+                tasks = []
+                for start, stop in ranges:
+                    chunk = {ticker: information[ticker] for ticker in panel.tickers[start:stop] if ticker in information}
+                    tasks.append(executor.submit(_evaluate_columns, start, stop, chunk, self.days, self.short_circuit))
+
+                _logger.info(f'{__name__}: Screening {count} symbols with {workers} processes')
+
+                for task in futures.as_completed(tasks):
+                    start, stop, evaluation, stats = task.result()
+                    for n, tested, passed, seconds in stats:
+                        record_stats(self.plan.steps[n], tested, passed, seconds)
+                        working += seconds
+
+                    successes[start:stop] = evaluation.successes
+                    scores[start:stop] = evaluation.scores
+                    evaluated[start:stop] = evaluation.evaluated
+                    descriptions[start:stop] = evaluation.descriptions
+
+                    with self._lock:
+                        self.task_counter += 1
+                        self.task_ticker = panel.tickers[stop-1]
+        finally:
+            panel_.release(blocks)
+
+        # What the pool took beyond the workers' share of the screening
+        _process_seconds = max(time.perf_counter() - start_time - (working / workers), 0.0)
+        _logger.info(f'{__name__}: Worker processes took {_process_seconds:.2f}s to start')
+
+        return Evaluation(panel.tickers, successes, scores, descriptions, evaluated)
 
     def _load_screen(self) -> bool:
-        self.scripts = []
-        path = Path(self.script_path)
-        if path.is_file():
+        self.scripts = load_scripts(self.screen)
+
+        # Compile once. Syntax errors are found here rather than while screening
+        if self.scripts:
             try:
-                with open(path) as f:
-                    self.scripts = json.load(f)
-            except:
+                self.plan = Plan(self.scripts)
+            except SyntaxError as e:
                 self.scripts = []
-                _logger.error(f'{__name__}: File format error')
-            else:
-                self._add_init_script()
-        else:
-            _logger.error(f'{__name__}: File "{self.screen}" not found')
+                _logger.error(f'{__name__}: SyntaxError: {str(e)}')
 
         return bool(self.scripts)
 
     def _open_screen(self) -> bool:
-        tickers = []
-
-        if self.type == 'every':
-            tickers = store.get_tickers('every')
-        elif self.type == 'exchange':
-            tickers = store.get_exchange_tickers(self.table)
-        elif self.type == 'index':
-            tickers = store.get_index_tickers(self.table)
-        else:
-            tickers = [self.table]
+        tickers = get_table_tickers(self.table)
 
         if len(tickers) > 0:
             try:
-                self.companies = [Company(ticker, self.days, backtest=self.backtest, live=self.live) for ticker in tickers]
+                # Tickers come from the store (or were checked above), so skip validating each one
+                self.companies = [Company(ticker, self.days, backtest=self.backtest, live=self.live, validate=False) for ticker in tickers]
             except ValueError as e:
                 _logger.warning(f'{__name__}: Invalid ticker: {e}')
 
@@ -259,58 +350,94 @@ class Screener(Threaded):
 
         return bool(self.companies)
 
-    def _add_init_script(self) -> bool:
-        path = Path(self.init_path)
-        if path.is_file():
-            try:
-                with open(path) as f:
-                    self.scripts += json.load(f)
-            except:
-                self.scripts = []
-                _logger.error(f'{__name__}: File format error')
-        else:
-            _logger.error(f'{__name__}: File \'init\' not found')
 
-        return bool(self.scripts)
+# Set once in each worker process by the pool initializer
+_worker_panel: Panel = None
+_worker_plan: Plan = None
+_worker_blocks = []
+
+
+def _attach_worker(spec: dict, scripts: list[dict]) -> None:
+    global _worker_panel, _worker_plan, _worker_blocks
+
+    _worker_panel, _worker_blocks = Panel.attach(spec)
+    _worker_plan = Plan(scripts)
+
+
+def _evaluate_columns(start: int, stop: int, information: dict[str, dict], days: int,
+                      short_circuit: bool) -> tuple[int, int, Evaluation, list[tuple[int, int, int, float]]]:
+    # Also returns what this range added to the stats of each distinct step
+    steps = {step.key: n for n, step in enumerate(_worker_plan.steps)}
+    before = {key: get_stats(_worker_plan.steps[n]) for key, n in steps.items()}
+
+    bars = _worker_panel.compact(np.arange(start, stop))
+    evaluation = _worker_plan.evaluate(bars['close'], bars['high'], bars['low'], bars['volume'],
+                                       _worker_panel.tickers[start:stop], information, days, short_circuit=short_circuit)
+
+    stats = []
+    for key, n in steps.items():
+        evaluated, passed, seconds = get_stats(_worker_plan.steps[n])
+        stats.append((n, evaluated - before[key][0], passed - before[key][1], seconds - before[key][2]))
+
+    return start, stop, evaluation, stats
+
+
+def load_scripts(screen: str) -> list[dict]:
+    # The screen's filters followed by the init filters, or none if either is missing or invalid
+    scripts = []
+    for name in (screen, SCREEN_INIT_NAME):
+        path = Path(f'{SCREEN_BASEPATH}/{name}.{SCREEN_SUFFIX}')
+        if not path.is_file():
+            _logger.error(f'{__name__}: File "{name}" not found')
+            return []
+
+        try:
+            with open(path) as f:
+                scripts += json.load(f)
+        except:
+            _logger.error(f'{__name__}: File format error')
+            return []
+
+    return scripts
+
+
+def get_table_tickers(table: str) -> list[str]:
+    table = table.upper()
+    if table == 'EVERY':
+        tickers = store.get_tickers('every')
+    elif store.is_exchange(table):
+        tickers = store.get_exchange_tickers(table)
+    elif store.is_index(table):
+        tickers = store.get_index_tickers(table)
+    elif store.is_ticker(table):
+        tickers = [table]
+    else:
+        tickers = []
+
+    return tickers
 
 
 def analyze_results(table: str) -> tuple[pd.DataFrame, pd.DataFrame]:
     table = table.lower()
 
-    def filter(files, table):
-        results = []
-        dates = []
-        for file in files:
-            parts = file.split('_')
-            date = parts[0]
-            parts = parts[2].split('-')
-            if parts[0] == table:
-                results.append(file)
-                dates.append(date)
-
-        # Only return results if all dates are equal (and exist)
-        if len(set(dates)) != 1:
-            results = []
+    # Cached results for the table, loaded directly rather than through a Screener per file.
+    # Keep only the most recent entry for each screen when several parameterizations are cached
+    entries = {}
+    for entry in cache.get_entries(CACHE_TYPE):
+        if entry['name'].split('-')[0] == table and entry['name'] not in entries:
+            entries[entry['name']] = entry
 
-        return results
+    # Only use results if all dates are equal (and exist)
+    entries = list(entries.values())
+    if len(set(entry['date'] for entry in entries)) != 1:
+        entries = []
 
     results: list[Result] = []
-    files = cache.get_filenames('', CACHE_TYPE)
-    files = filter(files, table)
-    for file in files:
-        parts = file.split('_')
-        if len(parts) == 3:
-            subparts = parts[2].split('-')  # Extract table and screen names
-
-            if parts[1] != CACHE_TYPE:
-                pass  # Wrong cache type
-            elif subparts[0] != table:
-                pass  # Wrong table name
-            else:
-                screen = Screener(subparts[0], subparts[1])
-                if screen.cache_available:
-                    screen.run()
-                    results += screen.valids
+    for entry in entries:
+        table = cache.load_file(entry['filename'])
+        if isinstance(table, pd.DataFrame):
+            cached = table_to_results(table[table['valid']], table.attrs.get('days', 365), live=table.attrs.get('live', False))
+            results += cached if cached else []
 
     summary: pd.DataFrame = pd.DataFrame()
     multiples: pd.DataFrame = pd.DataFrame()
@@ -330,9 +457,82 @@ def analyze_results(table: str) -> tuple[pd.DataFrame, pd.DataFrame]:
     return summary, multiples
 
 
+def results_to_table(results: list[Result], days: int, backtest: int = 0, live: bool = False) -> pd.DataFrame:
+    # Flat, typed columns for caching: one bool, float and string column per screen condition
+    # (success_0, score_0, description_0, ...) rather than lists in object columns.
+    # Only plain values are kept, not the Company objects with their histories
+    information = [result.company.information for result in results]
+    conditions = np.array([len(result.successes) for result in results], dtype=np.int16)
+    width = int(conditions.max()) if len(conditions) > 0 else 0
+
+    successes = np.zeros((len(results), width), dtype=bool)
+    scores = np.full((len(results), width), np.nan)
+    descriptions = np.full((len(results), width), '', dtype=object)
+    for n, result in enumerate(results):
+        successes[n, :conditions[n]] = result.successes
+        scores[n, :conditions[n]] = result.scores
+        descriptions[n, :conditions[n]] = result.descriptions
+
+    columns = {
+        'ticker': pd.Series([result.company.ticker for result in results], dtype='string'),
+        'screen': pd.Series([result.screen for result in results], dtype='category'),
+        'valid': np.array([bool(result) for result in results], dtype=bool),
+        'conditions': conditions,
+        'price_current': np.array([result.price_current for result in results], dtype=float),
+        'price_last': np.array([result.price_last for result in results], dtype=float),
+        'backtest_success': np.array([result.backtest_success for result in results], dtype=bool),
+        'name': pd.Series([info.get('name', '') if info else '' for info in information], dtype='string'),
+        'sector': pd.Series([info.get('sector', '') if info else '' for info in information], dtype='category'),
+    }
+    for n in range(width):
+        columns[f'success_{n}'] = successes[:, n]
+        columns[f'score_{n}'] = scores[:, n]
+        columns[f'description_{n}'] = pd.Series(descriptions[:, n], dtype='string')
+
+    table = pd.DataFrame(columns)
+    table.attrs = {'schema': SCHEMA_VERSION, 'days': days, 'backtest': backtest, 'live': live, 'width': width}
+
+    return table
+
+
+def table_to_results(table: pd.DataFrame | None, days: int, backtest: int = 0, live: bool = False) -> list[Result] | None:
+    results = None
+
+    if not isinstance(table, pd.DataFrame):
+        pass  # Not cached or an older cache format
+    elif table.attrs.get('schema') != SCHEMA_VERSION:
+        _logger.info(f'{__name__}: Cached results not used. Schema version {table.attrs.get("schema")} != {SCHEMA_VERSION}')
+    else:
+        width = table.attrs.get('width', 0)
+        successes = table[[f'success_{n}' for n in range(width)]].to_numpy(dtype=bool)
+        scores = table[[f'score_{n}' for n in range(width)]].to_numpy(dtype=float)
+        descriptions = table[[f'description_{n}' for n in range(width)]].astype(object).to_numpy()
+
+        results = []
+        for n, row in enumerate(table.itertuples(index=False)):
+            # Tickers were validated when the results were created
+            company = Company(row.ticker, days, backtest=backtest, live=live, validate=False)
+            if row.name:
+                company.information = {'name': row.name, 'sector': row.sector}
+
+            count = row.conditions
+            results.append(Result(company, row.screen, successes[n, :count].tolist(), scores[n, :count].tolist(),
+                                  descriptions[n, :count].tolist(), row.price_current, price_last=row.price_last,
+                                  backtest_success=bool(row.backtest_success)))
+
+    return results
+
+
 def summarize_results(results: list[Result]) -> pd.DataFrame:
     summary = pd.DataFrame()
 
+    # Fill in any missing company information in bulk
+    missing = [result.company for result in results if not result.company.information]
+    if missing:
+        companies = store.get_companies([company.ticker for company in missing], live=missing[0].live)
+        for company in missing:
+            company.information = companies.get(company.ticker, {'name': '', 'sector': ''})
+
     items = [{
         'ticker': result.company.ticker,
         'valid': bool(result),
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from analysis import divergence
+from data.panel import Panel
+from screener.plan import Plan
+from utils import memo
+
+
+RSI_SCREEN = [{
+    'note': 'RSI < 70',
+    'base': {'technical': 'rsi', 'length': 14, 'start': -1, 'stop': 0, 'series': 'none', 'factor': 1.0},
+    'conditional': 'le',
+    'criteria': {'technical': 'value', 'value': 70.0, 'length': 0, 'start': -1, 'stop': 0, 'series': 'none', 'factor': 1.0}
+}]
+
+
+def _panel() -> Panel:
+    # Tickers starting on different dates, with some missing bars
+    rng = np.random.default_rng(1)
+    dates = pd.bdate_range('2022-01-03', periods=300)
+    histories = {}
+    for n, ticker in enumerate(['AAA', 'BBB', 'CCC', 'DDD']):
+        close = 50.0 * np.exp(np.cumsum(rng.normal(0.0, 0.02, len(dates))))
+        history = pd.DataFrame({'date': dates, 'open': close, 'high': close * 1.01, 'low': close * 0.99, 'close': close, 'volume': 1e6})
+        history = history.iloc[n * 20:]
+        histories[ticker] = history[rng.random(len(history)) > 0.05].reset_index(drop=True)
+
+    return Panel.from_histories(histories)
+
+
+def test_screen_then_divergence_hits():
+    memo.clear()
+    cache = memo.get_cache()
+    panel = _panel()
+    spans = memo.build_spans(panel, panel.tickers)
+
+    bars = panel.compact()
+    Plan(RSI_SCREEN).evaluate(bars['close'], bars['high'], bars['low'], bars['volume'], panel.tickers, {}, 365, spans=spans)
+    assert (cache.hits, cache.misses) == (0, len(panel.tickers))
+
+    # Divergence over the same bars reuses the screen's RSI, and gets the same results as without the memo
+    close = panel.compact(end=False)['close']
+    results = divergence.calculate(close, 15, 14, 2, spans=spans)
+    assert (cache.hits, cache.misses) == (len(panel.tickers), len(panel.tickers))
+    np.testing.assert_array_equal(results, divergence.calculate(close, 15, 14, 2))
+
+
+def test_history_and_panel_spans_match():
+    panel = _panel()
+    column = panel.index['BBB']
+    valid = panel.valid[:, column]
+    history = pd.DataFrame({'date': panel.dates[valid], **{field: getattr(panel, field)[valid, column] for field in memo.BAR_FIELDS}})
+
+    assert memo.build_history_span('BBB', history) == memo.build_spans(panel, ['BBB'])[0]
@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from base import Threaded
+from data.panel import Panel
+from screener import plan as plan_
+from screener.plan import Plan
+from screener.screener import Screener
+
+
+SCREEN = [{
+    'note': 'RSI < 60',
+    'base': {'technical': 'rsi', 'length': 14, 'start': -1, 'stop': 0, 'series': 'none', 'factor': 1.0},
+    'conditional': 'le',
+    'criteria': {'technical': 'value', 'value': 60.0, 'length': 0, 'start': -1, 'stop': 0, 'series': 'none', 'factor': 1.0}
+}, {
+    'note': 'Close > 20-day low',
+    'base': {'technical': 'close', 'length': 0, 'start': -1, 'stop': 0, 'series': 'none', 'factor': 1.0},
+    'conditional': 'ge',
+    'criteria': {'technical': 'low', 'value': 0.0, 'length': 0, 'start': -20, 'stop': 0, 'series': 'min', 'factor': 1.05}
+}]
+
+
+def _panel() -> Panel:
+    rng = np.random.default_rng(2)
+    dates = pd.bdate_range('2022-01-03', periods=200)
+    histories = {}
+    for n in range(12):
+        close = 50.0 * np.exp(np.cumsum(rng.normal(0.0, 0.02, len(dates))))
+        history = pd.DataFrame({'date': dates, 'open': close, 'high': close * 1.01, 'low': close * 0.99, 'close': close, 'volume': 1e6})
+        histories[f'T{n:02d}'] = history.iloc[n * 5:].reset_index(drop=True)
+
+    return Panel.from_histories(histories)
+
+
+def _screener(processes: int) -> Screener:
+    # Only what screening a panel needs, without opening a table from the store
+    screener = Screener.__new__(Screener)
+    Threaded.__init__(screener)
+    screener.scripts = SCREEN
+    screener.plan = Plan(SCREEN)
+    screener.days = 365
+    screener.short_circuit = False
+    screener.processes = processes
+    screener._lock = threading.Lock()
+
+    return screener
+
+
+def test_processes_match_in_process():
+    panel = _panel()
+    screener = _screener(2)
+    assert screener._use_processes(len(panel.tickers))
+
+    plan_.clear_stats()
+    evaluation = screener._evaluate_processes(panel, {})
+
+    # Same results as in-process, with the workers' step stats added to this process's
+    bars = panel.compact()
+    expected = screener.plan.evaluate(bars['close'], bars['high'], bars['low'], bars['volume'], panel.tickers, {}, 365)
+    np.testing.assert_array_equal(evaluation.successes, expected.successes)
+    np.testing.assert_allclose(evaluation.scores, expected.scores)
+    assert evaluation.descriptions == expected.descriptions
+    assert screener.task_counter > 0
+
+    for step in screener.plan.steps:
+        evaluated, _, _ = plan_.get_stats(step)
+        assert evaluated == 2 * len(panel.tickers)
@@ -1,6 +1,14 @@
 from pathlib import Path
+import json
 import pickle
+import hashlib
+import sqlite3
+import threading
+import importlib.util
 import datetime as dt
+from contextlib import closing
+
+import pandas as pd
 
 from utils import ui, logger
 
@@ -11,32 +19,28 @@ _logger = logger.get_logger()
 CACHE_BASEPATH = './cache'
 CACHE_SUFFIX = 'pickle'
 CACHE_TODAY_ONLY = False
+MANIFEST_NAME = 'manifest.db'
+
+# DataFrames are stored compressed, using zstd if available
+TABLE_COMPRESSION = 'zstd' if importlib.util.find_spec('zstandard') is not None else 'gzip'
+TABLE_SUFFIXES = {'zstd': 'zst', 'gzip': 'gz'}
+
+# The manifest indexes every cached file so lookups never scan the cache directory.
+# It is rebuilt from the files on disk if missing
+_lock = threading.Lock()
 
 
-def exists(name: str, type: str, today_only: bool = True) -> bool:
+def exists(name: str, type: str, today_only: bool = True, params: str = '') -> bool:
     if not name:
         raise AssertionError('Must include \'name\'')
     if not type:
         raise AssertionError('Must include \'type\'')
 
-    name = name.lower()
-    type = type.lower()
-    filenames = []
-    names = get_filenames(name, type)
-    if names and today_only:
-        date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
-        for item in names:
-            parts = item.split('_')
-            if parts[0] == date:
-                filenames = [item]
-                break
-    else:
-        filenames = names
+    return bool(_find(name.lower(), type.lower(), today_only, params))
 
-    return bool(filenames)
 
-
-def dump(object: object, name: str, type: str) -> str:
+def dump(object: object, name: str, type: str, params: str = '', replace: bool = False) -> str:
+    # With 'replace', earlier entries with the same name, type and params are removed rather than kept by date
     if not name:
         raise AssertionError('Must include \'name\'')
     if not type:
@@ -44,20 +48,39 @@ def dump(object: object, name: str, type: str) -> str:
 
     name = name.lower()
     type = type.lower()
-    filename = build_filename(name, type)
+    filename = build_filename(name, type, params)
     if filename:
         try:
-            with open(filename, 'wb') as f:
-                pickle.dump(object, f, protocol=pickle.HIGHEST_PROTOCOL)
-                _logger.info(f'{__name__}: Results for {name}/{type} saved to cache')
+            Path(CACHE_BASEPATH).mkdir(parents=True, exist_ok=True)
+            if isinstance(object, pd.DataFrame):
+                filename = f'{filename}.{TABLE_SUFFIXES[TABLE_COMPRESSION]}'
+                object.to_pickle(filename, compression=TABLE_COMPRESSION, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                with open(filename, 'wb') as f:
+                    pickle.dump(object, f, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception as e:
             filename = ''
             _logger.error(f'{__name__}: Exception for pickle dump: {str(e)}')
+        else:
+            path = Path(filename)
+            date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
+            _execute('INSERT OR REPLACE INTO entries (filename, name, type, date, size, params) VALUES (?, ?, ?, ?, ?, ?)',
+                     (path.name, name, type, date, path.stat().st_size, params))
+
+            if replace:
+                rows = _query('SELECT filename FROM entries WHERE type = ? AND name = ? AND params = ? AND filename != ?',
+                              (type, name, params, path.name))
+                for row in rows:
+                    (Path(CACHE_BASEPATH) / row[0]).unlink(missing_ok=True)
+
+                _executemany('DELETE FROM entries WHERE filename = ?', rows)
+
+            _logger.info(f'{__name__}: Results for {name}/{type} saved to cache')
 
     return filename
 
 
-def load(name: str, type: str, today_only: bool = True) -> tuple[object, str]:
+def load(name: str, type: str, today_only: bool = True, params: str = '') -> tuple[object, str]:
     if not name:
         raise AssertionError('Must include \'name\'')
     if not type:
@@ -67,33 +90,36 @@ def load(name: str, type: str, today_only: bool = True) -> tuple[object, str]:
     type = type.lower()
 
     object = None
-    filename = ''
     date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
 
-    names = get_filenames(name, type)
-    if not names:
-        pass
-    elif today_only:
-        for item in names:
-            parts = item.split('_')
-            if parts[0] == date:
-                filename = item
-                break
-    else:
-        filename = names[0] # The latest file
-        parts = filename.split('_')
-        date = parts[0]
+    entry = _find(name, type, today_only, params)
+    if entry:
+        filename, date = entry
+        object = load_file(filename)
+        if object is not None:
+            _logger.info(f'{__name__}: Cached results for {name}/{type} available')
 
-    if filename:
-        filename = f'{CACHE_BASEPATH}/{filename}.{CACHE_SUFFIX}'
-        try:
-            with open(filename, 'rb') as f:
+    return object, date
+
+
+def load_file(filename: str) -> object:
+    object = None
+    path = Path(CACHE_BASEPATH) / filename
+    try:
+        if path.suffix == f'.{CACHE_SUFFIX}':
+            with open(path, 'rb') as f:
                 object = pickle.load(f)
-                _logger.info(f'{__name__}: Cached results for {name}/{type} available')
-        except Exception as e:
-            _logger.error(f'{__name__}: Exception for pickle load: {str(e)}')
+        else:
+            object = pd.read_pickle(path)  # Compressed table, inferred from the suffix
+    except FileNotFoundError:
+        # Removed outside of the cache module, so drop the stale entry
+        _execute('DELETE FROM entries WHERE filename = ?', (path.name,))
+        _logger.warning(f'{__name__}: Cached file {path.name} no longer exists')
+    except Exception as e:
+        _logger.error(f'{__name__}: Exception for pickle load: {str(e)}')
+
+    return object
 
-    return object, date
 
 def delete(type: str) -> tuple[bool, str]:
     if not type:
@@ -103,33 +129,28 @@ def delete(type: str) -> tuple[bool, str]:
     success = True
     message = ''
 
-    files = get_filenames('', type)
+    date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
+    files = [row[0] for row in _query('SELECT filename FROM entries WHERE type = ?', (type,))]
     if files:
-        paths = []
-        date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
-        for path in files:
-            head, sep, tail = path.partition('.')
-            parts = head.split('_')
-            file_date = f'{parts[0]}'
-            if file_date != date:
-                file = f'{CACHE_BASEPATH}/{path}.{CACHE_SUFFIX}'
-                paths.append(file)
+        paths = [row[0] for row in _query('SELECT filename FROM entries WHERE type = ? AND date != ?', (type, date))]
 
         if paths:
-            deleted = 0
+            deleted = []
             for path in paths:
                 try:
-                    file = Path(path)
-                    file.unlink()
+                    file = Path(CACHE_BASEPATH) / path
+                    file.unlink(missing_ok=True)
                 except OSError as e:
                     success = False
                     message = f'File error for {e.filename}: {e.strerror}'
                     break
                 else:
-                    deleted += 1
+                    deleted.append((path,))
 
-            if success and deleted > 0:
-                message = f'Deleted {deleted} file(s)'
+            _executemany('DELETE FROM entries WHERE filename = ?', deleted)
+
+            if success and deleted:
+                message = f'Deleted {len(deleted)} file(s)'
         else:
             message = 'All files up to date'
     else:
@@ -147,26 +168,31 @@ def get_filenames(name: str, type: str, type_only: bool = False) -> list[str]:
     name = name.lower()
     type = type.lower()
 
-    files = []
-    path = Path(CACHE_BASEPATH)
-    items = [item for item in path.glob(f'*.{CACHE_SUFFIX}') if item.is_file()]
-    for item in items:
-        head, sep, tail = item.name.partition('.')
-        parts = head.split('_')
-
-        if len(parts) != 3:
-            pass # Bad filename structure
-        elif name and name != parts[2]:
-            pass # Bad name
-        elif type == parts[1]:
-            files.append(head)
+    if name:
+        rows = _query('SELECT filename FROM entries WHERE type = ? AND name = ? ORDER BY date DESC, rowid DESC', (type, name))
+    else:
+        rows = _query('SELECT filename FROM entries WHERE type = ? ORDER BY date DESC, rowid DESC', (type,))
 
     # Return most recent first
-    files.sort(reverse=True)
-    return files
+    return [row[0].partition('.')[0] for row in rows]
+
 
+def get_entries(type: str, name: str = '') -> list[dict]:
+    type = type.lower()
+    name = name.lower()
+
+    if name:
+        rows = _query('SELECT filename, name, type, date, size, params FROM entries WHERE type = ? AND name = ? '
+                      'ORDER BY date DESC, rowid DESC', (type, name))
+    else:
+        rows = _query('SELECT filename, name, type, date, size, params FROM entries WHERE type = ? '
+                      'ORDER BY date DESC, rowid DESC', (type,))
 
-def build_filename(name: str, type: str) -> str:
+    keys = ('filename', 'name', 'type', 'date', 'size', 'params')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def build_filename(name: str, type: str, params: str = '') -> str:
     if not name:
         raise ValueError('\'name\' must be valid')
     if not type:
@@ -175,11 +201,92 @@ def build_filename(name: str, type: str) -> str:
     name = name.lower()
     type = type.lower()
     date_time = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
-    filename = f'{CACHE_BASEPATH}/{date_time}_{type}_{name}.{CACHE_SUFFIX}'
+    if params:
+        filename = f'{CACHE_BASEPATH}/{date_time}_{type}_{name}_{params}.{CACHE_SUFFIX}'
+    else:
+        filename = f'{CACHE_BASEPATH}/{date_time}_{type}_{name}.{CACHE_SUFFIX}'
 
     return filename
 
 
+def build_key(**params) -> str:
+    # Stable hash of all inputs to a result. Sets are hashed in sorted order so the same
+    # tickers always give the same key regardless of order
+    params = {key: sorted(value) if isinstance(value, (set, frozenset)) else value for key, value in params.items()}
+    text = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def rebuild() -> int:
+    with _lock, closing(_connect()) as conn, conn:
+        conn.execute('DELETE FROM entries')
+        count = _scan(conn)
+
+    _logger.info(f'{__name__}: Rebuilt cache manifest with {count} entries')
+
+    return count
+
+
+def _find(name: str, type: str, today_only: bool, params: str = '') -> tuple[str, str] | None:
+    if today_only:
+        date = dt.datetime.now().strftime(ui.DATE_FORMAT_YMD)
+        rows = _query('SELECT filename, date FROM entries WHERE type = ? AND name = ? AND params = ? AND date = ? '
+                      'ORDER BY rowid DESC LIMIT 1', (type, name, params, date))
+    else:
+        rows = _query('SELECT filename, date FROM entries WHERE type = ? AND name = ? AND params = ? '
+                      'ORDER BY date DESC, rowid DESC LIMIT 1', (type, name, params))
+
+    return rows[0] if rows else None
+
+
+def _query(sql: str, args: tuple = ()) -> list[tuple]:
+    with _lock, closing(_connect()) as conn:
+        return conn.execute(sql, args).fetchall()
+
+
+def _execute(sql: str, args: tuple = ()) -> None:
+    with _lock, closing(_connect()) as conn, conn:
+        conn.execute(sql, args)
+
+
+def _executemany(sql: str, args: list[tuple]) -> None:
+    with _lock, closing(_connect()) as conn, conn:
+        conn.executemany(sql, args)
+
+
+def _connect() -> sqlite3.Connection:
+    path = Path(CACHE_BASEPATH)
+    path.mkdir(parents=True, exist_ok=True)
+
+    manifest = path / MANIFEST_NAME
+    missing = not manifest.is_file()
+
+    conn = sqlite3.connect(manifest)
+    if missing:
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(filename TEXT PRIMARY KEY, name TEXT, type TEXT, date TEXT, size INTEGER, params TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_type_name_date ON entries (type, name, date)')
+            count = _scan(conn)
+
+        _logger.info(f'{__name__}: Created cache manifest with {count} entries')
+
+    return conn
+
+
+def _scan(conn: sqlite3.Connection) -> int:
+    entries = []
+    for item in Path(CACHE_BASEPATH).glob(f'*.{CACHE_SUFFIX}*'):
+        parts = item.name.partition('.')[0].split('_')
+        if item.is_file() and len(parts) >= 3:
+            entries.append((item.name, parts[2], parts[1], parts[0], item.stat().st_size, '_'.join(parts[3:])))
+
+    conn.executemany('INSERT OR REPLACE INTO entries (filename, name, type, date, size, params) VALUES (?, ?, ?, ?, ?, ?)', entries)
+
+    return len(entries)
+
+
 if __name__ == '__main__':
     import sys
 
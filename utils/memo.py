@@ -0,0 +1,260 @@
+import os
+import time
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+
+import numpy as np
+import pandas as pd
+
+from utils import cache, logger
+
+
+_logger = logger.get_logger()
+
+MEMO_BASEPATH = f'{cache.CACHE_BASEPATH}/series'
+MEMO_SUFFIX = 'pickle'
+MEMO_SIZE = 32768  # Max series kept in memory. Screens keep one per ticker and indicator (a few KB each)
+MEMO_DISK = False  # Also keep series on disk, across sessions
+MEMO_DISK_AGE = 7  # Days a series is kept on disk
+MEMO_DISK_SIZE = 256  # Max MB of series kept on disk
+MEMO_PRUNE_WRITES = 256  # Disk writes between prunes
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'volume')  # Values of the last bar in a key
+
+
+# Two-tier (memory, then optionally disk) cache of series derived from price history (indicators, returns, etc.).
+# Keys are built from the ticker, indicator and parameters plus the span and last bar of the history they are
+# computed from, so new bars give a new key. Series come from single histories (get()) or from the columns of a
+# panel's bars (get_columns()), e.g. the screener's and divergence's indicators. The disk tier is pruned by age
+# and total size
+class SeriesCache:
+    def __init__(self, path: str = MEMO_BASEPATH, maxsize: int = MEMO_SIZE, disk: bool = MEMO_DISK):
+        if maxsize < 1:
+            raise ValueError('Invalid cache size')
+
+        self.path = Path(path)
+        self.maxsize = maxsize
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._series: OrderedDict[str, pd.Series] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<SeriesCache ({len(self._series)} series, {self.hits} hits, {self.misses} misses)>'
+
+    def get(self, ticker: str, indicator: str, history: pd.DataFrame, compute: Callable[[], pd.Series], **params) -> pd.Series:
+        if history.empty:
+            return compute()
+
+        key = build_key(ticker, indicator, history, **params)
+        series = self._lookup(key)
+
+        if series is None:
+            series = compute()
+            self._store(key, series)
+        else:
+            _logger.debug(f'{__name__}: Using cached {indicator} for {ticker}')
+
+        # Cached series are shared, so hand out copies
+        return series.copy()
+
+    def get_columns(self, spans: list[str | None], lengths: np.ndarray, indicator: str,
+                    compute: Callable[[np.ndarray], np.ndarray], rows: int, end: bool = True, **params) -> np.ndarray:
+        # Indicator matrix (rows x columns) of each column's bars, aligned to the last row or the first as in
+        # Panel.compact(), with each column cached under its span (see build_spans()). compute() is given the
+        # positions of the columns not cached, and returns their values. Columns without a span aren't cached
+        matrix = np.full((rows, len(spans)), np.nan)
+        keys = [build_column_key(span, indicator, **params) if span is not None else None for span in spans]
+        bars = [slice(rows - length, rows) if end else slice(0, length) for length in lengths]
+
+        missing = []
+        for n, key in enumerate(keys):
+            values = self._lookup(key) if key is not None else None
+            if values is None:
+                missing.append(n)
+            else:
+                matrix[bars[n], n] = values
+
+        if missing:
+            missing = np.array(missing)
+            computed = compute(missing)
+            matrix[:, missing] = computed
+
+            for i, n in enumerate(missing):
+                if keys[n] is not None:
+                    self._store(keys[n], computed[bars[n], i].copy())
+
+        return matrix
+
+    def clear(self, disk: bool = False) -> None:
+        with self._lock:
+            self._series.clear()
+            self.hits = 0
+            self.misses = 0
+
+        if disk and self.path.is_dir():
+            for item in self.path.glob(f'*.{MEMO_SUFFIX}'):
+                item.unlink(missing_ok=True)
+
+    def prune(self, age: int = MEMO_DISK_AGE, size: int = MEMO_DISK_SIZE) -> int:
+        # Remove series older than 'age' days, then the least recently written until under 'size' MB
+        removed = 0
+        if not self.path.is_dir():
+            return removed
+
+        expired = time.time() - age * 86400
+        items = []
+        for item in self.path.glob(f'*.{MEMO_SUFFIX}'):
+            try:
+                stat = item.stat()
+            except FileNotFoundError:
+                continue
+
+            if stat.st_mtime < expired:
+                item.unlink(missing_ok=True)
+                removed += 1
+            else:
+                items.append((stat.st_mtime, stat.st_size, item))
+
+        total = sum(item[1] for item in items)
+        for _, length, item in sorted(items, key=lambda item: item[0]):
+            if total <= size * 1024 * 1024:
+                break
+
+            item.unlink(missing_ok=True)
+            total -= length
+            removed += 1
+
+        if removed > 0:
+            _logger.info(f'{__name__}: Pruned {removed} cached series')
+
+        return removed
+
+    def _lookup(self, key: str) -> pd.Series | np.ndarray | None:
+        # Memory, then disk
+        with self._lock:
+            series = self._series.get(key)
+            if series is not None:
+                self._series.move_to_end(key)
+                self.hits += 1
+
+        if series is None and self.disk:
+            series = self._read(key)
+            if series is not None:
+                self._put(key, series)
+                with self._lock:
+                    self.hits += 1
+
+        return series
+
+    def _store(self, key: str, series: pd.Series | np.ndarray) -> None:
+        self._put(key, series)
+        if self.disk:
+            self._write(key, series)
+
+        with self._lock:
+            self.misses += 1
+
+    def _put(self, key: str, series: pd.Series) -> None:
+        with self._lock:
+            self._series[key] = series
+            self._series.move_to_end(key)
+            while len(self._series) > self.maxsize:
+                self._series.popitem(last=False)
+
+    def _read(self, key: str) -> pd.Series | None:
+        series = None
+        path = self.path / f'{key}.{MEMO_SUFFIX}'
+        if path.is_file():
+            try:
+                series = pd.read_pickle(path)
+            except Exception as e:
+                _logger.warning(f'{__name__}: Unable to read cached series {key}: {str(e)}')
+
+        return series
+
+    def _write(self, key: str, series: pd.Series) -> None:
+        # Write to a temporary file first so other threads/processes never read a partial file
+        path = self.path / f'{key}.{MEMO_SUFFIX}'
+        temp = self.path / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            pd.to_pickle(series, temp)
+            os.replace(temp, path)
+        except Exception as e:
+            temp.unlink(missing_ok=True)
+            _logger.warning(f'{__name__}: Unable to write cached series {key}: {str(e)}')
+        else:
+            with self._lock:
+                self._writes += 1
+                prune = self._writes % MEMO_PRUNE_WRITES == 1
+
+            if prune:
+                self.prune()
+
+
+def build_key(ticker: str, indicator: str, history: pd.DataFrame, **params) -> str:
+    return cache.build_key(span=build_history_span(ticker, history), indicator=indicator, **params)
+
+
+def build_history_span(ticker: str, history: pd.DataFrame) -> str:
+    # The first/last dates and length identify the span without reading the whole history. The last
+    # bar is included since a live history updates it during the day
+    first = history['date'].iloc[0] if 'date' in history else history.index[0]
+    last = history['date'].iloc[-1] if 'date' in history else history.index[-1]
+    bar = history.iloc[-1][[field for field in BAR_FIELDS if field in history]]
+
+    return build_span(ticker, first, last, len(history), bar)
+
+
+def build_span(ticker: str, first: object, last: object, length: int, bar: Iterable) -> str:
+    # Dates and values are normalized, so a history and a panel column with the same bars give the same span
+    return cache.build_key(ticker=ticker.upper(), first=pd.Timestamp(first).isoformat(), last=pd.Timestamp(last).isoformat(),
+                           length=int(length), bar=[float(value) for value in bar])
+
+
+def build_spans(panel: 'Panel', tickers: list[str]) -> list[str | None]:
+    # Span of each ticker's bars in the panel, as for its own history. None for tickers without bars
+    spans = []
+    for ticker in tickers:
+        column = panel.index[ticker.upper()]
+        rows = np.flatnonzero(panel.valid[:, column])
+        if rows.size > 0:
+            bar = [getattr(panel, field)[rows[-1], column] for field in BAR_FIELDS]
+            spans.append(build_span(ticker, panel.dates[rows[0]], panel.dates[rows[-1]], rows.size, bar))
+        else:
+            spans.append(None)
+
+    return spans
+
+
+def build_column_key(span: str, indicator: str, **params) -> str:
+    # Column values are arrays rather than the series of get(), so they are kept apart from them
+    return cache.build_key(span=span, indicator=indicator, layout='column', **params)
+
+
+_cache = SeriesCache()
+
+
+def get(ticker: str, indicator: str, history: pd.DataFrame, compute: Callable[[], pd.Series], **params) -> pd.Series:
+    return _cache.get(ticker, indicator, history, compute, **params)
+
+
+def get_columns(spans: list[str | None], lengths: np.ndarray, indicator: str,
+                compute: Callable[[np.ndarray], np.ndarray], rows: int, end: bool = True, **params) -> np.ndarray:
+    return _cache.get_columns(spans, lengths, indicator, compute, rows, end=end, **params)
+
+
+def clear(disk: bool = False) -> None:
+    _cache.clear(disk=disk)
+
+
+def prune() -> int:
+    return _cache.prune()
+
+
+def get_cache() -> SeriesCache:
+    return _cache